@@ -4,6 +4,7 @@ from discodos.utils import ask_user, print_help
 from discodos.views import User_int
 from discodos.ctrls import Mix_ctrl_cli, Coll_ctrl_cli
 from discodos.config import Db_setup, Config
+from discodos.models import Web_cache
 import logging
 import argparse
 import sys
@@ -28,6 +29,13 @@ def argparser(argv):
         (Discogs, MusicBrainz, AcousticBrainz) itself. This option
         forces offline mode. A lot of options work in on- and
         offline mode. Some behave differently, depending on connection state.""")
+    parser.add_argument(
+        "--cache-only", dest="cache_only",
+        action="store_true",
+        help="""Answers of Discogs, MusicBrainz and AcousticBrainz are kept in
+        a local web cache for a while. This option uses only what is cached
+        already and never asks the online services. Useful to re-run long
+        *Brainz matching imports without network cost.""")
     # basic subparser element:
     subparsers = parser.add_subparsers(dest='command')
     ### SEARCH subparser #######################################################
@@ -229,6 +237,28 @@ def argparser(argv):
         "-k", "--key", type=str,
         dest='suggest_key', metavar="KEY",
         help='suggests tracks based on musical key.')
+    suggest_subparser.add_argument(
+        "-H", "--harmonic", action='store_true',
+        dest='suggest_harmonic',
+        help='''together with -k: suggests tracks in harmonically compatible
+        keys (Camelot wheel: same key, +/-1, relative major/minor and
+        energy boost).''')
+    suggest_subparser.add_argument(
+        "-s", "--set", type=int,
+        dest='suggest_set', metavar="LENGTH",
+        help='''builds a set of LENGTH tracks, starting with the track found
+        via search_terms. Harmonically compatible keys, small BPM steps and
+        well rated transitions of your mixes are preferred.''')
+    suggest_subparser.add_argument(
+        "--drift", type=float, default=3,
+        dest='suggest_drift', metavar="PERCENT",
+        help='''together with -s: maximum BPM change from one track to the
+        next, in percent. Default: 3''')
+    suggest_subparser.add_argument(
+        "--total-drift", type=float, default=8,
+        dest='suggest_total_drift', metavar="PERCENT",
+        help='''together with -s: maximum BPM difference of any track in the
+        set to the first one, in percent. Default: 8''')
     ### IMPORT subparser ##########################################################
     import_subparser = subparsers.add_parser(
         name='import',
@@ -277,6 +307,13 @@ def argparser(argv):
         used in mixes and updated using "disco mix -u")
         will be updated.
         ''')
+    import_subparser.add_argument(
+        '--incremental', '-i', dest='import_incremental', action='store_true',
+        help='''only imports releases that are new in your Discogs collection
+        (or were added again since the last import), without tracks or
+        combined with -u, with tracks. Releases removed from the
+        Discogs collection are marked as such in the DiscoBASE. This is the
+        fastest way to keep your DiscoBASE in sync with Discogs.''')
     import_subparser.add_argument(
         "--resume", dest="import_offset", metavar='OFFSET',
         type=int, default=0,
@@ -285,6 +322,26 @@ def argparser(argv):
         with the *Brainz matching import operation only
         (-z, -zz)
         ''')
+    import_subparser.add_argument(
+        "--max-age", dest="import_max_age", metavar='DAYS',
+        type=int, default=None,
+        help='''*Brainz matching (-z, -zz) skips tracks that were matched
+        within the last DAYS days already. Default: config.yaml setting
+        brainz_max_age, or 0 (re-match all tracks).
+        ''')
+    import_subparser.add_argument(
+        "--missing-only", dest="import_missing_only", action='store_true',
+        help='''*Brainz matching (-z, -zz) only fetches AcousticBrainz data
+        (key, BPM) of tracks that have a MusicBrainz Recording ID but no
+        AcousticBrainz data yet. MusicBrainz is not asked.
+        ''')
+    import_subparser.add_argument(
+        "--continue", dest="import_continue", action='store_true',
+        help='''continues the last collection import or *Brainz matching
+        that was interrupted (eg. ctrl-c or connection loss), started with
+        the same options. Releases and tracks that were done already are
+        skipped. Without an interrupted run a new one is started.
+        ''')
     setup_subparser = subparsers.add_parser(
         name='setup',
         help='''sets up the DiscoBASE and handles database schema upgrades.
@@ -328,9 +385,13 @@ def _main():
     # check cli args and set attributes
     user = User_int(args)
     log.info("user.WANTS_ONLINE: %s", user.WANTS_ONLINE)
+    # WEB CACHE shared by Discogs, MusicBrainz and AcousticBrainz requests
+    web_cache = Web_cache(conf.webcache_file, conf.webcache_ttls,
+            conf.webcache_max_size, cache_only = args.cache_only)
     # INIT COLLECTION CONTROLLER (DISCOGS API CONNECTION)
     coll_ctrl = Coll_ctrl_cli(False, user, conf.discogs_token, conf.discogs_appid,
-            conf.discobase, conf.musicbrainz_user, conf.musicbrainz_password)
+            conf.discobase, conf.musicbrainz_user, conf.musicbrainz_password,
+            web_cache)
 
     #### SEARCH MODE
     if user.WANTS_TO_LIST_ALL_RELEASES:
@@ -487,26 +548,35 @@ def _main():
     #elif user.WANTS_SUGGEST_TRACK_REPORT:
     if user.WANTS_SUGGEST_TRACK_REPORT:
         coll_ctrl.track_report(args.suggest_search)
+    if user.WANTS_SUGGEST_SET:
+        coll_ctrl.set_report(args.suggest_search, args.suggest_set,
+            args.suggest_drift, args.suggest_total_drift)
     if user.WANTS_SUGGEST_BPM_REPORT:
         coll_ctrl.bpm_report(args.suggest_bpm, 6)
     if user.WANTS_SUGGEST_KEY_REPORT:
-        coll_ctrl.key_report(args.suggest_key)
+        coll_ctrl.key_report(args.suggest_key, harmonic=args.suggest_harmonic)
     if user.WANTS_SUGGEST_KEY_AND_BPM_REPORT:
-        coll_ctrl.key_and_bpm_report(args.suggest_key, args.suggest_bpm, 6)
+        coll_ctrl.key_and_bpm_report(args.suggest_key, args.suggest_bpm, 6,
+            harmonic=args.suggest_harmonic)
 
     ### IMPORT MODE
     if user.WANTS_TO_IMPORT_COLLECTION:
-        coll_ctrl.import_collection()
+        coll_ctrl.import_collection(incremental=user.IMPORT_INCREMENTAL,
+            resume=user.IMPORT_CONTINUE)
     if user.WANTS_TO_IMPORT_RELEASE:
         coll_ctrl.import_release(args.import_id)
     if user.WANTS_TO_ADD_AND_IMPORT_RELEASE:
         coll_ctrl.add_release(args.import_id)
     if user.WANTS_TO_IMPORT_COLLECTION_WITH_TRACKS:
-        coll_ctrl.import_collection(tracks=True)
+        coll_ctrl.import_collection(tracks=True,
+            incremental=user.IMPORT_INCREMENTAL, resume=user.IMPORT_CONTINUE)
     if user.WANTS_TO_IMPORT_COLLECTION_WITH_BRAINZ:
         coll_ctrl.update_all_tracks_from_brainz(
             detail=user.BRAINZ_SEARCH_DETAIL,
-            offset=user.RESUME_OFFSET)
+            offset=user.RESUME_OFFSET, resume=user.IMPORT_CONTINUE,
+            max_age=(conf.brainz_max_age if args.import_max_age is None
+                     else args.import_max_age),
+            missing_only=args.import_missing_only)
 
 
     if user.WANTS_TO_LAUNCH_SETUP:
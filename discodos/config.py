@@ -3,7 +3,7 @@
 # config.py is kind of a controller - it sets up db and creates config
 from discodos.models import Database, sqlerr
 from discodos.views import User_int
-from discodos.utils import read_yaml, print_help, ask_user
+from discodos.utils import read_yaml, print_help, ask_user, camelot_keys, camelot_neighbours
 import yaml
 import logging
 import pprint
@@ -122,12 +122,346 @@ class Db_setup(Database):
                 'Add field release.m_match_time': 'ALTER TABLE release ADD m_match_time TEXT;',
                 'Add field release.d_catno': 'ALTER TABLE release ADD d_catno TEXT;'
              }
-           }                       # list element 0 ends here
-           #{'schema_version': 3,  # list element 1 starts here
-           # 'tasks': {
-           #     'Add field track.test_upgrade': 'ALTER TABLE track ADD test_upgrade TEXT;',
-           # }
-           #}                      # list element 1 ends here
+           },                      # list element 0 ends here
+           {'schema_version': 3,   # full-text search index for offline search
+            'compile_option': 'ENABLE_FTS5', # else skipped, search uses LIKE
+            'tasks': {
+                'Create table release_fts': """
+                    CREATE VIRTUAL TABLE IF NOT EXISTS release_fts USING fts5(
+                      discogs_title, d_artist, d_catno,
+                      tokenize = 'unicode61 remove_diacritics 2',
+                      prefix = '2 3'); """,
+                'Create table track_fts': """
+                    CREATE VIRTUAL TABLE IF NOT EXISTS track_fts USING fts5(
+                      d_track_name, d_artist, notes,
+                      tokenize = 'unicode61 remove_diacritics 2',
+                      prefix = '2 3'); """,
+                # track.rowid may change on VACUUM, track_fts.rowid is this
+                # table's fts_rowid (an INTEGER PRIMARY KEY, which doesn't)
+                'Create table track_fts_key': """
+                    CREATE TABLE IF NOT EXISTS track_fts_key (
+                      fts_rowid INTEGER PRIMARY KEY,
+                      d_release_id INTEGER NOT NULL,
+                      d_track_no TEXT NOT NULL,
+                      UNIQUE (d_release_id, d_track_no)); """,
+                # release_fts.rowid is release.discogs_id
+                'Create trigger release_fts_insert': """
+                    CREATE TRIGGER IF NOT EXISTS release_fts_insert
+                    AFTER INSERT ON release BEGIN
+                      INSERT OR REPLACE INTO release_fts(rowid, discogs_title,
+                        d_artist, d_catno)
+                      VALUES (new.discogs_id, new.discogs_title, new.d_artist,
+                        new.d_catno);
+                    END; """,
+                'Create trigger release_fts_update': """
+                    CREATE TRIGGER IF NOT EXISTS release_fts_update
+                    AFTER UPDATE OF discogs_id, discogs_title, d_artist, d_catno
+                    ON release BEGIN
+                      DELETE FROM release_fts WHERE rowid = old.discogs_id;
+                      INSERT INTO release_fts(rowid, discogs_title, d_artist,
+                        d_catno)
+                      VALUES (new.discogs_id, new.discogs_title, new.d_artist,
+                        new.d_catno);
+                    END; """,
+                'Create trigger release_fts_delete': """
+                    CREATE TRIGGER IF NOT EXISTS release_fts_delete
+                    AFTER DELETE ON release BEGIN
+                      DELETE FROM release_fts WHERE rowid = old.discogs_id;
+                    END; """,
+                # notes come from track_ext
+                'Create trigger track_fts_insert': """
+                    CREATE TRIGGER IF NOT EXISTS track_fts_insert
+                    AFTER INSERT ON track BEGIN
+                      INSERT OR IGNORE INTO track_fts_key (d_release_id, d_track_no)
+                      VALUES (new.d_release_id, new.d_track_no);
+                      INSERT OR REPLACE INTO track_fts(rowid, d_track_name,
+                        d_artist, notes)
+                      VALUES ((SELECT fts_rowid FROM track_fts_key
+                          WHERE d_release_id = new.d_release_id
+                          AND d_track_no = new.d_track_no),
+                        new.d_track_name, new.d_artist,
+                        (SELECT notes FROM track_ext
+                          WHERE d_release_id = new.d_release_id
+                          AND d_track_no = new.d_track_no));
+                    END; """,
+                'Create trigger track_fts_update': """
+                    CREATE TRIGGER IF NOT EXISTS track_fts_update
+                    AFTER UPDATE OF d_release_id, d_track_no, d_track_name,
+                      d_artist ON track BEGIN
+                      UPDATE track_fts_key SET d_release_id = new.d_release_id,
+                        d_track_no = new.d_track_no
+                      WHERE d_release_id = old.d_release_id
+                        AND d_track_no = old.d_track_no;
+                      UPDATE track_fts SET d_track_name = new.d_track_name,
+                        d_artist = new.d_artist
+                      WHERE rowid = (SELECT fts_rowid FROM track_fts_key
+                        WHERE d_release_id = new.d_release_id
+                        AND d_track_no = new.d_track_no);
+                    END; """,
+                'Create trigger track_fts_delete': """
+                    CREATE TRIGGER IF NOT EXISTS track_fts_delete
+                    AFTER DELETE ON track BEGIN
+                      DELETE FROM track_fts WHERE rowid = (
+                        SELECT fts_rowid FROM track_fts_key
+                        WHERE d_release_id = old.d_release_id
+                        AND d_track_no = old.d_track_no);
+                      DELETE FROM track_fts_key
+                        WHERE d_release_id = old.d_release_id
+                        AND d_track_no = old.d_track_no;
+                    END; """,
+                'Create trigger track_ext_fts_insert': """
+                    CREATE TRIGGER IF NOT EXISTS track_ext_fts_insert
+                    AFTER INSERT ON track_ext BEGIN
+                      UPDATE track_fts SET notes = new.notes
+                      WHERE rowid = (SELECT fts_rowid FROM track_fts_key
+                        WHERE d_release_id = new.d_release_id
+                        AND d_track_no = new.d_track_no);
+                    END; """,
+                'Create trigger track_ext_fts_update': """
+                    CREATE TRIGGER IF NOT EXISTS track_ext_fts_update
+                    AFTER UPDATE OF notes ON track_ext BEGIN
+                      UPDATE track_fts SET notes = new.notes
+                      WHERE rowid = (SELECT fts_rowid FROM track_fts_key
+                        WHERE d_release_id = new.d_release_id
+                        AND d_track_no = new.d_track_no);
+                    END; """,
+                'Create trigger track_ext_fts_delete': """
+                    CREATE TRIGGER IF NOT EXISTS track_ext_fts_delete
+                    AFTER DELETE ON track_ext BEGIN
+                      UPDATE track_fts SET notes = NULL
+                      WHERE rowid = (SELECT fts_rowid FROM track_fts_key
+                        WHERE d_release_id = old.d_release_id
+                        AND d_track_no = old.d_track_no);
+                    END; """,
+                'Fill table release_fts': """
+                    INSERT OR REPLACE INTO release_fts(rowid, discogs_title,
+                      d_artist, d_catno)
+                    SELECT discogs_id, discogs_title, d_artist, d_catno
+                    FROM release; """,
+                'Fill table track_fts_key': """
+                    INSERT OR IGNORE INTO track_fts_key (d_release_id, d_track_no)
+                    SELECT d_release_id, d_track_no FROM track; """,
+                'Fill table track_fts': """
+                    INSERT OR REPLACE INTO track_fts(rowid, d_track_name,
+                      d_artist, notes)
+                    SELECT fts_rowid, d_track_name, d_artist, notes
+                    FROM track INNER JOIN track_fts_key
+                      ON track.d_release_id = track_fts_key.d_release_id
+                      AND track.d_track_no = track_fts_key.d_track_no
+                    LEFT OUTER JOIN track_ext
+                      ON track.d_release_id = track_ext.d_release_id
+                      AND track.d_track_no = track_ext.d_track_no; """,
+             }
+           },                      # list element 1 ends here
+           {'schema_version': 4,   # secondary indexes for mix_track lookups
+            'tasks': {             # track and track_ext joins use their primary keys
+                # mix listings, snippets and position shifting
+                'Create index mix_track_mix_id_track_pos': """
+                    CREATE INDEX IF NOT EXISTS mix_track_mix_id_track_pos
+                    ON mix_track (mix_id, track_pos); """,
+                # track reports: in which mixes was a track played (covering)
+                'Create index mix_track_d_release_id_d_track_no': """
+                    CREATE INDEX IF NOT EXISTS mix_track_d_release_id_d_track_no
+                    ON mix_track (d_release_id, d_track_no, mix_id, track_pos); """,
+             }
+           },                      # list element 2 ends here
+           {'schema_version': 5,   # effective BPM and key used by suggest
+            'tasks': {             # user input in track_ext wins over AcousticBrainz
+                'Add field track.chosen_bpm': 'ALTER TABLE track ADD chosen_bpm REAL;',
+                'Add field track.chosen_key': 'ALTER TABLE track ADD chosen_key TEXT;',
+                'Create trigger track_chosen_insert': """
+                    CREATE TRIGGER IF NOT EXISTS track_chosen_insert
+                    AFTER INSERT ON track BEGIN
+                      UPDATE track SET
+                        chosen_bpm = round(coalesce((SELECT bpm FROM track_ext
+                          WHERE d_release_id = new.d_release_id
+                          AND d_track_no = new.d_track_no), new.a_bpm), 1),
+                        chosen_key = coalesce((SELECT key FROM track_ext
+                          WHERE d_release_id = new.d_release_id
+                          AND d_track_no = new.d_track_no), new.a_key)
+                      WHERE rowid = new.rowid;
+                    END; """,
+                'Create trigger track_chosen_update': """
+                    CREATE TRIGGER IF NOT EXISTS track_chosen_update
+                    AFTER UPDATE OF a_bpm, a_key ON track BEGIN
+                      UPDATE track SET
+                        chosen_bpm = round(coalesce((SELECT bpm FROM track_ext
+                          WHERE d_release_id = new.d_release_id
+                          AND d_track_no = new.d_track_no), new.a_bpm), 1),
+                        chosen_key = coalesce((SELECT key FROM track_ext
+                          WHERE d_release_id = new.d_release_id
+                          AND d_track_no = new.d_track_no), new.a_key)
+                      WHERE rowid = new.rowid;
+                    END; """,
+                'Create trigger track_ext_chosen_insert': """
+                    CREATE TRIGGER IF NOT EXISTS track_ext_chosen_insert
+                    AFTER INSERT ON track_ext BEGIN
+                      UPDATE track SET
+                        chosen_bpm = round(coalesce(new.bpm, a_bpm), 1),
+                        chosen_key = coalesce(new.key, a_key)
+                      WHERE d_release_id = new.d_release_id
+                      AND d_track_no = new.d_track_no;
+                    END; """,
+                'Create trigger track_ext_chosen_update': """
+                    CREATE TRIGGER IF NOT EXISTS track_ext_chosen_update
+                    AFTER UPDATE OF bpm, key ON track_ext BEGIN
+                      UPDATE track SET
+                        chosen_bpm = round(coalesce(new.bpm, a_bpm), 1),
+                        chosen_key = coalesce(new.key, a_key)
+                      WHERE d_release_id = new.d_release_id
+                      AND d_track_no = new.d_track_no;
+                    END; """,
+                'Create trigger track_ext_chosen_delete': """
+                    CREATE TRIGGER IF NOT EXISTS track_ext_chosen_delete
+                    AFTER DELETE ON track_ext BEGIN
+                      UPDATE track SET
+                        chosen_bpm = round(a_bpm, 1),
+                        chosen_key = a_key
+                      WHERE d_release_id = old.d_release_id
+                      AND d_track_no = old.d_track_no;
+                    END; """,
+                'Fill fields track.chosen_bpm and track.chosen_key': """
+                    UPDATE track SET
+                      chosen_bpm = round(coalesce((SELECT bpm FROM track_ext
+                        WHERE track_ext.d_release_id = track.d_release_id
+                        AND track_ext.d_track_no = track.d_track_no), a_bpm), 1),
+                      chosen_key = coalesce((SELECT key FROM track_ext
+                        WHERE track_ext.d_release_id = track.d_release_id
+                        AND track_ext.d_track_no = track.d_track_no), a_key); """,
+                'Create index track_chosen_bpm': """
+                    CREATE INDEX IF NOT EXISTS track_chosen_bpm
+                    ON track (chosen_bpm); """,
+                'Create index track_chosen_key_chosen_bpm': """
+                    CREATE INDEX IF NOT EXISTS track_chosen_key_chosen_bpm
+                    ON track (chosen_key, chosen_bpm); """,
+             }
+           },                      # list element 3 ends here
+           {'schema_version': 6,   # Camelot wheel codes for harmonic mixing
+            'tasks': {
+                'Create table key_camelot': """
+                    CREATE TABLE IF NOT EXISTS key_camelot (
+                      key TEXT PRIMARY KEY,
+                      camelot TEXT NOT NULL
+                      ) WITHOUT ROWID; """,
+                'Fill table key_camelot': """
+                    INSERT OR REPLACE INTO key_camelot (key, camelot)
+                    VALUES {}; """.format(', '.join(["('{}', '{}')".format(k, c)
+                        for k, c in camelot_keys().items()])),
+                'Create table camelot_compat': """
+                    CREATE TABLE IF NOT EXISTS camelot_compat (
+                      camelot TEXT NOT NULL,
+                      compatible TEXT NOT NULL,
+                      relation TEXT,
+                      PRIMARY KEY (camelot, compatible)
+                      ) WITHOUT ROWID; """,
+                'Fill table camelot_compat': """
+                    INSERT OR REPLACE INTO camelot_compat (camelot, compatible,
+                      relation)
+                    VALUES {}; """.format(', '.join(["('{}', '{}', '{}')".format(
+                        code, compat, relation)
+                        for code in sorted(set(camelot_keys().values()))
+                        for compat, relation in camelot_neighbours(code).items()])),
+                'Add field track.chosen_camelot': 'ALTER TABLE track ADD chosen_camelot TEXT;',
+                # chosen_key is maintained by the triggers of schema version 5,
+                # normalizing the key is the same as utils.normalize_key does
+                'Create trigger track_camelot_update': """
+                    CREATE TRIGGER IF NOT EXISTS track_camelot_update
+                    AFTER UPDATE OF chosen_key, a_chords_key ON track BEGIN
+                      UPDATE track SET chosen_camelot = coalesce(
+                        (SELECT camelot FROM key_camelot WHERE key = lower(
+                          replace(replace(replace(trim(new.chosen_key),
+                          ' ', ''), '♯', '#'), '♭', 'b'))),
+                        (SELECT camelot FROM key_camelot WHERE key = lower(
+                          replace(replace(replace(trim(new.a_chords_key),
+                          ' ', ''), '♯', '#'), '♭', 'b'))))
+                      WHERE rowid = new.rowid;
+                    END; """,
+                'Fill field track.chosen_camelot': """
+                    UPDATE track SET chosen_camelot = coalesce(
+                      (SELECT camelot FROM key_camelot WHERE key = lower(
+                        replace(replace(replace(trim(chosen_key),
+                        ' ', ''), '♯', '#'), '♭', 'b'))),
+                      (SELECT camelot FROM key_camelot WHERE key = lower(
+                        replace(replace(replace(trim(a_chords_key),
+                        ' ', ''), '♯', '#'), '♭', 'b')))); """,
+                'Create index track_chosen_camelot_chosen_bpm': """
+                    CREATE INDEX IF NOT EXISTS track_chosen_camelot_chosen_bpm
+                    ON track (chosen_camelot, chosen_bpm); """,
+             }
+           },                      # list element 4 ends here
+           {'schema_version': 7,   # local index of the Discogs collection
+            'tasks': {             # (one row per collection item instance)
+                'Create table d_collection': """
+                    CREATE TABLE IF NOT EXISTS d_collection (
+                      instance_id INTEGER PRIMARY KEY,
+                      d_release_id INTEGER NOT NULL,
+                      folder_id INTEGER,
+                      date_added TEXT
+                      ); """,
+                'Create index d_collection_d_release_id': """
+                    CREATE INDEX IF NOT EXISTS d_collection_d_release_id
+                    ON d_collection (d_release_id); """,
+                # key/value store, eg. when d_collection was refreshed last
+                'Create table meta': """
+                    CREATE TABLE IF NOT EXISTS meta (
+                      key TEXT PRIMARY KEY,
+                      value TEXT
+                      ) WITHOUT ROWID; """,
+             }
+           },                      # list element 5 ends here
+           {
+            'schema_version': 8,   # checkpoints of long-running jobs
+            'tasks': {             # (imports, *Brainz matching)
+                'Create table job': """
+                    CREATE TABLE IF NOT EXISTS job (
+                      job_id INTEGER PRIMARY KEY,
+                      kind TEXT NOT NULL,
+                      params TEXT,
+                      started TEXT,
+                      finished TEXT
+                      ); """,
+                'Create index job_kind_finished': """
+                    CREATE INDEX IF NOT EXISTS job_kind_finished
+                    ON job (kind, finished); """,
+                # an item is a release ID or "release ID/track number"
+                'Create table job_item': """
+                    CREATE TABLE IF NOT EXISTS job_item (
+                      job_id INTEGER NOT NULL,
+                      item_key TEXT NOT NULL,
+                      done_time TEXT,
+                      PRIMARY KEY (job_id, item_key)
+                      ) WITHOUT ROWID; """,
+             }
+           },                      # list element 6 ends here
+           {
+            'schema_version': 9,   # select *Brainz update candidates quickly
+            'tasks': {             # (stale or missing AcousticBrainz data)
+                'Create index track_m_match_time': """
+                    CREATE INDEX IF NOT EXISTS track_m_match_time
+                    ON track (m_match_time); """,
+                'Create index track_accbr_missing': """
+                    CREATE INDEX IF NOT EXISTS track_accbr_missing
+                    ON track (d_release_id, d_track_no)
+                    WHERE m_rec_id IS NOT NULL AND a_bpm IS NULL; """,
+             }
+           },                      # list element 7 ends here
+           {
+            'schema_version': 10,  # failed *Brainz matches, retried
+            'tasks': {             # with exponential back-off
+                'Create table brainz_fail': """
+                    CREATE TABLE IF NOT EXISTS brainz_fail (
+                      d_release_id INTEGER NOT NULL,
+                      d_track_no TEXT NOT NULL,
+                      reason TEXT,
+                      detail INTEGER,
+                      d_fingerprint TEXT,
+                      fail_count INTEGER,
+                      last_fail TEXT,
+                      retry_after TEXT,
+                      PRIMARY KEY (d_release_id, d_track_no)
+                      ) WITHOUT ROWID; """,
+             }
+           }                       # list element 8 ends here
         ]                          # list closes here
 
     def create_tables(self): # initial db setup
@@ -146,10 +480,6 @@ class Db_setup(Database):
         log.debug('Db_setup: Latest DiscoBASE schema version: {}'.format(latest))
         return latest
 
-    def get_current_schema_version(self):
-        curr_vers_row = self._select('PRAGMA user_version', fetchone = True)
-        return int(curr_vers_row['user_version'])
-
     def upgrade_schema(self, force_upgrade = False):
         current_schema = self.get_current_schema_version()
         latest_schema = self.get_latest_schema_version()
@@ -163,6 +493,13 @@ class Db_setup(Database):
             for upgrade in self.sql_upgrades: # list is sorted -> execute all up to highest
                 current_schema = self.get_current_schema_version()
                 if (current_schema < upgrade['schema_version'] or force_upgrade == True):
+                    option = upgrade.get('compile_option')
+                    if option and not self.compileoption_used(option):
+                        msg_skip="Skipping schema version {}, SQLite was built without {}.".format(
+                            upgrade['schema_version'], option)
+                        log.warning(msg_skip)
+                        print(msg_skip)
+                        continue
                     for task, sql in upgrade['tasks'].items():
                         try:
                             self.execute_sql(sql, raise_err = True)
@@ -277,6 +614,22 @@ class Config():
             self.webdav_password = self._get_config_entry('webdav_password')
             self.webdav_url = self._get_config_entry('webdav_url')
 
+            # web cache: file, time-to-live per service (days), size (MB)
+            self.webcache_file = self.discodos_data / 'webcache.db'
+            self.webcache_ttls = {}
+            for service, default_ttl in [('discogs', 7), ('musicbrainz', 30),
+                                         ('acousticbrainz', 90)]:
+                ttl = self._get_config_entry('webcache_ttl_{}'.format(service))
+                self.webcache_ttls[service] = default_ttl if ttl == '' else ttl
+            self.webcache_max_size = self._get_config_entry('webcache_max_size')
+            if self.webcache_max_size == '':
+                self.webcache_max_size = 500
+
+            # *Brainz matching: re-match only tracks matched longer ago (days)
+            self.brainz_max_age = self._get_config_entry('brainz_max_age')
+            if self.brainz_max_age == '':
+                self.brainz_max_age = 0 # no limit, re-match everything
+
             # discogs_token is essential, bother user until we have one
             # but not when no_ask_token is set (macOS)
             self.discogs_token = self._get_config_entry('discogs_token', False)
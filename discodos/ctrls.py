@@ -1,6 +1,6 @@
-from discodos.utils import is_number, join_sep
+from discodos.utils import is_number, join_sep, camelot
 from discodos.config import Db_setup
-from discodos.models import Mix, Collection, Brainz, Brainz_match
+from discodos.models import Mix, Collection, Brainz, Brainz_match, Set_builder
 from discodos.views import Mix_view_cli, Collection_view_cli
 from abc import ABC, abstractmethod
 import logging
@@ -8,6 +8,9 @@ import discogs_client.exceptions as errors
 import pprint as p
 import re
 from time import time
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 
 log = logging.getLogger('discodos')
 
@@ -198,13 +201,9 @@ class Mix_ctrl_cli (Ctrl_common, Mix_ctrl_common):
 
     def delete_track(self, delete_track_pos):
         if self.cli.really_delete_track(delete_track_pos, self.mix.name):
-             successful = self.mix.delete_track(delete_track_pos)
-             # reorder existing and print tracklist
+             # following tracks move up in the same transaction
+             successful = self.mix.remove_track(delete_track_pos)
              if successful:
-                 if delete_track_pos == 1:
-                    self.mix.reorder_tracks(1)
-                 else:
-                    self.mix.reorder_tracks(delete_track_pos - 1)
                  self.view()
              else:
                  self.cli.p("Delete failed, maybe nonexistent track position?")
@@ -245,41 +244,17 @@ class Mix_ctrl_cli (Ctrl_common, Mix_ctrl_common):
             last_track = self.mix.get_last_track()
             log.debug("Currently last track in mix is: %s", last_track[0])
             current_id = False
-            if _pos:
-                # a position to squeeze in the track was given
-                # get current tracks >= pos
-                tracks_to_shift = self.mix.get_tracks_from_position(_pos)
-                if self.cli.really_add_track(track_to_add, _release_title,
-                                             self.mix.id, _pos):
-                    current_id = self.mix.add_track(_release_id,
-                                                    track_to_add, track_pos = _pos)
-                    # all good? reorder tracks
-                    if current_id:
-                        log.info("Add track to mix successful, now reordering ...")
-                        self.mix.reorder_tracks_squeeze_in(_pos, tracks_to_shift)
-                else:
-                    print("Track not added.")
-                    return True
-            elif is_number(last_track[0]):
-                # no position was given, tracks already mix
-                if self.cli.really_add_track(track_to_add, _release_title,
-                                             self.mix.id, last_track[0]+1):
-
-                    current_id = self.mix.add_track(_release_id,
-                                                    track_to_add, track_pos = last_track[0] + 1)
-                else:
-                    print("Track not added.")
-                    return True
+            # without a position the track is appended. Either way only the
+            # new mix_track row is written, later positions follow on reading.
+            if not _pos or _pos > last_track[0]:
+                _pos = last_track[0] + 1
+            if self.cli.really_add_track(track_to_add, _release_title,
+                                         self.mix.id, _pos):
+                current_id = self.mix.insert_track(_release_id,
+                                                   track_to_add, _pos)
             else:
-                # no position and it's the first track ever added
-                if self.cli.really_add_track(track_to_add, _release_title,
-                                             self.mix.id, 1):
-
-                    current_id = self.mix.add_track(_release_id,
-                                                    track_to_add, track_pos = 1)
-                else:
-                    print("Track not added.")
-                    return True
+                print("Track not added.")
+                return True
             # FIXME untested if this is actually a proper sanity check
             log.debug("Value of current_id in add_offline_track: {}".format(current_id))
             if current_id:
@@ -382,21 +357,27 @@ class Coll_ctrl_common (ABC):
 # Collection controller class
 class Coll_ctrl_cli (Ctrl_common, Coll_ctrl_common):
     '''manages the record collection, offline and with help of discogs data'''
+    import_workers = 4 # threads fetching from Discogs in import_collection
+    brainz_lookahead = 4 # tracks prefetched in update_tracks_from_brainz
+    db_commit_every = 250 # statements per commit in import/update loops
 
     def __init__(self, _db_conn, _user_int, _userToken, _appIdentifier,
-            _db_file = False, _musicbrainz_user = False, _musicbrainz_pass = False):
+            _db_file = False, _musicbrainz_user = False, _musicbrainz_pass = False,
+            _web_cache = False):
         self.user = _user_int # take an instance of the User_int class and set as attribute
         self.cli = Collection_view_cli() # instantiate cli frontend class 
-        self.collection = Collection(_db_conn, _db_file)
+        self.web_cache = _web_cache # Web_cache instance or False
+        self.collection = Collection(_db_conn, _db_file, self.web_cache)
         if self.collection.db_not_found == True:
             self.cli.ask('Setting up DiscoBASE, press enter...')
             super(Coll_ctrl_cli, self).setup_db(_db_file)
-            self.collection = Collection(_db_conn, _db_file)
+            self.collection = Collection(_db_conn, _db_file, self.web_cache)
         if self.user.WANTS_ONLINE:
             if not self.collection.discogs_connect(_userToken, _appIdentifier):
                 log.error("connecting to Discogs API, let's stay offline!\n")
             else: # only try to initialize brainz if discogs is online already
-                self.brainz = Brainz(_musicbrainz_user, _musicbrainz_pass, _appIdentifier)
+                self.brainz = Brainz(_musicbrainz_user, _musicbrainz_pass,
+                                     _appIdentifier, self.web_cache)
         log.info("CTRL: Initial ONLINE status is %s", self.ONLINE)
         self.first_track_on_release = ""
 
@@ -425,12 +406,14 @@ class Coll_ctrl_cli (Ctrl_common, Coll_ctrl_common):
                 if not self.add_release(int(_searchterm)):
                     log.warning("Release wasn't added to Collection, continuing anyway.")
 
-            db_releases = self.collection.get_all_db_releases()
+            if not self.collection.has_releases():
+                log.error("Discogs collection was not imported to DiscoBASE. Use 'disco import' command!")
+                raise SystemExit(1)
             self.cli.p('Searching Discogs for Release ID or Title: {}'.format(_searchterm))
             search_results = self.collection.search_release_online(_searchterm)
             # SEARCH RESULTS OUTPUT HAPPENS HERE
             compiled_results_list = self.print_and_return_first_d_release(
-                  search_results, _searchterm, db_releases)
+                  search_results, _searchterm)
             if compiled_results_list == None:
                 self.cli.error_not_the_release()
                 m = 'Try altering your search terms!'
@@ -464,7 +447,7 @@ class Coll_ctrl_cli (Ctrl_common, Coll_ctrl_common):
                 return [search_results[answ]]
                 #return num_search_results[answ][0]
 
-    def print_and_return_first_d_release(self, discogs_results, _searchterm, _db_releases):
+    def print_and_return_first_d_release(self, discogs_results, _searchterm):
         ''' formatted output _and return of Discogs release search results'''
         self.first_track_on_release = '' # reset this in any case first
         # only show pages count if it's a Release Title Search
@@ -472,10 +455,19 @@ class Coll_ctrl_cli (Ctrl_common, Coll_ctrl_common):
             self.cli.p("Found "+str(discogs_results.pages )+" page(s) of results!")
         else:
             self.cli.p("ID: "+discogs_results[0].id+", Title: "+discogs_results[0].title+"")
-        for result_item in discogs_results:
-            self.cli.p("Checking " + str(result_item.id))
-            for dbr in _db_releases:
-                if result_item.id == dbr['discogs_id']:
+        # look up which results are in the DiscoBASE a batch (a Discogs
+        # results page) at a time, via the release table's primary key
+        results = iter(discogs_results)
+        while True:
+            batch = list(islice(results, 50))
+            if not batch:
+                return None
+            db_releases = self.collection.get_db_releases_by_ids(
+                [result_item.id for result_item in batch])
+            for result_item in batch:
+                self.cli.p("Checking " + str(result_item.id))
+                dbr = db_releases.get(int(result_item.id))
+                if dbr:
                     self.cli.p("Good, first matching record in your collection is:")
                     release_details = self.collection.prepare_release_info(result_item)
                     tracklist = self.collection.prepare_tracklist_info(
@@ -485,17 +477,8 @@ class Coll_ctrl_cli (Ctrl_common, Coll_ctrl_common):
                     self.cli.tab_online_search_results([release_details])
                     self.cli.online_search_results_tracklist(tracklist)
                     self.first_track_on_release = result_item.tracklist[0].position
-                    break
-            try:
-                if result_item.id == dbr['discogs_id']:
-                    #return release_details[0]
                     log.info("Compiled Discogs release_details: {}".format(release_details))
                     return release_details
-            except UnboundLocalError:
-                log.error("Discogs collection was not imported to DiscoBASE. Use 'disco import' command!")
-                #raise unb
-                raise SystemExit(1)
-        return None
 
     def view_all_releases(self):
         self.cli.p("Showing all releases in DiscoBASE.")
@@ -516,20 +499,50 @@ class Coll_ctrl_cli (Ctrl_common, Coll_ctrl_common):
                 track_no = self.cli.ask_for_track()
                 rel_id = release[0]['discogs_id']
                 rel_name = release[0]['discogs_title']
-            track_occurences = self.collection.track_report_occurences(rel_id, track_no)
+            report_snippets = self.collection.track_report_snippets(rel_id, track_no)
             tr_sugg_msg = '\nTrack combo suggestions for {} on "{}".'.format(
                 track_no, rel_name)
             tr_sugg_msg+= '\nThis is how you used this track in the past:'
             self.cli.p(tr_sugg_msg)
-            if track_occurences:
-                for tr in track_occurences:
-                    self.cli.p('Snippet of Mix {} - "{}":'.format(
-                        tr['mix_id'], tr['name']))
-                    report_snippet = self.collection.track_report_snippet(tr['track_pos'], tr['mix_id'])
-                    self.cli.tab_mix_table(report_snippet, _verbose = True)
+            if report_snippets:
+                self.cli.tab_track_report(report_snippets)
         else:
             raise SystemExit(3)
 
+    def set_report(self, track_searchterm, length, drift = 3, total_drift = 8):
+        start_time = time()
+        if not self.collection.schema_at_least(6):
+            self.cli.p('Building a set needs an upgraded DiscoBASE. Run "disco setup".')
+            return False
+        release = self.search_release(track_searchterm)
+        if not release:
+            raise SystemExit(3)
+        if self.collection.ONLINE == True:
+            track_no = self.cli.ask_for_track(suggest=self.first_track_on_release)
+            rel_id = release['id']
+        else:
+            track_no = self.cli.ask_for_track()
+            rel_id = release[0]['discogs_id']
+        builder = Set_builder(self.collection.get_tracks_for_set_builder(),
+            self.collection.get_transition_ratings(), drift, total_drift)
+        proposed_set = builder.build((rel_id, track_no.upper()), length)
+        if not proposed_set:
+            self.cli.p('Track {} has no key or BPM in the DiscoBASE, '.format(track_no)
+                + "can't build a set. Try importing AcousticBrainz data.")
+            return False
+        self.cli.p('\nProposed set of {} tracks. BPM drift is max. {:g}% per '.format(
+            len(proposed_set), drift) + 'transition and {:g}% overall.'.format(total_drift))
+        max_width = self.cli.get_max_width([tr for tr, _ in proposed_set],
+          ['chosen_camelot', 'chosen_key', 'chosen_bpm'], 3)
+        for pos, (tr, relation) in enumerate(proposed_set, 1):
+            key_bpm_and_space = self.cli.combine_fields_to_width(tr,
+              ['chosen_camelot', 'chosen_key', 'chosen_bpm'], max_width)
+            self.cli.p('{:>2}. {}{} - {} [{} ({}) {}] ({})'.format(pos,
+              key_bpm_and_space, tr['d_artist'], tr['d_track_name'],
+              tr['d_catno'], tr['d_track_no'], tr['discogs_title'], relation))
+        self.cli.duration_stats(start_time, 'Building a set')
+        return proposed_set
+
     # ADD RELEASE TO COLLECTION
     def add_release(self, release_id):
         start_time = time()
@@ -555,6 +568,7 @@ class Coll_ctrl_cli (Ctrl_common, Coll_ctrl_common):
                     for folder in self.collection.me.collection_folders:
                         if folder.id == 1:
                             folder.add_release(release_id)
+                            self.collection.expire_d_collection_index()
                             last_row_id = self.collection.create_release(result.id,
                                     result.title, artists, d_catno, d_coll = True)
                     if not last_row_id:
@@ -582,26 +596,51 @@ class Coll_ctrl_cli (Ctrl_common, Coll_ctrl_common):
             raise SystemExit(3)
         else:
             self.cli.p("Release ID is valid: {}\n".format(result.title) +
-                  "Let's see if it's in your collection, this might take some time...")
-            in_coll = self.collection.is_in_d_coll(_release_id)
-            if in_coll:
-                artists = self.collection.d_artists_to_str(in_coll.release.artists)
-                d_catno = self.collection.d_get_first_catno(in_coll.release.labels)
+                  "Let's see if it's in your collection...")
+            if self.collection.is_in_d_coll(_release_id):
+                artists = self.collection.d_artists_to_str(result.artists)
+                d_catno = self.collection.d_get_first_catno(result.labels)
                 self.cli.p(
                   "Found it in collection: {} - {} - {}.\nImporting to DiscoBASE.".format(
-                  in_coll.release.id, artists, in_coll.release.title))
-                self.collection.create_release(in_coll.release.id, in_coll.release.title,
+                  result.id, artists, result.title))
+                self.collection.create_release(result.id, result.title,
                   artists, d_catno, d_coll = True)
             else:
                 self.cli.error_not_the_release()
         self.cli.duration_stats(start_time, 'Discogs import') # print time stats
 
-    def import_collection(self, tracks=False):
+    def _start_or_continue_job(self, kind, params, resume=False):
+        '''returns the ID of a checkpointed job and the set of its items that
+           are done already. With resume the last interrupted job of this
+           kind and params is continued. Jobs need DiscoBASE schema 8, with
+           older ones (None, empty set) is returned and nothing is recorded.'''
+        if not self.collection.schema_at_least(8):
+            if resume:
+                log.warning("Can't continue, DiscoBASE schema too old. Run disco setup.")
+            return None, set()
+        if resume:
+            job = self.collection.get_unfinished_job(kind, params)
+            if job:
+                done = self.collection.get_job_done_items(job['job_id'])
+                self.cli.p('Continuing {} job started {}: {} items are done already.'.format(
+                    kind, job['started'], len(done)))
+                return job['job_id'], done
+            self.cli.p('No interrupted {} job to continue, starting a new one.'.format(
+                kind))
+        return self.collection.start_job(kind, params), set()
+
+    def import_collection(self, tracks=False, incremental=False, resume=False):
+        '''incremental: only fetch releases that are new or were (re-)added
+           to the Discogs collection after they were imported last time, and
+           mark releases not in the Discogs collection anymore.
+           resume: continue an interrupted import, skipping releases it
+           already imported.'''
         start_time = time()
         self.cli.exit_if_offline(self.collection.ONLINE)
         self.releases_processed = 0
         self.releases_added = 0
         self.releases_db_errors = 0
+        self.releases_skipped = 0
         if tracks:
             self.cli.p("Importing Discogs collection into DiscoBASE (extended import - releases and tracks)")
             self.tracks_processed = 0
@@ -610,56 +649,65 @@ class Coll_ctrl_cli (Ctrl_common, Coll_ctrl_common):
             self.tracks_discogs_errors = 0
         else:
             self.cli.p("Importing Discogs collection into DiscoBASE (regular import - just releases)")
-
-        for item in self.collection.me.collection_folders[0].releases:
-            self.collection.rate_limit_slow_downer(remaining=15, sleep=3)
-            d_artists = item.release.artists # we'll need it again with tracks
-            artists = self.collection.d_artists_to_str(d_artists)
-            first_catno = self.collection.d_get_first_catno(item.release.labels)
-            print('Release {} - "{}" - "{}"'.format(item.release.id, artists,
-                  item.release.title))
-            rel_created = self.collection.create_release(item.release.id,
-                  item.release.title, artists, first_catno, d_coll = True)
-            # create_release will return False if unsuccessful
-            if rel_created:
-                self.releases_added += 1
-            else:
-                self.releases_db_errors += 1
-                log.error(
-                  'importing release "{}" Continuing anyway.'.format(
-                      item.release.title))
-            if tracks:
-                try:
-                    tracklist = item.release.tracklist
-                    for track in tracklist:
-                        tr_artists = self.collection.d_artists_parse(
-                          tracklist, track.position, d_artists)
-                        tr_title = track.title
-                        if self.collection.upsert_track(item.release.id,
-                              track.position, tr_title, tr_artists):
-                            self.tracks_added += 1
-                            msg_tr_add = 'Track "{}" - "{}"'.format(
-                                  tr_artists, tr_title)
-                            log.info(msg_tr_add)
-                            print(msg_tr_add)
-                        else:
-                            self.tracks_db_errors += 1
-                            log.error(
-                              'importing track. Continuing anyway.')
-                except Exception as Exc:
-                    self.tracks_discogs_errors += 1
-                    log.error("Exception: %s", Exc)
-
-            msg_rel_add="Releases so far: {}".format(self.releases_added)
-            log.info(msg_rel_add)
-            print(msg_rel_add)
-            if tracks:
-                msg_trk_add="Tracks so far: {}".format(self.tracks_added)
-                log.info(msg_trk_add)
-                print(msg_trk_add)
-            print() # leave space after a release and all its tracks
-            self.releases_processed += 1
-
+        if incremental:
+            self.cli.p("Incremental import: Only new or changed releases are fetched.")
+            import_state = self.collection.get_releases_import_state()
+        seen_ids = set() # releases in the Discogs collection listing
+        coll_items = [] # the whole listing refreshes the collection index
+        job_id, job_done = self._start_or_continue_job('import',
+            {'tracks': tracks, 'incremental': incremental}, resume)
+        releases_done_before = 0
+
+        def _import(rel): # write to DiscoBASE and checkpoint the release
+            self._import_release_data(rel, tracks)
+            if not rel.get('error'): # retry Discogs errors when continuing
+                self.collection.job_item_done(job_id,
+                    self.collection.job_item_key(rel['id']))
+
+        # Worker threads fetch release details (the lazy loading of
+        # discogs_client objects happens in there, throttled by the shared
+        # rate limiter), this thread is the only one writing to the DiscoBASE.
+        # Results are consumed in collection order, at most
+        # import_workers * 2 releases are in flight.
+        in_flight = deque()
+        coll_releases = self.collection.me.collection_folders[0].releases
+        coll_releases.per_page = 100 # max. allowed, saves listing requests
+        with ThreadPoolExecutor(max_workers = self.import_workers) as pool, \
+              self.collection.transaction(commit_every = self.db_commit_every):
+            for item in coll_releases:
+                coll_items.append(item)
+                if incremental:
+                    if item.release.id in seen_ids: # multiple instances
+                        continue
+                    seen_ids.add(item.release.id)
+                if self.collection.job_item_key(item.release.id) in job_done:
+                    releases_done_before += 1
+                    continue
+                if incremental:
+                    if not self.collection.release_needs_import(
+                          import_state.get(item.release.id), item.date_added,
+                          tracks):
+                        self.releases_skipped += 1
+                        continue
+                in_flight.append(pool.submit(
+                    self.collection.d_release_import_data, item.release, tracks))
+                if len(in_flight) >= self.import_workers * 2:
+                    _import(in_flight.popleft().result())
+            while in_flight:
+                _import(in_flight.popleft().result())
+
+        if self.collection.schema_at_least(7):
+            self.collection.replace_d_collection_index(coll_items)
+        if incremental: # we got through the whole listing, safe to do
+            removed = self.collection.set_releases_not_in_d_collection(seen_ids)
+            print('Unchanged releases (skipped): {}. Removed from Discogs collection: {}.'.format(
+                self.releases_skipped, removed))
+
+        if job_id:
+            self.collection.finish_job(job_id)
+        if releases_done_before:
+            print('Imported in the interrupted run already (skipped): {}.'.format(
+                releases_done_before))
         print('Processed releases: {}. Imported releases to DiscoBASE: {}.'.format(
             self.releases_processed, self.releases_added))
         print('Database errors (release import): {}.'.format(
@@ -673,6 +721,48 @@ class Coll_ctrl_cli (Ctrl_common, Coll_ctrl_common):
 
         self.cli.duration_stats(start_time, 'Discogs import') # print time stats
 
+    def _import_release_data(self, rel, tracks=False):
+        '''writes what Collection.d_release_import_data fetched to the
+           DiscoBASE and prints progress. Used by import_collection'''
+        print('Release {} - "{}" - "{}"'.format(rel['id'], rel['artists'],
+              rel['title']))
+        rel_created = self.collection.create_release(rel['id'],
+              rel['title'], rel['artists'], rel['catno'], d_coll = True)
+        # create_release will return False if unsuccessful
+        if rel_created:
+            self.releases_added += 1
+        else:
+            self.releases_db_errors += 1
+            log.error(
+              'importing release "{}" Continuing anyway.'.format(
+                  rel['title']))
+        if tracks:
+            if rel['error']:
+                self.tracks_discogs_errors += 1
+                log.error("Exception: %s", rel['error'])
+            self.tracks_processed += len(rel['tracks'])
+            if self.collection.upsert_tracks(rel['id'], rel['tracks']) is False:
+                self.tracks_db_errors += len(rel['tracks'])
+                log.error(
+                  'importing tracks. Continuing anyway.')
+            else:
+                self.tracks_added += len(rel['tracks'])
+                for tr_no, tr_title, tr_artists in rel['tracks']:
+                    msg_tr_add = 'Track "{}" - "{}"'.format(
+                          tr_artists, tr_title)
+                    log.info(msg_tr_add)
+                    print(msg_tr_add)
+
+        msg_rel_add="Releases so far: {}".format(self.releases_added)
+        log.info(msg_rel_add)
+        print(msg_rel_add)
+        if tracks:
+            msg_trk_add="Tracks so far: {}".format(self.tracks_added)
+            log.info(msg_trk_add)
+            print(msg_trk_add)
+        print() # leave space after a release and all its tracks
+        self.releases_processed += 1
+
     def bpm_report(self, bpm, pitch_range):
         possible_tracks = self.collection.get_tracks_by_bpm(bpm, pitch_range)
         tr_sugg_msg = '\nShowing tracks with a BPM around {}. Pitch range is +/- {}%.'.format(bpm, pitch_range)
@@ -688,7 +778,9 @@ class Coll_ctrl_cli (Ctrl_common, Coll_ctrl_common):
                      key_bpm_and_space, tr['d_artist'], tr['d_track_name'],
                       catno, tr['d_track_no'], tr['discogs_title']))
 
-    def key_report(self, key):
+    def key_report(self, key, harmonic = False):
+        if harmonic:
+            return self.harmonic_report(key)
         possible_tracks = self.collection.get_tracks_by_key(key)
         tr_sugg_msg = '\nShowing tracks with key {}'.format(key)
         self.cli.p(tr_sugg_msg)
@@ -704,7 +796,9 @@ class Coll_ctrl_cli (Ctrl_common, Coll_ctrl_common):
                   key_bpm_and_space, tr['d_artist'], tr['d_track_name'],
                   tr['d_catno'], tr['d_track_no'], tr['discogs_title']))
 
-    def key_and_bpm_report(self, key, bpm, pitch_range):
+    def key_and_bpm_report(self, key, bpm, pitch_range, harmonic = False):
+        if harmonic:
+            return self.harmonic_report(key, bpm, pitch_range)
         possible_tracks = self.collection.get_tracks_by_key_and_bpm(key, bpm, pitch_range)
         tr_sugg_msg = '\nShowing tracks with key "{}" and a BPM around {}. Pitch range is +/- {}%.'.format(key, bpm, pitch_range)
         self.cli.p(tr_sugg_msg)
@@ -718,6 +812,33 @@ class Coll_ctrl_cli (Ctrl_common, Coll_ctrl_common):
                   key_bpm_and_space, tr['d_artist'], tr['d_track_name'],
                   tr['d_catno'], tr['d_track_no'], tr['discogs_title']))
 
+    def harmonic_report(self, key, bpm = False, pitch_range = 6):
+        code = camelot(key)
+        if not code:
+            self.cli.p('Unknown key "{}". Try something like Am, F#m, Db or 8A.'.format(key))
+            return False
+        if not self.collection.schema_at_least(6):
+            self.cli.p('Harmonic suggestions need an upgraded DiscoBASE. Run "disco setup".')
+            return False
+        possible_tracks = self.collection.get_tracks_by_harmonic_key(
+            key, bpm, pitch_range)
+        tr_sugg_msg = '\nShowing tracks harmonically compatible with key {} ({})'.format(
+            key, code)
+        if bpm:
+            tr_sugg_msg += ' and a BPM around {}. Pitch range is +/- {}%.'.format(
+                bpm, pitch_range)
+        self.cli.p(tr_sugg_msg)
+        if possible_tracks:
+            max_width = self.cli.get_max_width(possible_tracks,
+              ['chosen_camelot', 'chosen_key', 'chosen_bpm'], 3)
+            for tr in possible_tracks:
+                key_bpm_and_space = self.cli.combine_fields_to_width(tr,
+                  ['chosen_camelot', 'chosen_key', 'chosen_bpm'], max_width)
+                self.cli.p('{}{} - {} [{} ({}) {}]:'.format(
+                  key_bpm_and_space, tr['d_artist'], tr['d_track_name'],
+                  tr['d_catno'], tr['d_track_no'], tr['discogs_title']))
+        return True
+
     def update_tracks_from_discogs(self, track_list, offset=0):
         '''takes a list of tracks and updates tracknames/artists from Discogs.
            List has to contain fields: d_release_id, discogs_title, d_track_no.
@@ -734,49 +855,63 @@ class Coll_ctrl_cli (Ctrl_common, Coll_ctrl_common):
         self.tracks_added = 0
         self.tracks_db_errors = 0
         self.tracks_not_found_errors = 0
-        for track in track_list:
-
-            d_track_no = track['d_track_no']
-            d_release_id = track['d_release_id']
-            discogs_title = track['discogs_title']
-            self.collection.rate_limit_slow_downer(remaining=20, sleep=3)
-
-            # move this to method fetch_track_and_artist_from_discogs
-            try: # we catch 404 here, and not via get_d_release, to save one request
-                name, artist = "", ""
-                d_tracklist = self.d.release(d_release_id).tracklist
-                name = self.collection.d_tracklist_parse(
-                      d_tracklist, d_track_no)
-                artist = self.collection.d_artists_parse(
-                      d_tracklist, d_track_no,
-                      self.d.release(d_release_id).artists)
-            except errors.HTTPError as HtErr:
-                log.error('Track {} on "{}" ({}) not existing on Discogs ({})'.format(
-                      d_track_no, discogs_title, d_release_id, HtErr))
-                self.cli.brainz_processed_so_far(self.processed, self.processed_total)
-                self.processed += 1
-                print("") # space for readability
-                continue # jump to next iteration, nothing more to do here
-
-            if name or artist:
-                print('Adding Track {} on "{}" ({})'.format(
-                      d_track_no, discogs_title, d_release_id))
-                print('{} - {}'.format(artist, name))
-                if self.collection.upsert_track(d_release_id,
-                      d_track_no, name, artist):
-                    self.tracks_added += 1
+        # Each release is fetched from Discogs once, all its tracks (also
+        # the ones showing up in several mixes) reuse tracklist and artists.
+        # The list is not regrouped by release, processing order has to stay
+        # as is for resuming at an offset.
+        d_releases = {}
+        # commit every db_commit_every tracks, not each one
+        with self.collection.transaction(commit_every = self.db_commit_every):
+            for track in track_list:
+
+                d_track_no = track['d_track_no']
+                d_release_id = track['d_release_id']
+                discogs_title = track['discogs_title']
+
+                # move this to method fetch_track_and_artist_from_discogs
+                try: # we catch 404 here, and not via get_d_release, to save one request
+                    name, artist = "", ""
+                    if d_release_id not in d_releases:
+                        try:
+                            d_release = self.d.release(d_release_id)
+                            d_releases[d_release_id] = (d_release.tracklist,
+                                                        d_release.artists)
+                        except errors.HTTPError as HtErr: # don't ask again
+                            d_releases[d_release_id] = HtErr
+                    if isinstance(d_releases[d_release_id], errors.HTTPError):
+                        raise d_releases[d_release_id]
+                    d_tracklist, d_artists = d_releases[d_release_id]
+                    name = self.collection.d_tracklist_parse(
+                          d_tracklist, d_track_no)
+                    artist = self.collection.d_artists_parse(
+                          d_tracklist, d_track_no, d_artists)
+                except errors.HTTPError as HtErr:
+                    log.error('Track {} on "{}" ({}) not existing on Discogs ({})'.format(
+                          d_track_no, discogs_title, d_release_id, HtErr))
+                    self.cli.brainz_processed_so_far(self.processed, self.processed_total)
+                    self.processed += 1
+                    print("") # space for readability
+                    continue # jump to next iteration, nothing more to do here
+
+                if name or artist:
+                    print('Adding Track {} on "{}" ({})'.format(
+                          d_track_no, discogs_title, d_release_id))
+                    print('{} - {}'.format(artist, name))
+                    if self.collection.upsert_track(d_release_id,
+                          d_track_no, name, artist):
+                        self.tracks_added += 1
+                    else:
+                        self.tracks_db_errors += 1
+                    self.cli.brainz_processed_so_far(self.processed, self.processed_total)
+                    self.processed += 1
+                    print("") # space for readability
                 else:
-                    self.tracks_db_errors += 1
-                self.cli.brainz_processed_so_far(self.processed, self.processed_total)
-                self.processed += 1
-                print("") # space for readability
-            else:
-                print('Either track or artist name not found on "{}" ({}) - Track {} really existing?'.format(
-                      discogs_title, d_release_id, d_track_no))
-                self.tracks_not_found_errors += 1
-                self.cli.brainz_processed_so_far(self.processed, self.processed_total)
-                self.processed += 1
-                print("") # space for readability
+                    print('Either track or artist name not found on "{}" ({}) - Track {} really existing?'.format(
+                          discogs_title, d_release_id, d_track_no))
+                    self.tracks_not_found_errors += 1
+                    self.cli.brainz_processed_so_far(self.processed, self.processed_total)
+                    self.processed += 1
+                    print("") # space for readability
 
         if offset:
             processed_real = self.processed_total - offset
@@ -811,7 +946,13 @@ class Coll_ctrl_cli (Ctrl_common, Coll_ctrl_common):
             }]
         return self.update_tracks_from_discogs(tr_list)
 
-    def update_tracks_from_brainz(self, track_list, detail=1, offset=0):
+    def update_tracks_from_brainz(self, track_list, detail=1, offset=0,
+          accbr_bulk=False, job_id=None):
+        '''accbr_bulk: don't ask AcousticBrainz per track but collect
+           Recording MBIDs and fetch them in bulk after all tracks are matched
+           job_id: checkpoint each track once its MusicBrainz match is saved.
+           Bulk lookups cut short are redone when the job is continued, see
+           update_all_tracks_from_brainz.'''
         # catch errors. this is a last resort check. prettier err-msgs earlier!
         if track_list == [None] or track_list == [] or track_list == None:
             log.error("Didn't get sufficient data for *Brainz update. Quitting.")
@@ -829,17 +970,27 @@ class Coll_ctrl_cli (Ctrl_common, Coll_ctrl_common):
         errors_no_rec_MB, errors_no_rec_AB, errors_not_imported = 0, 0, 0
         added_release, added_rec, added_key, added_chords_key, added_bpm = 0, 0, 0, 0, 0
         warns_discogs_fetches = 0
-        for track in track_list:
+        accbr_pending = [] # (rec_mbid, discogs_id, d_track_no), for accbr_bulk
+        accbr_refresh = set() # rec_mbids of retried tracks, not from the cache
+        record_fails = self.collection.schema_at_least(10)
+
+        def _brainz_fail(rel_id, track_no, reason): # retried after back-off
+            if record_fails and track_no:
+                self.collection.record_brainz_fail(rel_id, track_no, reason,
+                    detail)
+        for track, d_rel in self._brainz_prefetch(track_list, detail):
             release_mbid, rec_mbid = None, None # we are filling these
             key, chords_key, bpm = None, None, None # searched later, in this order
             #d_release_id = track['d_release_id'] # from track table
             discogs_id = track['discogs_id'] # from release table
             d_track_no = track['d_track_no']
+            job_item_key = self.collection.job_item_key(discogs_id, d_track_no)
             user_rec_mbid = track['m_rec_id_override']
+            # failed before: the web cache would only repeat that answer
+            retry = self._brainz_retry(track)
 
             log.info('CTRL: Trying to match Discogs release {} "{}"...'.format(
                 discogs_id, track['discogs_title']))
-            d_rel = self.collection.get_d_release(discogs_id) # 404 is handled here
 
             def _warn_skipped(m): # prints skipped-message and processed-count
                 log.warning(m)
@@ -859,6 +1010,7 @@ class Coll_ctrl_cli (Ctrl_common, Coll_ctrl_common):
                     m+= f'Did you import Track details from Discogs yet? (-u)'
                     _warn_skipped(m)
                     errors_not_imported += 1
+                    self.collection.job_item_done(job_id, job_item_key)
                     processed += 1
                     continue # jump to next track
                 elif not track['d_track_name']: # no track name in db -> ask discogs
@@ -872,6 +1024,7 @@ class Coll_ctrl_cli (Ctrl_common, Coll_ctrl_common):
                         m+= f'not existing on release "{track["discogs_title"]}"'
                         _warn_skipped(m)
                         errors_not_found += 1
+                        self.collection.job_item_done(job_id, job_item_key)
                         processed += 1
                         continue # jump to next track
                     print(f'Track name found on Discogs: "{d_track_name}"')
@@ -910,13 +1063,14 @@ class Coll_ctrl_cli (Ctrl_common, Coll_ctrl_common):
                                   self.brainz.musicbrainz_appid,
               discogs_id, track['discogs_title'], d_catno,
               d_artist, d_track_name, d_track_no,
-              d_track_numerical)
+              d_track_numerical, web_cache = self.web_cache, refresh = retry)
             # fetching of mb_releases controllable from outside
             # (reruns with different settings)
             bmatch.fetch_mb_releases(detail = detail)
             release_mbid = bmatch.match_release()
             if not release_mbid and not user_rec_mbid:
                 log.info('CTRL: No MusicBrainz release matches. Sorry dude!')
+                _brainz_fail(discogs_id, d_track_no, 'no_release')
             else: # Recording MBID search
                 if user_rec_mbid:
                     rec_mbid = user_rec_mbid
@@ -924,18 +1078,28 @@ class Coll_ctrl_cli (Ctrl_common, Coll_ctrl_common):
                     bmatch.fetch_mb_matched_rel()
                     rec_mbid = bmatch.match_recording()
 
-                if rec_mbid: # we where lucky...
-                    # get accousticbrainz info
-                    key = bmatch.get_accbr_key(rec_mbid)
-                    if key is not None: # Skip if Rec MBID not on AcBr yet
-                        chords_key = bmatch.get_accbr_chords_key(rec_mbid)
-                        bpm = bmatch.get_accbr_bpm(rec_mbid)
-                    else:
-                        chords_key = None
-                        bpm = None
+                if rec_mbid and accbr_bulk: # fetched later, all at once
+                    accbr_pending.append((rec_mbid, discogs_id, d_track_no))
+                    if retry:
+                        accbr_refresh.add(rec_mbid)
+                elif rec_mbid: # we where lucky...
+                    # get accousticbrainz info, one request for all features
+                    features = bmatch.get_accbr_features(rec_mbid)
+                    if features and features['key'] is not None:
+                        key = features['key']
+                        chords_key = features['chords_key']
+                        bpm = features['bpm']
+                        if record_fails:
+                            self.collection.clear_brainz_fail(discogs_id,
+                                d_track_no)
+                    else: # Skip if Rec MBID not on AcBr yet
                         errors_no_rec_AB += 1
+                        _brainz_fail(discogs_id, d_track_no, 'no_accbr')
                 else:
                     errors_no_rec_MB += 1
+                    _brainz_fail(discogs_id, d_track_no, 'no_recording')
+            log.info('CTRL: MusicBrainz releases fetched: {}, reused: {}'.format(
+                bmatch.mb_full_releases_misses, bmatch.mb_full_releases_hits))
             # user reporting starts here, not in model anymore
             # summary and save only when we have Release MBID or user_rec_mbid
             if release_mbid or user_rec_mbid:
@@ -956,12 +1120,21 @@ class Coll_ctrl_cli (Ctrl_common, Coll_ctrl_common):
                     else:
                         print("Recording MBID: {}".format(rec_mbid))
 
-                print("Key: {}, Chords Key: {}, BPM: {}".format(
-                    key, chords_key, bpm))
-
-                # update release table
-                ok_release = self.collection.update_release_brainz(discogs_id,
-                    release_mbid, bmatch.release_match_method)
+                if rec_mbid and accbr_bulk:
+                    print("Key, Chords Key, BPM: queued for AcousticBrainz bulk lookup")
+                else:
+                    print("Key: {}, Chords Key: {}, BPM: {}".format(
+                        key, chords_key, bpm))
+
+                # update release, track and track_ext table, one commit
+                with self.collection.transaction():
+                    ok_release = self.collection.update_release_brainz(discogs_id,
+                        release_mbid, bmatch.release_match_method)
+                    # AcousticBrainz fields of bulk lookups are written later
+                    ok_rec = self.collection.upsert_track_brainz(discogs_id,
+                        track['d_track_no'], rec_mbid, bmatch.rec_match_method,
+                        key, chords_key, bpm,
+                        accbr = not (rec_mbid and accbr_bulk))
                 if ok_release:
                     print('Release table updated successfully.')
                     log.info('Release table updated successfully.')
@@ -970,10 +1143,6 @@ class Coll_ctrl_cli (Ctrl_common, Coll_ctrl_common):
                     log.error('while updating release table. Continuing anyway.')
                     errors_db += 1
 
-                # update track and track_ext table
-                ok_rec = self.collection.upsert_track_brainz(discogs_id,
-                    track['d_track_no'], rec_mbid, bmatch.rec_match_method,
-                    key, chords_key, bpm)
 
                 if ok_rec:
                     if rec_mbid: added_rec += 1
@@ -990,10 +1159,20 @@ class Coll_ctrl_cli (Ctrl_common, Coll_ctrl_common):
                 errors_no_release += 1
                 log.warning('No Release MBID found for track {} on Discogs release "{}"'.format(
                         track['d_track_no'], track['discogs_title']))
+            self.collection.job_item_done(job_id, job_item_key)
             self.cli.brainz_processed_so_far(processed, processed_total)
             processed += 1
             print('') # space for readability
 
+        if accbr_pending:
+            accbr_stats = self._update_tracks_accbr_bulk(accbr_pending,
+                detail=detail, refresh=accbr_refresh)
+            added_key += accbr_stats['key']
+            added_chords_key += accbr_stats['chords_key']
+            added_bpm += accbr_stats['bpm']
+            errors_no_rec_AB += accbr_stats['not_found']
+            errors_db += accbr_stats['db_errors']
+
         if offset:
             processed_real = processed_total - offset
         else:
@@ -1005,16 +1184,205 @@ class Coll_ctrl_cli (Ctrl_common, Coll_ctrl_common):
         self.cli.duration_stats(start_time, 'Updating track info') # print time stats
         return True # we are through all tracks, in any way, this is a success
 
-    def update_all_tracks_from_brainz(self, detail=1, offset=0):
+    def _brainz_retry(self, track):
+        '''True if the track failed to match before and is due a retry
+           (see get_all_tracks_for_brainz_update)'''
+        return 'brainz_fails' in track.keys() and bool(track['brainz_fails'])
+
+    def _brainz_prefetch(self, track_list, detail):
+        '''yields (track, Discogs release) for each track. Worker threads
+           fetch the Discogs releases of the next tracks meanwhile. If the
+           web cache can keep the answers, another thread asks MusicBrainz
+           for their release search and first candidate at low priority, so
+           the rate limited MusicBrainz queue doesn't idle while a track is
+           matched. Nobody waits for that, it's cancelled once a track's turn
+           has come.'''
+        mb_prefetch = (self.web_cache and self.web_cache.enabled('musicbrainz')
+                       and not self.web_cache.cache_only)
+
+        def _fetch(track): # in a worker thread, no DiscoBASE access here!
+            return self.collection.get_d_release(track['discogs_id']) # 404 is handled here
+
+        def _prefetch_mb(track): # in the prefetch thread, no DiscoBASE access here!
+            try: # search data as in update_tracks_from_brainz
+                Brainz_match(self.brainz.musicbrainz_user,
+                    self.brainz.musicbrainz_password,
+                    self.brainz.musicbrainz_appid, track['discogs_id'],
+                    track['discogs_title'], track['d_catno'],
+                    track['d_artist'], track['d_track_name'],
+                    track['d_track_no'], 0, # track no. not needed for fetching
+                    web_cache = self.web_cache).prefetch(detail)
+            except Exception as exc: # matching will try again anyway
+                log.debug("CTRL: MusicBrainz prefetch failed: %s", exc)
+
+        def _prefetchable(track):
+            # without DiscoBASE data the match searches with what Discogs
+            # returns, retries skip the web cache: the prefetch wouldn't hit
+            return (mb_prefetch and track['d_track_no'] and track['d_track_name']
+                    and track['d_catno'] and track['d_artist']
+                    and not self._brainz_retry(track))
+
+        in_flight = {} # discogs_id -> Future of _fetch
+        prefetching = {} # discogs_id -> Future of _prefetch_mb
+        mb_pool = ThreadPoolExecutor(max_workers = 1) # MusicBrainz is serial anyway
+        try:
+            with ThreadPoolExecutor(max_workers = self.brainz_lookahead) as pool:
+                def _submit(i):
+                    if i < len(track_list):
+                        rel_id = track_list[i]['discogs_id']
+                        if rel_id not in in_flight:
+                            in_flight[rel_id] = pool.submit(_fetch, track_list[i])
+                            if _prefetchable(track_list[i]):
+                                prefetching[rel_id] = mb_pool.submit(
+                                    _prefetch_mb, track_list[i])
+                for i in range(self.brainz_lookahead):
+                    _submit(i)
+                for i, track in enumerate(track_list):
+                    _submit(i + self.brainz_lookahead)
+                    _submit(i) # its release was dropped already (unsorted list)
+                    prefetch = prefetching.pop(track['discogs_id'], None)
+                    if prefetch: # matching asks at full priority now
+                        prefetch.cancel()
+                    d_rel = in_flight[track['discogs_id']].result()
+                    yield track, d_rel
+                    next_track = i + 1 < len(track_list) and track_list[i + 1]
+                    if not next_track or next_track['discogs_id'] != track['discogs_id']:
+                        del in_flight[track['discogs_id']]
+        finally:
+            for prefetch in prefetching.values():
+                prefetch.cancel()
+            mb_pool.shutdown(wait = False)
+
+    def update_all_tracks_from_brainz(self, detail=1, offset=0, resume=False,
+          max_age=0, missing_only=False):
+        '''resume: continue an interrupted run, skipping tracks it
+           matched already
+           max_age: skip tracks matched less than max_age days ago
+           missing_only: don't match again, only fetch AcousticBrainz data
+           of tracks that have a Recording MBID already'''
         if not self.ONLINE:
             self.cli.p("Not online, can't pull from AcousticBrainz...")
             return False # exit method we are offline
+        if missing_only:
+            return self._update_tracks_accbr_missing(offset, max_age, detail)
+        job_id, job_done = self._start_or_continue_job('brainz',
+            {'detail': detail, 'max_age': max_age}, resume)
+        skip_failed = self.collection.schema_at_least(10)
+        if job_done: # matched before the interruption, bulk lookup pending?
+            accbr_pending = [(track['m_rec_id_override'] or track['m_rec_id'],
+                track['discogs_id'], track['d_track_no']) for track in
+                self.collection.get_all_tracks_for_brainz_update(missing_only=True)
+                if self.collection.job_item_key(track['discogs_id'],
+                    track['d_track_no']) in job_done]
+            if accbr_pending:
+                self.cli.p('Tracks of the interrupted run missing AcousticBrainz data: {}'.format(
+                    len(accbr_pending)))
+                self._update_tracks_accbr_bulk(accbr_pending,
+                    detail=detail if skip_failed else 0)
         tracks = self.collection.get_all_tracks_for_brainz_update(
-              offset=offset)
+              offset=offset, max_age=max_age,
+              detail=detail if skip_failed else 0)
+        if max_age:
+            self.cli.p('Tracks not matched within the last {} days: {}'.format(
+                max_age, len(tracks)))
+        if skip_failed:
+            backed_off = self.collection.count_brainz_fails_backed_off(detail)
+            if backed_off:
+                self.cli.p('{} tracks failed to match recently, they are retried later.'.format(
+                    backed_off))
+        if not tracks:
+            self.cli.p('No tracks need a *Brainz update.')
+            if job_id:
+                self.collection.finish_job(job_id)
+            return True
+        if job_done:
+            tracks = [track for track in tracks
+                if self.collection.job_item_key(track['discogs_id'],
+                    track['d_track_no']) not in job_done]
+            if not tracks:
+                self.cli.p('All tracks were matched in the interrupted run already.')
+                self.collection.finish_job(job_id)
+                return True
         match_ret = self.update_tracks_from_brainz(tracks, detail,
-              offset=offset)
+              offset=offset, accbr_bulk=True, job_id=job_id)
+        if match_ret and job_id:
+            self.collection.finish_job(job_id)
         return match_ret
 
+    def _update_tracks_accbr_missing(self, offset=0, max_age=0, detail=1):
+        '''fetches AcousticBrainz data of all tracks that have a
+           Recording MBID but no AcousticBrainz data yet, MusicBrainz is not
+           asked at all. Tracks not found are backed off like failed matches
+           of the given detail level.'''
+        start_time = time()
+        if not self.collection.schema_at_least(10):
+            detail = 0 # no brainz_fail table to record or skip failures
+        tracks = self.collection.get_all_tracks_for_brainz_update(
+              offset=offset, max_age=max_age, missing_only=True, detail=detail)
+        self.cli.p('Tracks with Recording MBID but missing AcousticBrainz data: {}'.format(
+            len(tracks)))
+        if not tracks:
+            return True
+        stats = self._update_tracks_accbr_bulk([(
+            track['m_rec_id_override'] or track['m_rec_id'],
+            track['discogs_id'], track['d_track_no']) for track in tracks],
+            detail=detail, refresh={
+                track['m_rec_id_override'] or track['m_rec_id']
+                for track in tracks if self._brainz_retry(track)})
+        self.cli.brainz_processed_report(len(tracks), 0, 0, stats['key'],
+          stats['chords_key'], stats['bpm'], stats['db_errors'], 0,
+          stats['not_found'], 0, 0)
+        self.cli.duration_stats(start_time, 'Updating track info')
+        return True
+
+    def _update_tracks_accbr_bulk(self, accbr_pending, detail=0, refresh=()):
+        '''fetches AcousticBrainz features for a list of
+           (rec_mbid, discogs_id, d_track_no) tuples using bulk requests and
+           writes them to the track table in a single transaction.
+           detail: record tracks not found as failed matches of this
+           detail level
+           refresh: rec_mbids to ask AcousticBrainz for again, not the cache'''
+        stats = {'key': 0, 'chords_key': 0, 'bpm': 0, 'not_found': 0,
+                 'db_errors': 0}
+        rec_mbids = [pending[0] for pending in accbr_pending]
+        print('Fetching key and BPM of {} recordings from AcousticBrainz...'.format(
+            len(set(rec_mbids))))
+        features_by_rec = self.brainz.get_accbr_features_bulk(
+            [rec_mbid for rec_mbid in rec_mbids if rec_mbid not in refresh])
+        features_by_rec.update(self.brainz.get_accbr_features_bulk(
+            [rec_mbid for rec_mbid in rec_mbids if rec_mbid in refresh],
+            refresh = True))
+        accbr_rows, not_found = [], []
+        for rec_mbid, discogs_id, d_track_no in accbr_pending:
+            features = features_by_rec.get(rec_mbid)
+            if not features or features['key'] is None:
+                stats['not_found'] += 1 # Rec MBID not on AcBr yet
+                not_found.append((discogs_id, d_track_no))
+                continue
+            accbr_rows.append((features['key'], features['chords_key'],
+                               features['bpm'], discogs_id, d_track_no))
+            if features['key']: stats['key'] += 1
+            if features['chords_key']: stats['chords_key'] += 1
+            if features['bpm']: stats['bpm'] += 1
+        if accbr_rows:
+            if self.collection.update_tracks_accbr(accbr_rows) is False:
+                log.error('while saving AcousticBrainz data to track table.')
+                stats['db_errors'] += len(accbr_rows)
+                stats['key'], stats['chords_key'], stats['bpm'] = 0, 0, 0
+            else:
+                print('Track table updated with {} AcousticBrainz results.'.format(
+                    len(accbr_rows)))
+        if self.collection.schema_at_least(10):
+            with self.collection.transaction():
+                if not stats['db_errors']:
+                    for _key, _chords_key, _bpm, rel_id, track_no in accbr_rows:
+                        self.collection.clear_brainz_fail(rel_id, track_no)
+                if detail:
+                    for rel_id, track_no in not_found:
+                        self.collection.record_brainz_fail(rel_id, track_no,
+                            'no_accbr', detail)
+        return stats
+
     def update_single_track_or_release_from_brainz(self, rel_id, rel_title, track_no,
           detail):
         def _err_cant_fetch(tr_no):
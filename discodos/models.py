@@ -1,4 +1,4 @@
-from discodos.utils import is_number # most of this should only be in view
+from discodos.utils import is_number, camelot, camelot_neighbours # most of this should only be in view
 from abc import ABC, abstractmethod
 import logging
 import pprint
@@ -9,6 +9,14 @@ import urllib3.exceptions
 from sqlite3 import Error as sqlerr
 import sqlite3
 import time
+import threading
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+from bisect import bisect_left, bisect_right
+import heapq
+import itertools
+import queue
+from concurrent.futures import Future
 from datetime import datetime
 import musicbrainzngs as m
 from musicbrainzngs import WebServiceError
@@ -19,9 +27,21 @@ from socket import gethostbyname, gaierror
 
 log = logging.getLogger('discodos')
 
+class _Edit_failed (sqlerr):
+    '''raised inside Database.transaction() to roll back an edit that
+       couldn't be finished'''
+
+
 class Database (object):
+    # UPSERT needs 3.24, window functions 3.25 and the WINDOW clause 3.28
+    sqlite_min_version = (3, 28, 0)
 
     def __init__(self, db_conn=False, db_file=False, setup=False):
+        if sqlite3.sqlite_version_info < self.sqlite_min_version:
+            log.error("DB-NEW: SQLite %s is too old, DiscoDOS needs %s or newer. "
+                      "See INSTALLATION.md.", sqlite3.sqlite_version,
+                      '.'.join(str(v) for v in self.sqlite_min_version))
+            raise SystemExit(4) # 4 = other db error
         self.db_not_found = False
         if db_conn:
             log.debug("DB-NEW: db_conn argument was handed over.")
@@ -37,14 +57,20 @@ class Database (object):
                 self.db_conn = self.create_conn(db_file, setup=True)
         self.db_conn.row_factory = sqlite3.Row # also this was in each db.function before
         self.cur = self.db_conn.cursor() # we had this in each db function before
+        self.in_transaction = 0 # nesting level of transaction()
+        self.commit_every = 0
+        self.uncommitted = 0 # statements run since last commit in transaction
         self.configure_db() # set PRAGMA options
 
     def create_conn(self, db_file, setup=False):
         try:  # format ensures db_file is string. uri rw mode throws error if non-existen
+            # cached_statements: prepared statements reused by SQL string
             if setup:
-                conn = sqlite3.connect('file:{}'.format(db_file), uri=True)
+                conn = sqlite3.connect('file:{}'.format(db_file), uri=True,
+                                       cached_statements=256)
             else:
-                conn = sqlite3.connect('file:{}?mode=rw'.format(db_file), uri=True)
+                conn = sqlite3.connect('file:{}?mode=rw'.format(db_file), uri=True,
+                                       cached_statements=256)
             return conn
         except sqlerr as e:
             if e.args[0] == 'unable to open database file':
@@ -56,11 +82,67 @@ class Database (object):
                 log.error("DB-NEW: Connection error: %s", e)
                 raise SystemExit(4) # 4 = other db error. will SystemExit break gui?
 
+    @contextmanager
+    def transaction(self, commit_every = 0):
+        '''groups statements into one transaction: execute_sql and
+           execute_many don't commit on their own inside this context.
+           commit_every > 0 commits each time that many statements ran.
+           Everything left is committed on exit, also when the block is left
+           by an exception (eg. ctrl-c), as done work should be kept for
+           resuming. Only database errors roll back. Nested transactions
+           are merged into the outermost, each nested level is a SAVEPOINT
+           though: a database error rolls back that level only.'''
+        self.in_transaction += 1
+        savepoint = None
+        if self.in_transaction == 1:
+            self.commit_every = commit_every
+            self.uncommitted = 0
+        else:
+            if not self.db_conn.in_transaction: # a SAVEPOINT would commit on RELEASE
+                self.db_conn.execute('BEGIN')
+            savepoint = 'nested_{}'.format(self.in_transaction)
+            self.db_conn.execute('SAVEPOINT {}'.format(savepoint))
+        try:
+            yield self
+        except sqlerr:
+            if savepoint and self.db_conn.in_transaction:
+                log.info("DB-NEW: Rolling back nested transaction.")
+                self.db_conn.execute('ROLLBACK TO {}'.format(savepoint))
+            elif self.in_transaction == 1:
+                log.info("DB-NEW: Rolling back transaction.")
+                self.db_conn.rollback()
+            raise
+        finally:
+            if savepoint and self.db_conn.in_transaction:
+                self.db_conn.execute('RELEASE {}'.format(savepoint))
+            self.in_transaction -= 1
+            if self.in_transaction == 0 and self.db_conn.in_transaction:
+                log.info("DB-NEW: Committing transaction ({} statements).".format(
+                    self.uncommitted))
+                self.db_conn.commit()
+
+    def _autocommit(self):
+        '''outside transaction() statements commit themselves, inside
+           we only count them and commit every self.commit_every'''
+        if not self.in_transaction:
+            return self.db_conn # auto commits and auto rolls back on exceptions
+        return nullcontext()
+
+    def _statement_done(self):
+        if self.in_transaction:
+            self.uncommitted += 1
+            # committing would end the SAVEPOINTs of nested transactions
+            if (self.commit_every and self.uncommitted >= self.commit_every
+                    and self.in_transaction == 1):
+                log.info("DB-NEW: Committing {} statements.".format(self.uncommitted))
+                self.db_conn.commit()
+                self.uncommitted = 0
+
     def execute_sql(self, sql, values_tuple = False, raise_err = False):
         '''used for eg. creating tables or inserts'''
         log.info("DB-NEW: execute_sql: %s", sql)
         try:
-            with self.db_conn: # auto commits and auto rolls back on exceptions
+            with self._autocommit():
                 c = self.cur  # connection close has to be done manually though!
                 if values_tuple:
                     log.info("DB-NEW: ...with this tuple: {%s}", values_tuple)
@@ -73,7 +155,9 @@ class Database (object):
                 #self.db_conn.commit()
             log.info("DB-NEW: Committing via context close NOW")
             self.lastrowid = c.lastrowid
-            return c.rowcount
+            rowcount = c.rowcount
+            self._statement_done()
+            return rowcount
         except sqlerr as e:
             #log.error("DB-NEW: %s", dir(e))
             if raise_err:
@@ -83,22 +167,56 @@ class Database (object):
                 log.error("DB-NEW: %s", e.args[0])
             return False
 
+    def execute_many(self, sql, values_list, raise_err = False):
+        '''executes one statement for a list of value tuples in a single
+           transaction (sqlite3 executemany). Returns total rowcount.
+           Inside transaction() each value tuple counts as a statement.'''
+        log.info("DB-NEW: execute_many: %s", sql)
+        log.info("DB-NEW: ...with %s value tuples", len(values_list))
+        try:
+            with self._autocommit():
+                c = self.cur
+                c.executemany(sql, values_list)
+                log.info("DB-NEW: rowcount: {}".format(c.rowcount))
+            log.info("DB-NEW: Committing via context close NOW")
+            rowcount = c.rowcount
+            if self.in_transaction: # each value tuple counts
+                self.uncommitted += len(values_list) - 1
+            self._statement_done()
+            return rowcount
+        except sqlerr as e:
+            if raise_err:
+                log.info("DB-NEW: Raising error to upper level.")
+                raise e
+            else:
+                log.error("DB-NEW: %s", e.args[0])
+            return False
+
     def configure_db(self):
         settings = "PRAGMA foreign_keys = ON;"
         self.execute_sql(settings)
 
     def _select_simple(self, fields_list, table, condition=False,
-      fetchone=False, orderby=False, distinct=False, offset=0):
+      fetchone=False, orderby=False, distinct=False, offset=0, params=()):
         """This is a wrapper around the _select method.
-           It puts together sql select statements as strings.
+           It puts together sql select statements as strings. Values should
+           not be part of condition but passed as params and referenced
+           with ? placeholders, this way the SQL string is the same for each
+           call and sqlite3 can reuse its prepared statement.
         """
         log.info("DB-NEW: _select_simple: fetchone = {}".format(fetchone))
-        fields_str = ""
-        for cnt,field in enumerate(fields_list):
-            if cnt == 0:
-                fields_str += field
-            else:
-                fields_str += ", {}".format(field)
+        select_str = self._select_simple_sql(tuple(fields_list), table,
+            condition, orderby, distinct, bool(offset))
+        if offset:
+            params = tuple(params) + (offset, )
+        return self._select(select_str, fetchone, params)
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def _select_simple_sql(fields, table, condition, orderby, distinct, offset):
+        '''builds the SQL string for _select_simple, cached since the same
+           statements are built over and over again in loops'''
+        fields_str = ", ".join(fields)
         if condition:
             where_or_not = "WHERE {}".format(condition)
         else:
@@ -112,20 +230,19 @@ class Database (object):
         else:
             select = 'SELECT'
         if offset:
-            limit = 'LIMIT -1 OFFSET {}'.format(offset)
+            limit = 'LIMIT -1 OFFSET ?'
         else:
             limit = ''
-        select_str = "{} {} FROM {} {} {} {};".format(select, fields_str, table,
+        return "{} {} FROM {} {} {} {};".format(select, fields_str, table,
           where_or_not, orderby_or_not, limit)
-        return self._select(select_str, fetchone)
 
-    def _select(self, sql_select, fetchone = False):
+    def _select(self, sql_select, fetchone = False, params = ()):
         """Executes sql selects in two possible ways: fetchone or fetchall
-           It's completely string based and not aware of tuple based
-           values substitution in sqlite3 cursor objects.
+           Values are bound to ? placeholders in sql_select via params.
 
         @param sql_select (string): the complete sql select statement
         @param fetchone (bool): defaults to False (return multiple rows)
+        @param params (tuple): values for the ? placeholders in sql_select
         @return (type is depending on running mode)
             fetchone = True:
                 something found: sqlite3.Row (dict-like) object
@@ -135,7 +252,9 @@ class Database (object):
                 nothing found: an empty list
         """
         log.info("DB-NEW: _select: {}".format(sql_select))
-        self.cur.execute(sql_select)
+        if params:
+            log.info("DB-NEW: ...with this tuple: {%s}", params)
+        self.cur.execute(sql_select, params)
         if fetchone:
             rows = self.cur.fetchone()
         else:
@@ -155,6 +274,15 @@ class Database (object):
             log.info('DB-NEW: Nothing found - Returning type: {}.'.format(type(rows).__name__))
             return rows # was empty list before, now it's either empty list or NoneType
 
+    def get_current_schema_version(self):
+        curr_vers_row = self._select('PRAGMA user_version', fetchone = True)
+        return int(curr_vers_row['user_version'])
+
+    def compileoption_used(self, option):
+        '''checks if SQLite was built with a compile-time option, eg. ENABLE_FTS5'''
+        return bool(self._select('SELECT sqlite_compileoption_used(?)',
+                                 fetchone = True, params = (option, ))[0])
+
     def close_conn(self): # manually close conn! - context manager (with) doesn't do it
         self.db_conn.close()
 
@@ -170,8 +298,313 @@ class Database (object):
             print()
         return True
 
+class Web_cache (Database):
+    '''A persistent HTTP response cache shared by the Discogs, MusicBrainz
+       and AcousticBrainz clients. Responses are kept in their own SQLite
+       file (not the DiscoBASE), have a per-service time-to-live (in days,
+       0 disables caching for that service) and are evicted least recently
+       used first when the cache grows beyond max_size (MB).
+       In cache_only mode the network is never touched: misses are reported
+       like an HTTP 504 Gateway Timeout.'''
+
+    def __init__(self, cache_file, ttls = {}, max_size = 500, cache_only = False):
+        # thread-safe own connection, we serialize access with a lock
+        conn = sqlite3.connect(str(cache_file), check_same_thread = False)
+        super(Web_cache, self).__init__(db_conn = conn)
+        self.lock = threading.RLock()
+        self.ttls = ttls
+        self.max_size = max_size * 1024 * 1024
+        self.cache_only = cache_only
+        self.hits, self.misses = 0, 0
+        self.execute_sql('''
+            CREATE TABLE IF NOT EXISTS response (
+                service TEXT NOT NULL,
+                key TEXT NOT NULL,
+                status INTEGER NOT NULL,
+                body BLOB,
+                size INTEGER NOT NULL,
+                fetched REAL NOT NULL,
+                accessed REAL NOT NULL,
+                PRIMARY KEY (service, key)
+            ); ''')
+        self.execute_sql('''CREATE INDEX IF NOT EXISTS response_accessed
+                               ON response (accessed); ''')
+        # running total of body sizes, so put() only evicts when necessary
+        self.total_size = self._sum_size()
+
+    def _sum_size(self):
+        self.cur.execute('SELECT COALESCE(SUM(size), 0) FROM response;')
+        return self.cur.fetchone()[0]
+
+    def enabled(self, service):
+        return self.cache_only or self.ttls.get(service, 0) > 0
+
+    def get(self, service, key):
+        '''returns a (body, status) tuple or None if not cached or expired.
+           Expiry is ignored in cache_only mode.'''
+        if not self.enabled(service):
+            return None
+        with self.lock:
+            self.cur.execute('''SELECT body, status, fetched FROM response
+                                  WHERE service = ? AND key = ?;''', (service, key))
+            row = self.cur.fetchone()
+            now = time.time()
+            max_age = self.ttls.get(service, 0) * 86400
+            if row is None or (not self.cache_only and now - row['fetched'] > max_age):
+                self.misses += 1
+                log.debug("MODEL: Web_cache miss: %s %s", service, key)
+                return None
+            self.execute_sql('''UPDATE response SET accessed = ?
+                                  WHERE service = ? AND key = ?;''', (now, service, key))
+            self.hits += 1
+            log.debug("MODEL: Web_cache hit: %s %s", service, key)
+            return row['body'], row['status']
+
+    def put(self, service, key, body, status):
+        '''stores a response, only successful ones and 404s are worth it'''
+        if self.cache_only or not self.enabled(service):
+            return False
+        if not (200 <= status < 300 or status == 404):
+            return False
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        now = time.time()
+        with self.lock:
+            self.cur.execute('''SELECT size FROM response
+                                  WHERE service = ? AND key = ?;''', (service, key))
+            replaced = self.cur.fetchone()
+            ok = self.execute_sql('''INSERT OR REPLACE INTO response
+                (service, key, status, body, size, fetched, accessed)
+                VALUES (?, ?, ?, ?, ?, ?, ?);''',
+                (service, key, status, body, len(body), now, now))
+            if ok:
+                self.total_size += len(body) - (replaced[0] if replaced else 0)
+            if self.total_size > self.max_size:
+                self.evict()
+        return ok
+
+    def evict(self):
+        '''drops least recently used responses exceeding max_size'''
+        with self.lock:
+            evicted = self.execute_sql('''DELETE FROM response WHERE rowid IN (
+                SELECT rowid FROM (
+                    SELECT rowid, SUM(size) OVER (
+                        ORDER BY accessed DESC, rowid DESC) AS running_size
+                    FROM response)
+                WHERE running_size > ?);''', (self.max_size, ))
+            self.total_size = self._sum_size()
+            return evicted
+
+    def clear(self, service = False):
+        with self.lock:
+            if service:
+                cleared = self.execute_sql(
+                    "DELETE FROM response WHERE service = ?;", (service, ))
+            else:
+                cleared = self.execute_sql("DELETE FROM response;")
+            self.total_size = self._sum_size()
+            return cleared
+
+    def get_json(self, service, key):
+        '''convenience for callers caching already parsed data'''
+        cached = self.get(service, key)
+        if cached is None:
+            return None
+        body, status = cached
+        return json.loads(body), status
+
+    def put_json(self, service, key, data, status = 200):
+        return self.put(service, key, json.dumps(data), status)
+
+
+class Web_cache_fetcher (object):
+    '''Wraps the fetcher of a discogs_client.Client: GET requests are looked
+       up in and written to a Web_cache, everything else is passed through.
+       Attributes like rate_limit_remaining are proxied to the wrapped
+       fetcher.'''
+    # user collection pages change when records are added, never cache them,
+    # the OAuth identity is DiscoDOS' online check and depends on the token
+    uncached_url_parts = ['/users/', '/oauth/']
+
+    def __init__(self, fetcher, web_cache, service = 'discogs'):
+        self.fetcher = fetcher
+        self.web_cache = web_cache
+        self.service = service
+
+    def __getattr__(self, name):
+        return getattr(self.fetcher, name)
+
+    def fetch(self, client, method, url, **kwargs): # kwargs: data, headers
+        cacheable = method == 'GET' and not any(
+            part in url for part in self.uncached_url_parts)
+        if cacheable:
+            cached = self.web_cache.get(self.service, url)
+            if cached is not None:
+                return cached
+        if self.web_cache.cache_only:
+            log.warning("MODEL: Not in web cache (cache only mode): %s", url)
+            return b'{"message": "Not in web cache (cache only mode)"}', 504
+        content, status_code = self.fetcher.fetch(client, method, url, **kwargs)
+        if cacheable:
+            self.web_cache.put(self.service, url, content, status_code)
+        return content, status_code
+
+
+class Rate_limiter (object):
+    '''A thread-safe token bucket: allows up to "limit" requests per "period"
+       seconds, in bursts of at most "limit". acquire() sleeps only as long as
+       necessary to get the next token. The bucket can be synced with what
+       the server says is remaining in its window (sync).'''
+
+    def __init__(self, limit, period):
+        self.limit = limit
+        self.period = period
+        self.tokens = float(limit)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+        self.waited = 0.0 # total seconds slept, for stats
+
+    def _refill(self):
+        now = time.monotonic()
+        if now <= self.last_refill: # held empty by sync
+            return
+        self.tokens = min(float(self.limit),
+            self.tokens + (now - self.last_refill) * self.limit / self.period)
+        self.last_refill = now
+
+    def acquire(self):
+        with self.lock: # waiting inside the lock keeps callers in line
+            self._refill()
+            if self.tokens < 1:
+                wait = max(self.last_refill - time.monotonic(), 0) + (
+                    (1 - self.tokens) * self.period / self.limit)
+                log.info("MODEL: Rate limit reached, waiting %.2f seconds.", wait)
+                time.sleep(wait)
+                self.waited += wait
+                self._refill()
+            self.tokens -= 1
+
+    def sync(self, limit, remaining):
+        '''adjust to rate limit headers, the server's view wins if it saw
+           more requests than we did (eg. other clients using the same token).
+           Nothing remaining means the server's moving window is full, the
+           bucket then stays empty for a whole period.'''
+        try:
+            limit, remaining = int(limit), int(remaining)
+        except (TypeError, ValueError): # headers missing, eg. on errors
+            return
+        with self.lock:
+            self._refill()
+            self.limit = limit
+            self.tokens = min(self.tokens, float(remaining))
+            if remaining <= 0:
+                self.tokens = 0.0
+                self.last_refill = time.monotonic() + self.period
+            log.debug("MODEL: Rate limit: %s/%s remaining (bucket: %.2f)",
+                      remaining, limit, self.tokens)
+
+
+class Rate_limited_fetcher (object):
+    '''Wraps the fetcher of a discogs_client.Client: each request takes a
+       token from a Rate_limiter first, the limiter is synced from the
+       X-Discogs-Ratelimit response headers afterwards. The headers are taken
+       from each thread's own response, the rate_limit attributes of the
+       wrapped fetcher are shared by all threads.'''
+
+    def __init__(self, fetcher, rate_limiter):
+        self.fetcher = fetcher
+        self.rate_limiter = rate_limiter
+        self.local = threading.local()
+        if hasattr(fetcher, 'request'): # all of discogs_client's HTTP fetchers
+            fetcher.request = self._recording(fetcher.request)
+
+    def __getattr__(self, name):
+        return getattr(self.fetcher, name)
+
+    def _recording(self, request):
+        def recording_request(*args, **kwargs):
+            resp = request(*args, **kwargs)
+            self.local.headers = resp.headers
+            return resp
+        return recording_request
+
+    def fetch(self, client, method, url, **kwargs): # kwargs: data, headers
+        self.rate_limiter.acquire()
+        self.local.headers = {}
+        content, status_code = self.fetcher.fetch(client, method, url, **kwargs)
+        self.rate_limiter.sync(self.local.headers.get('X-Discogs-Ratelimit'),
+            self.local.headers.get('X-Discogs-Ratelimit-Remaining'))
+        return content, status_code
+
+
+class Brainz_scheduler (object):
+    '''Runs MusicBrainz requests one after another in its own thread, paced
+       by a Rate_limiter (MusicBrainz allows 1 request per second). Requests
+       with a lower priority number go first. A request that is already
+       queued or running under the same key isn't sent again, the caller
+       gets the same Future; a more urgent duplicate moves it up the queue.'''
+
+    def __init__(self, rate_limiter):
+        self.rate_limiter = rate_limiter
+        self.queue = queue.PriorityQueue()
+        self.in_flight = {} # key -> request dict, until its Future is done
+        self.lock = threading.Lock()
+        self.seq = itertools.count() # FIFO within the same priority
+        self.thread = threading.Thread(target = self._run,
+            name = 'Brainz_scheduler', daemon = True)
+        self.thread.start()
+
+    def submit(self, key, priority, func, *args, **kwargs):
+        '''queues func(*args, **kwargs), returns a Future of its result'''
+        with self.lock:
+            request = self.in_flight.get(key)
+            if request:
+                log.debug("MODEL: Brainz_scheduler: joining request %s", key)
+                if priority < request['priority'] and not request['started']:
+                    request['priority'] = priority # queued again, runs once
+                    self.queue.put((priority, next(self.seq), request))
+                return request['future']
+            request = {'key': key, 'priority': priority, 'started': False,
+                       'future': Future(), 'call': (func, args, kwargs)}
+            self.in_flight[key] = request
+            self.queue.put((priority, next(self.seq), request))
+            return request['future']
+
+    def call(self, key, priority, func, *args, **kwargs):
+        '''submit and wait, errors are raised as if func was called directly'''
+        return self.submit(key, priority, func, *args, **kwargs).result()
+
+    def _run(self):
+        while True:
+            _priority, _seq, request = self.queue.get()
+            with self.lock:
+                if request['started']: # moved up the queue, ran already
+                    continue
+                request['started'] = True
+            self.rate_limiter.acquire()
+            func, args, kwargs = request['call']
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as exc:
+                self._done(request)
+                request['future'].set_exception(exc)
+            else:
+                self._done(request)
+                request['future'].set_result(result)
+
+    def _done(self, request):
+        with self.lock:
+            del self.in_flight[request['key']]
+
+
 # mix model class
 class Mix (Database):
+    # mix_track.track_pos only orders the tracks of a mix, it may have gaps
+    # and fractions (see _pos_key). The positions shown to and entered by the
+    # user are numbered densely at read time:
+    _numbered = '''(SELECT mix_track_id, ROW_NUMBER() OVER (
+                     ORDER BY track_pos, mix_track_id) AS pos
+                   FROM mix_track WHERE mix_id == ?) AS numbered'''
 
     def __init__(self, db_conn, mix_name_or_id, db_file = False):
         super(Mix, self).__init__(db_conn, db_file)
@@ -304,9 +737,10 @@ class Mix (Database):
 
     def get_one_mix_track(self, track_id):
         log.info("MODEL: Returning track {} from mix {}.".format(track_id, self.id))
-        _where = 'mix_track.mix_id == {} AND mix_track.track_pos == {}'.format(self.id,
-            track_id)
-        _join = '''mix_track INNER JOIN mix
+        _where = 'numbered.pos == ?'
+        _join = self._numbered + ''' INNER JOIN mix_track
+                              ON mix_track.mix_track_id = numbered.mix_track_id
+                              INNER JOIN mix
                                 ON mix.mix_id = mix_track.mix_id
                                   INNER JOIN release
                                   ON mix_track.d_release_id = release.discogs_id
@@ -316,10 +750,11 @@ class Mix (Database):
                                       LEFT OUTER JOIN track_ext
                                       ON mix_track.d_release_id = track_ext.d_release_id
                                       AND mix_track.d_track_no = track_ext.d_track_no'''
-        return self._select_simple(['track_pos', 'discogs_title', 'd_track_name',
-          'mix_track.d_track_no', 'trans_rating', 'trans_notes', 'key', 'key_notes',
-          'bpm', 'notes', 'mix_track_id', 'mix_track.d_release_id', 'm_rec_id_override'],
-          _join, fetchone = True, condition = _where)
+        return self._select_simple(['numbered.pos AS track_pos', 'discogs_title',
+          'd_track_name', 'mix_track.d_track_no', 'trans_rating', 'trans_notes', 'key',
+          'key_notes', 'bpm', 'notes', 'mix_track.mix_track_id',
+          'mix_track.d_release_id', 'm_rec_id_override'],
+          _join, fetchone = True, condition = _where, params = (self.id, track_id))
 
     def update_mix_track_and_track_ext(self, track_details, edit_answers):
         log.info(
@@ -346,60 +781,40 @@ class Mix (Database):
                 track_ext_edit = True
 
         if mix_track_edit:
-            # save current track order if pos-edit included
-            if 'track_pos' in edit_answers:
-                move_to = int(edit_answers['track_pos'])
-                # when moving the track "up"
-                if move_to < track_details['track_pos']:
-                    all_after_dest_pos = self.get_tracks_from_position(
-                          edit_answers['track_pos'])
-                    # shift all those tracks "down" +1
-                    self.reorder_tracks_squeeze_in(edit_answers['track_pos'],
-                          all_after_dest_pos)
-                # when moving the track "down"
-                elif move_to > track_details['track_pos']:
-                    # we set dest pos to be one further down to really be the
-                    # chosen destination after reorder_pos (see below db update)
-                    edit_answers['track_pos'] = move_to + 1
-                    all_after_dest_pos = self.get_tracks_from_position(
-                          edit_answers['track_pos'])
-                    # shift all those tracks "down" +1
-                    self.reorder_tracks_squeeze_in(edit_answers['track_pos'],
-                          all_after_dest_pos)
-                # no else: nothing to do if track_pos stays the same
-                # FIXME somehow we should user inform like this:
-                # this track will be put in after/bevore track "name" ok?
-
             update_mix_track = 'UPDATE mix_track SET '
-            where_mix_track = 'WHERE mix_track_id == {}'.format(track_details['mix_track_id'])
+            where_mix_track = 'WHERE mix_track_id == ?'
             for key, answer in edit_answers.items():
                 log.debug('key: {}, value: {}'.format(key, answer))
-                if key in mix_track_cols:
+                # moving is done by move_track, only the moved row changes
+                if key in mix_track_cols and key != 'track_pos':
                     if values_mix_track == '':
                         values_mix_track += "{} = ? ".format(key)
                     else:
                         values_mix_track += ", {} = ? ".format(key)
                     values_list_mix_track.append(answer)
             final_update_mix_track = update_mix_track + values_mix_track + where_mix_track
+            values_list_mix_track.append(track_details['mix_track_id'])
             # debug
             #log.info('MODEL: {}'.format(final_update_mix_track))
             #log.info(log.info('MODEL: {}'.format(tuple(values_list_mix_track))))
 
-            log.info("MODEL: Now really executing mix_track update...")
-            updated_mix_track = self.execute_sql(
-                final_update_mix_track, tuple(values_list_mix_track))
+            if values_mix_track:
+                log.info("MODEL: Now really executing mix_track update...")
+                updated_mix_track = self.execute_sql(
+                    final_update_mix_track, tuple(values_list_mix_track))
 
-            # finish "track moving":
-            # after original track_pos was edited we fill in the gap
+            # the track lands right before (moving up) or right after
+            # (moving down) the track currently at the chosen position
             if 'track_pos' in edit_answers:
-                self.reorder_tracks(int(track_details['track_pos']) - 1)
-            # FIXME no sanity check if this was ok
+                move_to = int(edit_answers['track_pos'])
+                if move_to != track_details['track_pos']:
+                    updated_mix_track = self.move_track(
+                        track_details['track_pos'], move_to)
 
         if track_ext_edit:
             update_track_ext = 'UPDATE track_ext SET '
             insert_track_ext = 'INSERT INTO track_ext'
-            where_track_ext = 'WHERE d_release_id == {} AND d_track_no == \"{}\"'.format(
-                                track_details['d_release_id'], track_details['d_track_no'])
+            where_track_ext = 'WHERE d_release_id == ? AND d_track_no == ?'
             for key, answer in edit_answers.items():
                 log.debug('key: {}, value: {}'.format(key, answer))
                 if key in track_ext_cols:
@@ -429,6 +844,8 @@ class Mix (Database):
             values_insert_list_track_ext = values_list_track_ext[:]
             values_insert_list_track_ext.append(track_details['d_release_id'])
             values_insert_list_track_ext.append(track_details['d_track_no'])
+            # the WHERE clause of the update binds the same two values
+            values_list_track_ext = values_insert_list_track_ext
             #log.info('MODEL: {}'.format(tuple(values_insert_list_track_ext)))
 
             log.info("MODEL: Now really executing track_ext update/insert...")
@@ -454,112 +871,146 @@ class Mix (Database):
     def get_tracks_from_position(self, pos):
         log.info('MODEL: Getting tracks in mix, starting at position {}.'.format(pos))
         #return db.get_tracks_from_position(self.db_conn, self.id, pos)
-        return self._select_simple(['mix_track_id', 'track_pos'], 'mix_track',
-            condition = "mix_id = {} AND track_pos >= {}".format(self.id, pos),
-            orderby = 'track_pos ASC')
+        return self._select_simple(['mix_track_id', 'pos AS track_pos'],
+            self._numbered, condition = "pos >= ?",
+            orderby = 'pos ASC', params = (self.id, pos))
+
+    def _edit_positions(self, edit, *args):
+        '''runs an edit of track positions and the mix' updated timestamp in
+           one transaction. Any error rolls back the edit and returns False.'''
+        try:
+            with self.transaction():
+                if not edit(*args):
+                    # transaction() would commit what the edit wrote so far
+                    raise _Edit_failed("Incomplete track positions edit.")
+                return self._updated_timestamp()
+        except _Edit_failed as e:
+            log.info("MODEL: Rolled back: %s", e.args[0])
+            return False
+        except sqlerr as e:
+            log.error("MODEL: Editing track positions failed: %s", e.args[0])
+            return False
+
+    def _key_between(self, pos, exclude_id):
+        '''track_pos value half way between the tracks that end up before and
+           after a track put at position pos, None if there's no room left'''
+        sql_sel = '''SELECT track_pos FROM mix_track
+                       WHERE mix_id == ? AND mix_track_id != ?
+                       ORDER BY track_pos, mix_track_id LIMIT 2 OFFSET ?'''
+        keys = [row['track_pos'] for row in self._select(sql_sel,
+            params = (self.id, exclude_id, max(pos - 2, 0)))]
+        if pos > 1 and not keys: # far behind the last track: append
+            keys = [row[0] for row in self._select_simple(['MAX(track_pos)'],
+                'mix_track', 'mix_id == ? AND mix_track_id != ?',
+                params = (self.id, exclude_id)) if row[0] is not None]
+        before, after = (None, keys) if pos <= 1 else (keys[:1], keys[1:])
+        if not before and not after:
+            return 1
+        if not before:
+            return after[0] - 1
+        if not after:
+            return before[0] + 1
+        key = (before[0] + after[0]) / 2
+        if before[0] < key < after[0]:
+            return key
+        return None
+
+    def _pos_key(self, pos, exclude_id = -1):
+        '''track_pos value for a track put at position pos (leaving out
+           exclude_id, the track being moved). Only this track's row has to be
+           written, unless fractions got too fine and the mix is renumbered.'''
+        key = self._key_between(pos, exclude_id)
+        if key is None:
+            log.info("MODEL: No room at position {}, renumbering mix.".format(pos))
+            self._renumber_tracks()
+            key = self._key_between(pos, exclude_id)
+        return key
+
+    def _renumber_tracks(self):
+        '''rebalances: sets track_pos of all tracks to 1, 2, 3... in one UPDATE'''
+        sql_upd = '''WITH numbered AS (
+                       SELECT mix_track_id, ROW_NUMBER() OVER (
+                         ORDER BY track_pos, mix_track_id) AS pos
+                       FROM mix_track WHERE mix_id == ?)
+                     UPDATE mix_track SET track_pos = (
+                       SELECT pos FROM numbered
+                         WHERE numbered.mix_track_id = mix_track.mix_track_id)
+                     WHERE mix_track_id IN (SELECT mix_track_id FROM numbered)'''
+        return self.execute_sql(sql_upd, (self.id, ), raise_err = True)
 
     def reorder_tracks(self, pos):
+        '''positions are numbered at read time, gaps never show. This only
+           tidies up track_pos values of the whole mix.'''
         log.info("MODEL: Reordering tracks in mix, starting at pos {}".format(pos))
-        #tracks_to_shift = db.get_tracks_from_position(self.db_conn, self.id, pos)
-        tracks_to_shift = self.get_tracks_from_position(pos)
-        if not tracks_to_shift:
+        if not self.get_tracks_from_position(pos):
             return False
-        for t in tracks_to_shift:
-            log.info("MODEL: Shifting mix_track_id %i from pos %i to %i", t['mix_track_id'],
-                     t['track_pos'], pos)
-            sql_upd = 'UPDATE mix_track SET track_pos = ? WHERE mix_track_id == ?'
-            ids_tuple = (pos, t['mix_track_id'])
-            #if not db.update_pos_in_mix(self.db_conn, t['mix_track_id'], pos):
-            #    return False
-            if not self.execute_sql(sql_upd, ids_tuple):
-                return False
-            pos = pos + 1
-        return self._updated_timestamp()
-
-    def reorder_tracks_squeeze_in(self, pos, tracks_to_shift):
-        log.info('MODEL: Reordering because a track was squeezed in at pos {}.'.format(pos))
-        if not tracks_to_shift:
+        return self._edit_positions(self._renumber_tracks)
+
+    def insert_track(self, release_id, track_no, pos, trans_rating='', trans_notes=''):
+        '''adds a track at pos, positions after it are one higher then.
+           A pos after the last track appends.'''
+        log.info('MODEL: Inserting track at pos {}.'.format(pos))
+        def insert():
+            sql_add = '''INSERT INTO mix_track
+                (mix_id, d_release_id, d_track_no, track_pos, trans_rating, trans_notes)
+                VALUES(?, ?, ?, ?, ?, ?)'''
+            return self.execute_sql(sql_add, (self.id, release_id, track_no.upper(),
+                self._pos_key(pos), trans_rating, trans_notes), raise_err = True)
+        return self._edit_positions(insert)
+
+    def remove_track(self, pos):
+        '''deletes the track at pos, positions after it are one lower then'''
+        log.info("MODEL: Removing track {} from {}.".format(pos, self.id))
+        def remove():
+            sql_del = '''DELETE FROM mix_track WHERE mix_track_id == (
+                           SELECT mix_track_id FROM {} WHERE pos == ?)'''.format(
+                           self._numbered)
+            return self.execute_sql(sql_del, (self.id, pos), raise_err = True)
+        return self._edit_positions(remove)
+
+    def move_track(self, pos, new_pos):
+        '''moves the track at pos to new_pos, only its own row changes'''
+        log.info("MODEL: Moving track {} to {}.".format(pos, new_pos))
+        if not 1 <= new_pos <= self.get_last_track()[0]:
+            log.error('MODEL: move_track: position {} is not in mix.'.format(new_pos))
             return False
-        for t in tracks_to_shift:
-            new_pos = t['track_pos'] + 1
-            log.info("MODEL: Shifting mix_track_id %i from pos %i to %i", t['mix_track_id'],
-                     t['track_pos'], new_pos)
-            #if not db.update_pos_in_mix(self.db_conn, t['mix_track_id'], new_pos):
-            #    return False
-            sql_upd = 'UPDATE mix_track SET track_pos = ? WHERE mix_track_id == ?'
-            ids_tuple = (new_pos, t['mix_track_id'])
-            if not self.execute_sql(sql_upd, ids_tuple):
-                return False
-        return self._updated_timestamp()
+        track = self.get_one_mix_track(pos)
+        if not track:
+            log.error('MODEL: move_track: no track at position {}.'.format(pos))
+            return False
+        def move():
+            return self.execute_sql(
+                'UPDATE mix_track SET track_pos = ? WHERE mix_track_id == ?',
+                (self._pos_key(new_pos, track['mix_track_id']),
+                 track['mix_track_id']), raise_err = True)
+        return self._edit_positions(move)
 
     def shift_track(self, pos, direction):
         if direction != 'up' and direction != 'down':
             log.error('MODEL: shift_track: wrong usage.')
             return False
-        # get mix_track_id of track to shift, the one before and the one after
-        tr_before = self._select_simple(['mix_track_id'], 'mix_track', fetchone=True,
-            condition = "mix_id = {} AND track_pos == {}".format(self.id, pos-1))
-        tr = self._select_simple(['mix_track_id'], 'mix_track', fetchone=True,
-            condition = "mix_id = {} AND track_pos == {}".format(self.id, pos))
-        tr_after = self._select_simple(['mix_track_id'], 'mix_track', fetchone=True,
-            condition = "mix_id = {} AND track_pos == {}".format(self.id, pos+1))
-        log.debug('before: {}, shift_track: {}, after: {}'.format(
-          tr_before['mix_track_id'], tr['mix_track_id'], tr_after['mix_track_id']))
-
-        if direction == 'up':
-            tr_before_pos = pos     # is now the same as the orig track
-            tr_pos        = pos -1  # is now one less than before
-            tr_after_pos  = pos +1  # stays the same
-
-            sql_upd_tr_bef = 'UPDATE mix_track SET track_pos = ? WHERE mix_track_id == ?'
-            ids_tr_bef = (tr_before_pos, tr_before['mix_track_id'])
-            sql_upd_tr = 'UPDATE mix_track SET track_pos = ? WHERE mix_track_id == ?'
-            ids_tr = (tr_pos, tr['mix_track_id'])
-
-            ret_tr = self.execute_sql(sql_upd_tr, ids_tr)
-            ret_tr_bef = self.execute_sql(sql_upd_tr_bef, ids_tr_bef)
-            ret_tr_aft = True
-
-        elif direction == 'down':
-            tr_before_pos = pos -1  # stays the same
-            tr_pos        = pos +1  # is now one more than before
-            tr_after_pos  = pos     # is now the same as the orig track
-
-            sql_upd_tr = 'UPDATE mix_track SET track_pos = ? WHERE mix_track_id == ?'
-            ids_tr = (tr_pos, tr['mix_track_id'])
-            sql_upd_tr_aft = 'UPDATE mix_track SET track_pos = ? WHERE mix_track_id == ?'
-            ids_tr_aft = (tr_after_pos, tr_after['mix_track_id'])
-
-            ret_tr_bef = True
-            ret_tr = self.execute_sql(sql_upd_tr, ids_tr)
-            ret_tr_aft = self.execute_sql(sql_upd_tr_aft, ids_tr_aft)
-
-        if not ret_tr and ret_tr_bef and ret_tr_aft:
-            log.error ('MODEL: shift_track: one or more track updates failed.')
+        new_pos = pos - 1 if direction == 'up' else pos + 1
+        if not self.move_track(pos, new_pos):
+            log.error('MODEL: shift_track: track update failed.')
             return False
         log.info (
             'MODEL: shift_track: Former track {} was successfully shifted {}.'.format(
                      pos, direction))
-        return self._updated_timestamp()
+        return True
 
     def delete_track(self, pos):
         log.info("MODEL: Deleting track {} from {}.".format(pos, self.id))
-        sql_del = 'DELETE FROM mix_track WHERE mix_id == ? AND track_pos == ?'
-        ids_tuple = (self.id, pos)
-        del_success = self.execute_sql(sql_del, (ids_tuple))
-        if del_success:
-            return self._updated_timestamp()
-        return del_success
+        return self.remove_track(pos)
 
     def get_full_mix(self, verbose = False, brainz = False, order_by = 'track_pos ASC'):
         log.info('MODEL: Getting full mix.')
         if verbose:
-            sql_sel = '''SELECT track_pos, discogs_title, track.d_artist,
+            sql_sel = '''SELECT numbered.pos AS track_pos, discogs_title, track.d_artist,
                           d_track_name, mix_track.d_track_no,
                           key, bpm, key_notes, trans_rating, trans_notes, notes,
                           a_key, a_chords_key, a_bpm FROM'''
         elif brainz:
-            sql_sel = '''SELECT track_pos, discogs_title, mix_track.d_track_no,
+            sql_sel = '''SELECT numbered.pos AS track_pos, discogs_title, mix_track.d_track_no,
                           key, bpm, a_key, a_chords_key, a_bpm,
                           d_catno, discogs_id, m_rel_id, m_rec_id,
                           m_rel_id_override, m_rec_id_override,
@@ -568,12 +1019,14 @@ class Mix (Database):
                           release.m_match_time AS release_match_time,
                           track.m_match_time AS track_match_time FROM'''
         else:
-            sql_sel = '''SELECT track_pos, d_catno, discogs_title, mix_track.d_track_no,
+            sql_sel = '''SELECT numbered.pos AS track_pos, d_catno, discogs_title, mix_track.d_track_no,
                           trans_rating, key, bpm, a_key, a_chords_key, a_bpm FROM'''
 
         order_clause = 'ORDER BY {}'.format(order_by)
-        sql_sel+=''' 
-                           mix_track INNER JOIN mix
+        sql_sel+=''' {}
+                           INNER JOIN mix_track
+                           ON mix_track.mix_track_id = numbered.mix_track_id
+                           INNER JOIN mix
                              ON mix.mix_id = mix_track.mix_id
                                INNER JOIN release
                                ON mix_track.d_release_id = release.discogs_id
@@ -583,9 +1036,8 @@ class Mix (Database):
                                    LEFT OUTER JOIN track_ext
                                    ON mix_track.d_release_id = track_ext.d_release_id
                                    AND mix_track.d_track_no = track_ext.d_track_no
-                       WHERE mix_track.mix_id == {}
-                       {}'''.format(self.id, order_clause)
-        return self._select(sql_sel, fetchone = False)
+                       {}'''.format(self._numbered, order_clause)
+        return self._select(sql_sel, fetchone = False, params = (self.id, ))
 
     def add_track(self, release_id, track_no, track_pos, trans_rating='', trans_notes=''):
         log.info('MODEL: Adding track to current mix.')
@@ -603,17 +1055,18 @@ class Mix (Database):
 
     def get_last_track(self):
         log.info('MODEL: Getting last track in current mix')
-        return self._select_simple(['MAX(track_pos)'], 'mix_track',
-            condition = "mix_id = {}".format(self.id), fetchone = True)
+        # positions are numbered densely, the last one is the track count
+        return self._select_simple(['COUNT(*)'], 'mix_track',
+            condition = "mix_id = ?", fetchone = True, params = (self.id, ))
 
     def get_tracks_of_one_mix(self, start_pos = False):
         log.info("MODEL: Getting tracks of a mix, from mix_track_table only)")
-        if not start_pos:
-            where = "mix_id == {}".format(self.id)
-        else:
-            where = "mix_id == {} and track_pos >= {}".format(self.id, start_pos)
-        return self._select_simple(['*'], 'mix_track', where,
-                fetchone = False, orderby = 'track_pos')
+        return self._select_simple(['mix_track.mix_track_id', 'mix_id',
+                'd_release_id', 'd_track_no', 'pos AS track_pos', 'trans_rating',
+                'trans_notes'], self._numbered + ''' INNER JOIN mix_track
+                  ON mix_track.mix_track_id = numbered.mix_track_id''',
+                'pos >= ?', fetchone = False, orderby = 'pos',
+                params = (self.id, start_pos or 1))
 
     def get_all_tracks_in_mixes(self):
         log.info('MODEL: Getting all tracks from mix_track table (only).')
@@ -629,7 +1082,7 @@ class Mix (Database):
         @author
         """
         self.mix_info = self._select_simple(
-            ['*'], 'mix', "mix_id == {}".format(self.id), fetchone = True)
+            ['*'], 'mix', "mix_id == ?", fetchone = True, params = (self.id, ))
         return self.mix_info
 
     def update_mix_info(self, mix_details, edit_answers):
@@ -640,7 +1093,7 @@ class Mix (Database):
         values_list_mix = []
 
         update_mix = 'UPDATE mix SET '
-        where_mix = 'WHERE mix_id == {}'.format(mix_details['mix_id'])
+        where_mix = 'WHERE mix_id == ?'
         for key, answer in edit_answers.items():
             log.debug('key: {}, value: {}'.format(key, answer))
             # handle slq col = ?
@@ -654,6 +1107,7 @@ class Mix (Database):
 
         if len(edit_answers) != 0: # only update if necessary
             final_update_mix = update_mix + values_mix + where_mix
+            values_list_mix.append(mix_details['mix_id'])
             log.info("MODEL: Executing mix update...")
             return self.execute_sql(final_update_mix, tuple(values_list_mix))
         else:
@@ -662,12 +1116,8 @@ class Mix (Database):
 
     def get_mix_tracks_for_brainz_update(self, start_pos = False):
         log.info("MODEL: Getting tracks of a mix. Preparing for Discogs or AcousticBrainz update.")
-        if not start_pos:
-            where = "mix_id == {}".format(self.id)
-        else:
-            where = "mix_id == {} and track_pos >= {}".format(
-                self.id, start_pos)
-        tables = '''mix_track
+        tables = self._numbered + ''' INNER JOIN mix_track
+                  ON mix_track.mix_track_id = numbered.mix_track_id
                       INNER JOIN release
                       ON mix_track.d_release_id = release.discogs_id
                         LEFT OUTER JOIN track
@@ -676,15 +1126,16 @@ class Mix (Database):
                           LEFT OUTER JOIN track_ext
                           ON mix_track.d_release_id = track_ext.d_release_id
                           AND mix_track.d_track_no = track_ext.d_track_no'''
-        return self._select_simple(['track_pos', 'mix_track.d_release_id',
+        return self._select_simple(['pos AS track_pos', 'mix_track.d_release_id',
           'discogs_id', 'discogs_title', 'd_catno', 'track.d_artist',
           'd_track_name', 'mix_track.d_track_no', 'm_rec_id_override'],
-           tables, where, fetchone = False, orderby = 'mix_track.track_pos')
+           tables, 'pos >= ?', fetchone = False, orderby = 'pos',
+           params = (self.id, start_pos or 1))
 
     def get_all_mix_tracks_for_brainz_update(self, offset=0):
         log.info("MODEL: Getting all tracks of all mix. Preparing for Discogs or AcousticBrainz update.")
         if offset > 0:
-            log.info('MODEL: Add 1 to offset (FIXME why?)')
+            log.info('MODEL: Subtract 1 from offset (--resume counts from 1)')
             offset = offset - 1
         tables = '''mix_track
                       INNER JOIN release
@@ -695,21 +1146,34 @@ class Mix (Database):
                           LEFT OUTER JOIN track_ext
                           ON mix_track.d_release_id = track_ext.d_release_id
                           AND mix_track.d_track_no = track_ext.d_track_no'''
-        return self._select_simple(['track_pos', 'mix_track.d_release_id',
+        return self._select_simple(['''ROW_NUMBER() OVER (
+            PARTITION BY mix_track.mix_id ORDER BY mix_track.track_pos,
+              mix_track.mix_track_id) AS track_pos''', 'mix_track.d_release_id',
           'discogs_id', 'discogs_title', 'd_catno', 'track.d_artist',
           'd_track_name', 'mix_track.d_track_no', 'm_rec_id_override'],
            tables, fetchone=False, distinct=True, offset=offset,
-           orderby='mix_track.mix_id, mix_track.track_pos')
+           orderby='mix_track.mix_id, mix_track.track_pos, mix_track.mix_track_id')
 
 # record collection class
 class Collection (Database):
-
-    def __init__(self, db_conn, db_file=False):
+    # the DiscoBASE data a *Brainz match is based on. A failed match is
+    # retried early when it changed (see record_brainz_fail)
+    _brainz_fingerprint = '''(release.discogs_title || char(31)
+        || coalesce(release.d_catno, '') || char(31)
+        || coalesce(track.d_artist, '') || char(31)
+        || coalesce(track.d_track_name, '') || char(31)
+        || coalesce(track_ext.m_rec_id_override, ''))'''
+    brainz_backoff_days = 7 # first retry after a failed match, then doubled
+    brainz_backoff_max_days = 180
+
+    def __init__(self, db_conn, db_file=False, web_cache=False):
         super(Collection, self).__init__(db_conn, db_file)
         # discogs api objects are online set when discogs_connect method is called
         self.d = False
         self.me = False
         self.ONLINE = False
+        self.web_cache = web_cache # a Web_cache instance or False
+        self.rate_limiter = Rate_limiter(60, 60) # Discogs: 60 requests/min
 
     # discogs connect try,except wrapper, sets attributes d and me
     # leave globals for compatibility for now
@@ -718,6 +1182,13 @@ class Collection (Database):
             self.d = discogs_client.Client(
                     _appIdentifier,
                     user_token = _userToken)
+            # every request to Discogs has to pass the rate limiter,
+            # cache hits don't, thus the cache wraps the limiter
+            self.d._fetcher = Rate_limited_fetcher(self.d._fetcher,
+                                                   self.rate_limiter)
+            if self.web_cache:
+                self.d._fetcher = Web_cache_fetcher(self.d._fetcher,
+                                                    self.web_cache, 'discogs')
             self.me = self.d.identity()
             global d
             d = self.d
@@ -738,6 +1209,23 @@ class Collection (Database):
             #'import_timestamp', 'in_d_collection'], 'release', orderby='d_artist, discogs_title')
             ], 'release', orderby='d_artist, discogs_title')
 
+    def get_db_releases_by_ids(self, release_ids):
+        '''the releases of the given Discogs IDs that are in the DiscoBASE,
+           as a dict keyed by discogs_id. Looked up via the primary key, the
+           release table is not scanned.'''
+        release_ids = [int(rel_id) for rel_id in release_ids]
+        if not release_ids:
+            return {}
+        rows = self._select_simple(['d_catno', 'd_artist', 'discogs_title',
+            'discogs_id', 'm_rel_id', 'm_rel_id_override'], 'release',
+            'discogs_id IN ({})'.format(', '.join('?' * len(release_ids))),
+            params = tuple(release_ids))
+        return {row['discogs_id']: row for row in rows}
+
+    def has_releases(self):
+        return bool(self._select_simple(['discogs_id'], 'release',
+            fetchone = True))
+
     def search_release_online(self, id_or_title):
         try:
             if is_number(id_or_title):
@@ -796,8 +1284,10 @@ class Collection (Database):
             object and adds additional information from the database 
             into the list'''
         tl=[]
+        dbtracks = self.get_tracks_of_release(release_id)
         for i, track in enumerate(tracklist):
-            dbtrack = self.get_track(release_id, track.position)
+            # we always save track_nos uppercase
+            dbtrack = dbtracks.get(track.position.upper())
             if dbtrack == None:
                 log.debug(
                  "prepare_tracklist_info: Track not in DB. Adding title/track_no only.")
@@ -822,15 +1312,30 @@ class Collection (Database):
     def get_track(self, release_id, track_no):
         log.info("MODEL: Returning collection track {} from release {}.".format(
               track_no, release_id))
-        where = 'track.d_release_id == {} AND track.d_track_no == "{}"'.format(
-              release_id, track_no.upper()) # we always save track_nos uppercase
+        where = 'track.d_release_id == ? AND track.d_track_no == ?'
         join = '''track LEFT OUTER JOIN track_ext
                     ON track.d_release_id = track_ext.d_release_id
                     AND track.d_track_no = track_ext.d_track_no'''
         return self._select_simple(['track.d_track_no', 'track.d_release_id',
           'd_track_name', 'key', 'key_notes', 'bpm', 'notes', 'm_rec_id_override',
           'a_key', 'a_chords_key', 'a_bpm'],
-          join, fetchone = True, condition = where)
+          join, fetchone = True, condition = where,
+          params = (release_id, track_no.upper())) # we always save track_nos uppercase
+
+    def get_tracks_of_release(self, release_id):
+        '''returns all tracks of a release with the same fields as get_track
+           in a dict keyed by track number'''
+        log.info("MODEL: Returning collection tracks of release {}.".format(
+              release_id))
+        join = '''track LEFT OUTER JOIN track_ext
+                    ON track.d_release_id = track_ext.d_release_id
+                    AND track.d_track_no = track_ext.d_track_no'''
+        rows = self._select_simple(['track.d_track_no', 'track.d_release_id',
+          'd_track_name', 'key', 'key_notes', 'bpm', 'notes', 'm_rec_id_override',
+          'a_key', 'a_chords_key', 'a_bpm'],
+          join, fetchone = False, condition = 'track.d_release_id == ?',
+          params = (release_id, ))
+        return {row['d_track_no']: row for row in rows}
 
     def search_release_offline(self, id_or_title):
         if is_number(id_or_title):
@@ -841,9 +1346,18 @@ class Collection (Database):
                 raise Exc
         else:
             try:
-                releases = self._select_simple(['*'], 'release',
-                        'discogs_title LIKE "%{}%" OR d_artist LIKE "%{}%"'.format(
-                        id_or_title, id_or_title), fetchone = False, orderby = 'd_artist')
+                if self.fts_available():
+                    releases = self._select_simple(['release.*'],
+                        'release_fts JOIN release ON release.discogs_id = release_fts.rowid',
+                        'release_fts MATCH ?', fetchone = False,
+                        orderby = 'release_fts.rank, release.d_artist',
+                        params = (self._fts_match(id_or_title,
+                            ['discogs_title', 'd_artist', 'd_catno']), ))
+                else:
+                    like = '%{}%'.format(id_or_title)
+                    releases = self._select_simple(['*'], 'release',
+                        'discogs_title LIKE ? OR d_artist LIKE ?',
+                        fetchone = False, orderby = 'd_artist', params = (like, like))
                 if releases:
                     log.debug("First found release: {}".format(releases[0]))
                     log.debug("All found releases: {}".format(releases))
@@ -854,7 +1368,98 @@ class Collection (Database):
                 log.error("Not found or Database Exception: %s\n", Exc)
                 raise Exc
 
+    def schema_at_least(self, version):
+        '''checks if the DiscoBASE was upgraded to the given schema version,
+           features of newer versions are only used after `disco setup`'''
+        if not hasattr(self, '_schema_version'):
+            self._schema_version = self.get_current_schema_version()
+            log.info("MODEL: DiscoBASE schema version: %s", self._schema_version)
+        return self._schema_version >= version
+
+    def fts_available(self):
+        '''checks if the full-text search tables exist. Schema version 3
+           creates them only if SQLite was built with FTS5.'''
+        if not hasattr(self, '_fts_available'):
+            self._fts_available = self.schema_at_least(3) and bool(
+                self._select_simple(['name'], 'sqlite_master',
+                    "type == 'table' AND name == 'track_fts_key'", fetchone = True))
+            log.info("MODEL: Full-text search available: %s", self._fts_available)
+        return self._fts_available
+
+    @staticmethod
+    def _fts_match(term, columns):
+        '''builds an FTS5 query matching all words of term as prefixes in
+           any of the given columns. Words are quoted, so no FTS5 syntax
+           characters in the search term are interpreted.'''
+        words = ['"{}"*'.format(word.replace('"', '""')) for word in term.split()]
+        return '{{{}}} : ({})'.format(' '.join(columns), ' '.join(words or ['""']))
+
     def search_release_track_offline(self, artist='', release='', track=''):
+        # prevent returning whole track collection when all search params empty
+        if not artist and not release and not track:
+            return []
+        if not self.fts_available():
+            return self._search_release_track_like(artist, release, track)
+        fields = ['release.d_artist', 'track.d_artist', 'track.d_release_id',
+                 'release.discogs_title', 'track.d_track_no', 'track.d_track_name',
+                 'key', 'bpm', 'key_notes', 'track_ext.notes']
+        # the most specific search term's FTS table drives the query and ranks
+        where_list, params = [], ()
+        if track:
+            from_tables = '''
+                    track_fts JOIN track_fts_key
+                      ON track_fts_key.fts_rowid = track_fts.rowid
+                    JOIN track ON track.d_release_id = track_fts_key.d_release_id
+                      AND track.d_track_no = track_fts_key.d_track_no
+                    JOIN release ON track.d_release_id = release.discogs_id'''
+            where_list.append('track_fts MATCH ?')
+            params += (self._fts_match(track, ['d_track_name', 'notes']), )
+            order_by = 'track_fts.rank, '
+        elif release:
+            from_tables = '''
+                    release_fts JOIN release ON release.discogs_id = release_fts.rowid
+                    LEFT OUTER JOIN track ON track.d_release_id = release.discogs_id'''
+            where_list.append('release_fts MATCH ?')
+            params += (self._fts_match(release, ['discogs_title']), )
+            order_by = 'release_fts.rank, '
+        else:
+            from_tables = '''
+                    release LEFT OUTER JOIN track
+                    ON track.d_release_id = release.discogs_id'''
+            order_by = ''
+        from_tables += '''
+                      LEFT OUTER JOIN track_ext
+                      ON track.d_release_id = track_ext.d_release_id
+                      AND track.d_track_no = track_ext.d_track_no'''
+        order_by += 'track.d_artist, release.discogs_title, track.d_track_name'
+
+        if release and track:
+            where_list.append('''release.discogs_id IN (
+                SELECT rowid FROM release_fts WHERE release_fts MATCH ?)''')
+            params += (self._fts_match(release, ['discogs_title']), )
+        if artist:
+            where_list.append('''(release.discogs_id IN (
+                  SELECT rowid FROM release_fts WHERE release_fts MATCH ?)
+                OR (track.d_release_id, track.d_track_no) IN (
+                  SELECT d_release_id, d_track_no FROM track_fts_key
+                  WHERE fts_rowid IN (
+                    SELECT rowid FROM track_fts WHERE track_fts MATCH ?)))''')
+            params += (self._fts_match(artist, ['d_artist']), ) * 2
+            if not release and not track: # narrow down releases, saves a scan
+                where_list.append('''release.discogs_id IN (
+                    SELECT rowid FROM release_fts WHERE release_fts MATCH ?
+                    UNION SELECT d_release_id FROM track_fts_key
+                      WHERE fts_rowid IN (
+                        SELECT rowid FROM track_fts WHERE track_fts MATCH ?))''')
+                params += (self._fts_match(artist, ['d_artist']), ) * 2
+        tracks = self._select_simple(fields, from_tables, ' AND '.join(where_list),
+                                     fetchone = False, orderby = order_by,
+                                     params = params)
+        #log.debug(self.debug_db(tracks))
+        return tracks
+
+    def _search_release_track_like(self, artist='', release='', track=''):
+        '''search_release_track_offline for DiscoBASEs without FTS tables'''
         fields = ['release.d_artist', 'track.d_artist', 'track.d_release_id', 'discogs_title',
                  'track.d_track_no', 'd_track_name',
                  'key', 'bpm', 'key_notes', 'notes']
@@ -865,89 +1470,146 @@ class Collection (Database):
                       ON track.d_release_id = track_ext.d_release_id
                       AND track.d_track_no = track_ext.d_track_no'''
 
+        params = ()
         if not artist:
             artist_sql = '''
-                     ((track.d_artist IS NULL OR track.d_artist LIKE "%") OR
-                      (release.d_artist IS NULL OR release.d_artist LIKE "%"))'''
+                     ((track.d_artist IS NULL OR track.d_artist LIKE '%') OR
+                      (release.d_artist IS NULL OR release.d_artist LIKE '%'))'''
         else:
-            artist_sql = '(track.d_artist LIKE "%{}%" OR release.d_artist LIKE "%{}%")'.format(
-              artist, artist)
+            artist_sql = '(track.d_artist LIKE ? OR release.d_artist LIKE ?)'
+            params += ('%{}%'.format(artist), '%{}%'.format(artist))
 
         if not release:
-            release_sql = '(discogs_title IS NULL OR discogs_title LIKE "%")'
+            release_sql = "(discogs_title IS NULL OR discogs_title LIKE '%')"
         else:
-            release_sql = 'discogs_title LIKE "%{}%"'.format(release)
+            release_sql = 'discogs_title LIKE ?'
+            params += ('%{}%'.format(release), )
 
         if not track:
-            track_sql = '(d_track_name IS NULL OR d_track_name LIKE "%")'
+            track_sql = "(d_track_name IS NULL OR d_track_name LIKE '%')"
         else:
-            track_sql = 'd_track_name LIKE "%{}%"'.format(track)
+            track_sql = 'd_track_name LIKE ?'
+            params += ('%{}%'.format(track), )
 
         where = '''{} AND {} AND {}'''.format(artist_sql, release_sql, track_sql)
         order_by = 'track.d_artist, discogs_title, d_track_name'
-
-        # prevent returning whole track collection when all search params empty
-        if not artist and not release and not track:
-            tracks = []
-        else:
-            tracks = self._select_simple(fields, from_tables, where,
-                                   fetchone = False, orderby = order_by)
-        #log.debug(self.debug_db(tracks))
-        return tracks
+        return self._select_simple(fields, from_tables, where,
+                                   fetchone = False, orderby = order_by,
+                                   params = params)
 
     def upsert_track(self, release_id, track_no, track_name, track_artist):
-        track_no = track_no.upper() # always save uppercase track numbers
-        try:
-            sql_i='''INSERT INTO track(d_release_id, d_track_no, d_artist,
-                        d_track_name, import_timestamp)
-                        VALUES(?, ?, ?, ?, datetime('now', 'localtime'));'''
-            tuple_i = (release_id, track_no, track_artist, track_name)
-            return self.execute_sql(sql_i, tuple_i, raise_err=True)
-        except sqlerr as e:
-            if "UNIQUE constraint failed" in e.args[0]:
-                log.debug("Track already in DiscoBASE, updating ...")
-                try:
-                    sql_u='''UPDATE track SET
-                                d_artist = ?, d_track_name = ?,
-                                import_timestamp=datetime('now', 'localtime')
-                                WHERE d_release_id = ? AND d_track_no = ?;'''
-                    tuple_u = (track_artist, track_name, release_id, track_no)
-                    return self.execute_sql(sql_u, tuple_u, raise_err=True)
-                except sqlerr as e:
-                    log.error("MODEL: upsert_track: %s", e.args[0])
-                    return False
-            else:
-                log.error("MODEL: %s", e.args[0])
-                return False
+        return self.upsert_tracks(release_id, [(track_no, track_name, track_artist)])
+
+    def upsert_tracks(self, release_id, tracks):
+        '''batch version of upsert_track: takes a list of
+           (track_no, track_name, track_artist) tuples of one release and
+           inserts or updates them with one executemany statement.
+           Returns count of tracks or False on errors.'''
+        sql_upsert = '''INSERT INTO track(d_release_id, d_track_no, d_artist,
+                d_track_name, import_timestamp)
+                VALUES(?, ?, ?, ?, datetime('now', 'localtime'))
+                ON CONFLICT (d_release_id, d_track_no) DO UPDATE SET
+                    d_artist = excluded.d_artist,
+                    d_track_name = excluded.d_track_name,
+                    import_timestamp = excluded.import_timestamp;'''
+        # always save uppercase track numbers
+        tuples_upsert = [(release_id, track_no.upper(), track_artist, track_name)
+                         for track_no, track_name, track_artist in tracks]
+        if self.execute_many(sql_upsert, tuples_upsert) is False:
+            return False
+        return len(tracks)
 
     def search_release_id(self, release_id):
         return self._select_simple(['*'], 'release',
-            'discogs_id == {}'.format(release_id), fetchone = True)
+            'discogs_id == ?', fetchone = True, params = (release_id, ))
 
     def create_release(self, release_id, release_title, release_artists, d_catno, d_coll = False):
+        # MusicBrainz fields of existing releases are kept
+        sql_upsert = '''INSERT INTO release(discogs_id, discogs_title,
+                import_timestamp, d_artist, in_d_collection, d_catno)
+                VALUES(?, ?, ?, ?, ?, ?)
+                ON CONFLICT (discogs_id) DO UPDATE SET
+                    discogs_title = excluded.discogs_title,
+                    import_timestamp = excluded.import_timestamp,
+                    d_artist = excluded.d_artist,
+                    in_d_collection = excluded.in_d_collection,
+                    d_catno = excluded.d_catno;'''
+        tuple_upsert = (release_id, release_title,
+                datetime.today().isoformat(' ', 'seconds'), release_artists,
+                d_coll, d_catno)
+        return self.execute_sql(sql_upsert, tuple_upsert)
+
+    def get_releases_import_state(self):
+        '''returns a dict of discogs_id -> sqlite3.Row containing
+           import_timestamp and tracks (count of tracks in DiscoBASE)'''
+        rows = self._select('''SELECT discogs_id, import_timestamp,
+            (SELECT COUNT(*) FROM track WHERE d_release_id = discogs_id) AS tracks
+            FROM release;''')
+        return {row['discogs_id']: row for row in rows}
+
+    def release_needs_import(self, import_state, date_added, tracks=False):
+        '''decides if a release from the Discogs collection listing has to be
+           (re-)imported. import_state is a row of get_releases_import_state
+           (None if the release is not in the DiscoBASE), date_added comes
+           from the collection item'''
+        if not import_state or not import_state['import_timestamp']:
+            return True
+        if tracks and not import_state['tracks']:
+            return True
+        if not date_added:
+            return False
+        if isinstance(date_added, str):
+            date_added = datetime.fromisoformat(date_added)
+        if date_added.tzinfo: # import_timestamp is naive localtime
+            date_added = date_added.astimezone().replace(tzinfo=None)
         try:
-            insert_sql = '''INSERT OR FAIL INTO release(discogs_id, discogs_title,
-                                    import_timestamp, d_artist, in_d_collection, d_catno)
-                                    VALUES(?, ?, ?, ?, ?, ?)'''
-            in_tuple = (release_id, release_title, datetime.today().isoformat(' ', 'seconds'),
-                    release_artists, d_coll, d_catno)
-            return self.execute_sql(insert_sql, in_tuple, raise_err = True)
-        except sqlerr as e:
-            if "UNIQUE constraint failed" in e.args[0]:
-                log.debug("Release already in DiscoBASE, updating ...")
-                try:
-                    upd_sql = '''UPDATE release SET (discogs_title,
-                        import_timestamp, d_artist, in_d_collection, d_catno)
-                        = (?, ?, ?, ?, ?) WHERE discogs_id == ?;'''
-                    upd_tuple = (release_title, datetime.today().isoformat(' ', 'seconds'),
-                        release_artists, d_coll, d_catno, release_id)
-                    return self.execute_sql(upd_sql, upd_tuple, raise_err = True)
-                except sqlerr as e:
-                    log.error("MODEL: create_release: %s", e.args[0])
-                    return False
-            else:
-                log.error("MODEL: %s", e.args[0])
-                return False
+            imported = datetime.fromisoformat(import_state['import_timestamp'])
+        except ValueError:
+            log.warning("MODEL: Unknown import_timestamp format: {}".format(
+                import_state['import_timestamp']))
+            return True
+        return imported < date_added
+
+    def set_releases_not_in_d_collection(self, d_coll_ids):
+        '''marks all releases not in the given set of Discogs collection
+           release IDs as not in_d_collection. Returns count of changed.'''
+        rows = self._select_simple(['discogs_id'], 'release',
+                                   condition = 'in_d_collection == 1')
+        removed = [(row['discogs_id'], ) for row in rows
+                   if row['discogs_id'] not in d_coll_ids]
+        if not removed:
+            return 0
+        for (rel_id, ) in removed:
+            log.info("MODEL: Release {} not in Discogs collection anymore.".format(
+                rel_id))
+        self.execute_many('''UPDATE release SET in_d_collection = 0
+                               WHERE discogs_id == ?;''', removed)
+        return len(removed)
+
+    def d_release_import_data(self, d_release, tracks=False):
+        '''fetches everything import_collection needs from a discogs_client
+           Release object and returns it as a dict of plain data. Doesn't touch
+           the database, thus can be run in worker threads.
+           tracks is a list of (track_no, track_name, track_artist) tuples,
+           error is set if the tracklist couldn't be fetched.'''
+        d_artists = d_release.artists
+        rel = {
+            'id': d_release.id,
+            'title': d_release.title,
+            'artists': self.d_artists_to_str(d_artists),
+            'catno': self.d_get_first_catno(d_release.labels),
+            'tracks': [],
+            'error': None,
+        }
+        if tracks:
+            try:
+                tracklist = d_release.tracklist
+                for track in tracklist:
+                    rel['tracks'].append((track.position, track.title,
+                        self.d_artists_parse(tracklist, track.position, d_artists)))
+            except Exception as Exc:
+                rel['error'] = Exc
+        return rel
 
     def get_d_release(self, release_id, catch = True):
         try:
@@ -969,6 +1631,15 @@ class Collection (Database):
             return False
 
     def is_in_d_coll(self, release_id):
+        '''checks the local Discogs collection index (see
+           refresh_d_collection_index), walks the collection on Discogs only if
+           the DiscoBASE schema is too old for it. Returns a truthy value if
+           the release is in the Discogs collection.'''
+        if self.schema_at_least(7):
+            self.refresh_d_collection_index()
+            return self._select_simple(['instance_id', 'd_release_id',
+                'folder_id', 'date_added'], 'd_collection', 'd_release_id == ?',
+                fetchone = True, params = (release_id, ))
         #successful = False
         for r in self.me.collection_folders[0].releases:
             #self.rate_limit_slow_downer(d, remaining=5, sleep=2)
@@ -976,28 +1647,131 @@ class Collection (Database):
                 return r
         return False
 
-    def rate_limit_slow_downer(self, remaining=10, sleep=2):
-        '''Discogs util: stay in 60/min rate limit'''
-        if int(self.d._fetcher.rate_limit_remaining) < remaining:
-            log.info(
-             "Discogs request rate limit is about to exceed, let's wait a little: %s",
-                          self.d._fetcher.rate_limit_remaining)
-            #while int(self.d._fetcher.rate_limit_remaining) < remaining:
-            time.sleep(sleep)
-        else:
-            log.info("Discogs rate limit: %s remaining.",
-                          self.d._fetcher.rate_limit_remaining)
+    def _d_coll_index_row(self, item):
+        '''d_collection row of a Discogs collection listing item'''
+        date_added = item.date_added
+        if isinstance(date_added, datetime):
+            date_added = date_added.isoformat()
+        return (item.instance_id, item.release.id, item.folder_id, date_added)
+
+    def replace_d_collection_index(self, items):
+        '''replaces the local Discogs collection index with the given
+           collection listing items (a complete listing!) and timestamps it'''
+        with self.transaction():
+            self.execute_sql('DELETE FROM d_collection;')
+            self.execute_many('''INSERT OR REPLACE INTO d_collection
+                (instance_id, d_release_id, folder_id, date_added)
+                VALUES (?, ?, ?, ?);''', [self._d_coll_index_row(item)
+                                          for item in items])
+            self._d_coll_index_refreshed()
+        log.info("MODEL: Discogs collection index holds {} items.".format(
+            len(items)))
+
+    def _d_coll_index_refreshed(self):
+        self.execute_sql('''INSERT OR REPLACE INTO meta (key, value)
+            VALUES ('d_collection_refreshed', datetime('now', 'localtime'));''')
+
+    def expire_d_collection_index(self):
+        '''makes the next is_in_d_coll refresh the index, eg. after adding
+           a release to the Discogs collection'''
+        if self.schema_at_least(7):
+            self.execute_sql("DELETE FROM meta WHERE key == 'd_collection_refreshed';")
+
+    def refresh_d_collection_index(self, max_age = 1, full = False):
+        '''brings the local index of the Discogs collection (table
+           d_collection) up to date, if it is older than max_age hours.
+           The collection listing is walked newest first and only until an
+           already known item shows up, usually that's a single request. If
+           the item counts don't add up then (something was removed on
+           Discogs), or if full is set, the whole listing is fetched.'''
+        fresh = self._select_simple(['value'], 'meta',
+            "key == 'd_collection_refreshed' AND value > datetime('now', 'localtime', ?)",
+            fetchone = True, params = ('-{} hours'.format(max_age), ))
+        if fresh and not full:
+            log.info("MODEL: Discogs collection index is up to date.")
+            return True
+        listing = self.me.collection_folders[0].releases
+        listing.per_page = 100 # max. allowed, saves listing requests
+        if not full:
+            known_count = self._select_simple(['COUNT(*)'], 'd_collection',
+                fetchone = True)[0]
+            new_items = []
+            for item in listing.sort('added', 'desc'):
+                if self._select_simple(['instance_id'], 'd_collection',
+                        'instance_id == ?', fetchone = True,
+                        params = (item.instance_id, )):
+                    break
+                new_items.append(item)
+            if known_count + len(new_items) == listing.count:
+                log.info("MODEL: {} new items in Discogs collection.".format(
+                    len(new_items)))
+                with self.transaction():
+                    self.execute_many('''INSERT OR REPLACE INTO d_collection
+                        (instance_id, d_release_id, folder_id, date_added)
+                        VALUES (?, ?, ?, ?);''', [self._d_coll_index_row(item)
+                                                  for item in new_items])
+                    self._d_coll_index_refreshed()
+                return True
+            log.info("MODEL: Discogs collection changed, refreshing index completely.")
+            listing.sort('added', 'asc')
+        self.replace_d_collection_index(list(listing))
+        return True
+
+    def get_unfinished_job(self, kind, params):
+        '''latest job of this kind, started with the same params, that did
+           not finish (eg. was interrupted)'''
+        return self._select_simple(['job_id', 'started'], 'job',
+            'kind == ? AND params == ? AND finished IS NULL', fetchone = True,
+            orderby = 'job_id DESC',
+            params = (kind, json.dumps(params, sort_keys = True)))
+
+    def start_job(self, kind, params):
+        '''records a new long-running job (params is a dict of its options),
+           returns its ID'''
+        if not self.execute_sql('''INSERT INTO job (kind, params, started)
+                VALUES (?, ?, datetime('now', 'localtime'));''',
+                (kind, json.dumps(params, sort_keys = True))):
+            return False
+        return self.lastrowid
+
+    def finish_job(self, job_id):
+        '''marks the job finished, its item checkpoints aren't needed anymore'''
+        with self.transaction():
+            self.execute_sql('''UPDATE job SET finished = datetime('now', 'localtime')
+                WHERE job_id == ?;''', (job_id, ))
+            self.execute_sql('DELETE FROM job_item WHERE job_id == ?;', (job_id, ))
+
+    @staticmethod
+    def job_item_key(release_id, track_no = None):
+        '''items are releases, or tracks of releases'''
+        if track_no is None:
+            return str(release_id)
+        return '{}/{}'.format(release_id, track_no)
+
+    def job_item_done(self, job_id, item_key):
+        '''checkpoint: the item won't be processed again when the job
+           is continued'''
+        if not job_id:
+            return False
+        return self.execute_sql('''INSERT OR IGNORE INTO job_item
+            (job_id, item_key, done_time)
+            VALUES (?, ?, datetime('now', 'localtime'));''', (job_id, item_key))
+
+    def get_job_done_items(self, job_id):
+        rows = self._select_simple(['item_key'], 'job_item', 'job_id == ?',
+            fetchone = False, params = (job_id, ))
+        return {row['item_key'] for row in rows}
 
     def track_report_snippet(self, track_pos, mix_id):
-        track_pos_before = track_pos - 1
-        track_pos_after = track_pos + 1
-        sql_sel = '''SELECT track_pos, discogs_title, track.d_artist, d_track_name,
-                           mix_track.d_track_no,
+        '''the track at track_pos of a mix and the ones before and after it.
+           Positions are numbered at read time like in Mix.get_full_mix.'''
+        sql_sel = '''SELECT numbered.pos AS track_pos, discogs_title,
+                           track.d_artist, d_track_name, mix_track.d_track_no,
                            key, bpm, key_notes, trans_rating, trans_notes, notes,
                            a_key, a_chords_key, a_bpm FROM'''
         sql_sel+='''
-                           mix_track INNER JOIN mix
-                             ON mix.mix_id = mix_track.mix_id
+                           {} INNER JOIN mix_track
+                             ON mix_track.mix_track_id = numbered.mix_track_id
                                INNER JOIN release
                                ON mix_track.d_release_id = release.discogs_id
                                  LEFT OUTER JOIN track
@@ -1006,11 +1780,10 @@ class Collection (Database):
                                    LEFT OUTER JOIN track_ext
                                    ON mix_track.d_release_id = track_ext.d_release_id
                                    AND mix_track.d_track_no = track_ext.d_track_no
-                       WHERE (mix_track.track_pos == "{}" OR mix_track.track_pos == "{}"
-                             OR mix_track.track_pos == "{}") AND mix_track.mix_id == "{}"
-                       ORDER BY mix_track.track_pos'''.format(
-                               track_pos, track_pos_before, track_pos_after, mix_id)
-        tracks_snippet = self._select(sql_sel, fetchone = False)
+                       WHERE numbered.pos BETWEEN ? AND ?
+                       ORDER BY numbered.pos'''.format(Mix._numbered)
+        tracks_snippet = self._select(sql_sel, fetchone = False, params = (
+            mix_id, track_pos - 1, track_pos + 1))
         if not tracks_snippet:
             return False
         else:
@@ -1019,13 +1792,69 @@ class Collection (Database):
             return tracks_snippet
 
     def track_report_occurences(self, release_id, track_no):
+        '''mixes a track was played in and its (read time numbered) position'''
         occurences_data = self._select_simple(
-                ['track_pos', 'mix_track.mix_id', 'mix.name'],
-                 'mix_track INNER JOIN MIX ON mix.mix_id = mix_track.mix_id',
-                 'd_release_id == "{}" AND d_track_no == "{}"'.format(release_id, track_no))
+                ['pos AS track_pos', 'numbered.mix_id', 'mix.name'],
+                '''(SELECT mix_id, d_release_id, d_track_no,
+                     ROW_NUMBER() OVER (PARTITION BY mix_id
+                       ORDER BY track_pos, mix_track_id) AS pos
+                   FROM mix_track WHERE mix_id IN (
+                     SELECT mix_id FROM mix_track
+                       WHERE d_release_id == ? AND d_track_no == ?)) AS numbered
+                   INNER JOIN mix ON mix.mix_id = numbered.mix_id''',
+                 'd_release_id == ? AND d_track_no == ?',
+                 orderby = 'numbered.mix_id, pos',
+                 params = (release_id, track_no, release_id, track_no))
         log.info("MODEL: Returning track_report_occurences data.")
         return occurences_data
 
+    def track_report_snippets(self, release_id, track_no):
+        '''all occurences of a track in mixes including the tracks played
+           before and after it, fetched in one query. LAG/LEAD find the
+           neighbours, track positions are numbered per mix like in
+           Mix.get_full_mix. Rows are ordered by mix and occurence;
+           occurence_pos groups the rows of one snippet.'''
+        sql_sel = '''WITH numbered AS (
+                       SELECT mix_track_id, mix_id, d_release_id, d_track_no,
+                         ROW_NUMBER() OVER mix_order AS pos,
+                         LAG(mix_track_id) OVER mix_order AS prev_id,
+                         LEAD(mix_track_id) OVER mix_order AS next_id
+                       FROM mix_track WHERE mix_id IN (
+                         SELECT mix_id FROM mix_track
+                           WHERE d_release_id == ? AND d_track_no == ?)
+                       WINDOW mix_order AS (PARTITION BY mix_id
+                         ORDER BY track_pos, mix_track_id)),
+                     occurences AS (
+                       SELECT pos, prev_id, mix_track_id, next_id
+                       FROM numbered
+                       WHERE d_release_id == ? AND d_track_no == ?)
+                     SELECT numbered.mix_id, mix.name,
+                           occurences.pos AS occurence_pos,
+                           numbered.pos AS track_pos, discogs_title, track.d_artist,
+                           d_track_name, mix_track.d_track_no,
+                           key, bpm, key_notes, trans_rating, trans_notes, notes,
+                           a_key, a_chords_key, a_bpm FROM
+                           occurences INNER JOIN numbered
+                             ON numbered.mix_track_id IN (occurences.prev_id,
+                               occurences.mix_track_id, occurences.next_id)
+                             INNER JOIN mix_track
+                             ON mix_track.mix_track_id = numbered.mix_track_id
+                               INNER JOIN mix
+                               ON mix.mix_id = mix_track.mix_id
+                                 INNER JOIN release
+                                 ON mix_track.d_release_id = release.discogs_id
+                                   LEFT OUTER JOIN track
+                                   ON mix_track.d_release_id = track.d_release_id
+                                   AND mix_track.d_track_no = track.d_track_no
+                                     LEFT OUTER JOIN track_ext
+                                     ON mix_track.d_release_id = track_ext.d_release_id
+                                     AND mix_track.d_track_no = track_ext.d_track_no
+                       ORDER BY numbered.mix_id, occurences.pos, numbered.pos'''
+        snippets = self._select(sql_sel, fetchone = False, params = (
+            release_id, track_no, release_id, track_no))
+        log.info("MODEL: Returning track_report_snippets data.")
+        return snippets
+
     def d_artists_to_str(self, d_artists):
         '''gets a combined string from discogs artistlist object'''
         artist_str=''
@@ -1095,136 +1924,112 @@ class Collection (Database):
     def get_tracks_by_bpm(self, bpm, pitch_range):
         min_bpm = bpm - (bpm / 100 * pitch_range)
         max_bpm = bpm + (bpm / 100 * pitch_range)
-        sql_bpm = '''
-          SELECT discogs_title, d_catno, track.d_artist, d_track_name,
-              track.d_track_no, key_notes, notes,
-            CASE
-                WHEN track_ext.bpm IS NOT NULL
-                    THEN round(track_ext.bpm, 1)
-                WHEN track.a_bpm IS NOT NULL
-                    THEN round(track.a_bpm, 1)
-            END AS chosen_bpm,
-            CASE
-                WHEN track_ext.key IS NOT NULL
-                    THEN track_ext.key
-                WHEN track.a_key IS NOT NULL
-                    THEN track.a_key
-            END AS chosen_key,
-            CASE
-                WHEN track.a_chords_key IS NOT NULL
-                    THEN round(track.a_chords_key, 1)
-            END AS chosen_chords_key
-            FROM release LEFT OUTER JOIN track
-                ON release.discogs_id = track.d_release_id
-                    INNER JOIN track_ext
-                    ON track.d_release_id = track_ext.d_release_id
-                    AND track.d_track_no = track_ext.d_track_no
-            WHERE
-                (chosen_bpm >= {} AND chosen_bpm <= {})
-                OR (chosen_bpm >= "{}" AND chosen_bpm <= "{}")
-            ORDER BY chosen_key, chosen_bpm'''.format(
-              min_bpm, max_bpm, min_bpm, max_bpm)
-                    #THEN trim(track_ext.bpm, '.0')
-                    #THEN trim(round(track.a_bpm, 0), '.0')
-        return self._select(sql_bpm, fetchone = False)
+        return self._get_tracks_by_chosen(
+            '{bpm} >= ? AND {bpm} <= ?', (min_bpm, max_bpm))
 
     def get_tracks_by_key(self, key):
         #prev_key = "" # future music ;-) when we have key-translation-table
         #next_key = ""
-        sql_key = '''
-          SELECT discogs_title, d_catno, track.d_artist, d_track_name,
-            track.d_track_no, key_notes, notes,
-            CASE
-                WHEN track_ext.bpm IS NOT NULL
-                    THEN round(track_ext.bpm, 1)
-                WHEN track.a_bpm IS NOT NULL
-                    THEN round(track.a_bpm, 1)
-            END AS chosen_bpm,
-            CASE
-                WHEN track_ext.key IS NOT NULL
-                    THEN track_ext.key
-                WHEN track.a_key IS NOT NULL
-                    THEN track.a_key
-            END AS chosen_key,
-            CASE
-                WHEN track.a_chords_key IS NOT NULL
-                    THEN round(track.a_chords_key, 1)
-            END AS chosen_chords_key
-                FROM release LEFT OUTER JOIN track
-                    ON release.discogs_id = track.d_release_id
-                        INNER JOIN track_ext
-                        ON track.d_release_id = track_ext.d_release_id
-                        AND track.d_track_no = track_ext.d_track_no
-            WHERE
-                chosen_key LIKE "%{}%"
-            ORDER BY chosen_key, chosen_bpm'''.format(key)
-                   # THEN trim(round(track.a_bpm, 0), '.0')
-                   # THEN round(track_ext.bpm, 0)
-        return self._select(sql_key, fetchone = False)
+        return self._get_tracks_by_chosen(
+            '{key} LIKE ?', ('%{}%'.format(key), ))
 
     def get_tracks_by_key_and_bpm(self, key, bpm, pitch_range):
         min_bpm = bpm - (bpm / 100 * pitch_range)
         max_bpm = bpm + (bpm / 100 * pitch_range)
-        sql_bpm = '''
+        return self._get_tracks_by_chosen(
+            '{bpm} >= ? AND {bpm} <= ? AND {key} LIKE ?',
+            (min_bpm, max_bpm, '%{}%'.format(key)))
+
+    def get_tracks_by_harmonic_key(self, key, bpm = False, pitch_range = 6):
+        '''returns tracks in keys that are harmonically compatible with the
+           given one: same, +1/-1 on the Camelot wheel, relative major/minor
+           and energy boost (+2). Optionally within a BPM range.
+           Needs schema version 6, returns an empty list otherwise.'''
+        code = camelot(key)
+        if not code or not self.schema_at_least(6):
+            log.error("MODEL: get_tracks_by_harmonic_key: unknown key %s or "
+                      "DiscoBASE schema too old.", key)
+            return []
+        where = '''track.chosen_camelot IN (
+            SELECT compatible FROM camelot_compat WHERE camelot = ?)'''
+        params = (code, )
+        if bpm:
+            where += ' AND {bpm} >= ? AND {bpm} <= ?'
+            params += (bpm - (bpm / 100 * pitch_range),
+                       bpm + (bpm / 100 * pitch_range))
+        return self._get_tracks_by_chosen(where, params,
+            order_by = 'track.chosen_camelot, {bpm}')
+
+    def _get_tracks_by_chosen(self, where, params, order_by = '{key}, {bpm}'):
+        '''common select of the get_tracks_by_* methods. where references
+           the effective BPM and key as {bpm} and {key}: User-entered values
+           in track_ext win over AcousticBrainz ones. Since schema version 5
+           they are stored in track.chosen_bpm/chosen_key and indexed.'''
+        if self.schema_at_least(5):
+            bpm, key = 'track.chosen_bpm', 'track.chosen_key'
+        else:
+            bpm = 'round(coalesce(track_ext.bpm, track.a_bpm), 1)'
+            key = 'coalesce(track_ext.key, track.a_key)'
+        if self.schema_at_least(6):
+            camelot_field = 'track.chosen_camelot'
+        else:
+            camelot_field = 'NULL'
+        sql_chosen = '''
           SELECT discogs_title, d_catno, track.d_artist, d_track_name,
               track.d_track_no, key_notes, notes,
-            CASE
-                WHEN track_ext.bpm IS NOT NULL
-                    THEN round(track_ext.bpm, 1)
-                WHEN track.a_bpm IS NOT NULL
-                    THEN round(track.a_bpm, 1)
-            END AS chosen_bpm,
-            CASE
-                WHEN track_ext.key IS NOT NULL
-                    THEN track_ext.key
-                WHEN track.a_key IS NOT NULL
-                    THEN track.a_key
-            END AS chosen_key,
-            CASE
-                WHEN track.a_chords_key IS NOT NULL
-                    THEN round(track.a_chords_key, 1)
-            END AS chosen_chords_key
-            FROM release LEFT OUTER JOIN track
+              {bpm} AS chosen_bpm,
+              {key} AS chosen_key,
+              {camelot} AS chosen_camelot,
+              round(track.a_chords_key, 1) AS chosen_chords_key
+            FROM track INNER JOIN release
                 ON release.discogs_id = track.d_release_id
-                    INNER JOIN track_ext
+                    LEFT OUTER JOIN track_ext
                     ON track.d_release_id = track_ext.d_release_id
                     AND track.d_track_no = track_ext.d_track_no
-            WHERE (chosen_bpm >= {} AND chosen_bpm <= {}
-                  OR (chosen_bpm >= "{}" AND chosen_bpm <= "{}")
-                   AND chosen_key LIKE "%{}%")
-            ORDER BY chosen_key, chosen_bpm'''.format(min_bpm, max_bpm,
-              min_bpm, max_bpm, key)
-        return self._select(sql_bpm, fetchone = False)
+            WHERE {where}
+            ORDER BY {order_by}'''.format(bpm = bpm, key = key,
+                camelot = camelot_field,
+                where = where.format(bpm = bpm, key = key),
+                order_by = order_by.format(bpm = bpm, key = key))
+        return self._select(sql_chosen, fetchone = False, params = params)
 
     def upsert_track_brainz(self, release_id, track_no, rec_id,
-          match_method, key, chords_key, bpm):
+          match_method, key, chords_key, bpm, accbr = True):
+        '''accbr: also write the AcousticBrainz fields. False leaves them
+           as they are, eg. when update_tracks_accbr writes them later.'''
         track_no = track_no.upper() # always save uppercase track numbers
-        try:
-            sql_i = '''INSERT INTO track(d_release_id, d_track_no,
-                  m_rec_id, m_match_method, m_match_time, a_key, a_chords_key, a_bpm)
-                  VALUES(?, ?, ?, ?, datetime('now', 'localtime'), ?, ?, ?);'''
-            tuple_i = (release_id, track_no, rec_id, match_method, key,
-                  chords_key, bpm)
-            return self.execute_sql(sql_i, tuple_i, raise_err=True)
-        except sqlerr as e:
-            if "UNIQUE constraint failed" in e.args[0]:
-                log.debug("Track already in DiscoBASE, updating ...")
-                try:
-                    sql_u = ''' UPDATE track SET
-                          m_rec_id=?, m_match_method=?,
-                          m_match_time=datetime('now', 'localtime'),
-                          a_key=?, a_chords_key=?, a_bpm=?
-                          WHERE d_release_id=? AND d_track_no=?; 
-                          '''
-                    tuple_u = (rec_id, match_method, key, chords_key, bpm,
-                          release_id, track_no)
-                    return self.execute_sql(sql_u, tuple_u)
-                except sqlerr as e:
-                    log.error("MODEL: create_release: %s", e.args[0])
-                    return False
-            else:
-                log.error("MODEL: %s", e.args[0])
-                return False
+        if not accbr:
+            sql_upsert = '''INSERT INTO track(d_release_id, d_track_no,
+                  m_rec_id, m_match_method, m_match_time)
+                  VALUES(?, ?, ?, ?, datetime('now', 'localtime'))
+                  ON CONFLICT (d_release_id, d_track_no) DO UPDATE SET
+                      m_rec_id = excluded.m_rec_id,
+                      m_match_method = excluded.m_match_method,
+                      m_match_time = excluded.m_match_time;'''
+            return self.execute_sql(sql_upsert,
+                (release_id, track_no, rec_id, match_method))
+        sql_upsert = '''INSERT INTO track(d_release_id, d_track_no,
+              m_rec_id, m_match_method, m_match_time, a_key, a_chords_key, a_bpm)
+              VALUES(?, ?, ?, ?, datetime('now', 'localtime'), ?, ?, ?)
+              ON CONFLICT (d_release_id, d_track_no) DO UPDATE SET
+                  m_rec_id = excluded.m_rec_id,
+                  m_match_method = excluded.m_match_method,
+                  m_match_time = excluded.m_match_time,
+                  a_key = excluded.a_key,
+                  a_chords_key = excluded.a_chords_key,
+                  a_bpm = excluded.a_bpm;'''
+        tuple_upsert = (release_id, track_no, rec_id, match_method, key,
+              chords_key, bpm)
+        return self.execute_sql(sql_upsert, tuple_upsert)
+
+    def update_tracks_accbr(self, accbr_rows):
+        '''takes a list of (key, chords_key, bpm, release_id, track_no) tuples
+           and writes the AcousticBrainz fields of all tracks in one go'''
+        sql_upd = '''UPDATE track SET a_key = ?, a_chords_key = ?, a_bpm = ?
+                       WHERE d_release_id = ? AND d_track_no = ?;'''
+        tuples_upd = [(key, chords_key, bpm, release_id, track_no.upper())
+                      for key, chords_key, bpm, release_id, track_no in accbr_rows]
+        return self.execute_many(sql_upd, tuples_upd)
 
     def update_release_brainz(self, release_id, mbid, match_method):
         sql_upd = '''UPDATE release SET (m_rel_id, m_match_method,
@@ -1271,29 +2076,122 @@ class Collection (Database):
             log.info('MODEL: Found Discogs CatNo(s) "{}"'.format(catno_str))
         return catno_str
 
-    def get_all_tracks_for_brainz_update(self, offset=0):
+    def get_all_tracks_for_brainz_update(self, offset=0, max_age=0,
+          missing_only=False, detail=0):
+        '''max_age: only tracks never matched or matched more than max_age
+           days ago. missing_only: only tracks that have a Recording MBID
+           but no AcousticBrainz BPM. Both skip releases without tracks.
+           detail: skip tracks that failed to match with this or a higher
+           detail level, until their back-off expired or their data changed
+           (see record_brainz_fail).'''
         log.info(
            "MODEL: Getting _all_ tracks in DiscoBASE. Preparing for AcousticBrainz update.")
         if offset > 0:
-            log.info('MODEL: Subtract 1 from offset (eg --resume 1 should not alter anything')
+            log.info('MODEL: Subtract 1 from offset (--resume counts from 1)')
             offset = offset - 1
-        tables = '''release
+        fields = ['release.discogs_id',
+              'track.d_release_id', 'discogs_title', 'd_catno',
+              'track.d_artist', 'track.d_track_name', 'track.d_track_no',
+              'track.m_rec_id', 'track_ext.m_rec_id_override']
+        if not max_age and not missing_only:
+            tables = '''release
                       LEFT OUTER JOIN track
-                      ON release.discogs_id = track.d_release_id
+                      ON release.discogs_id = track.d_release_id'''
+        else: # candidates are found via indexes on track (schema version 9)
+            tables = '''track
+                      INNER JOIN release
+                      ON track.d_release_id = release.discogs_id'''
+        tables+= '''
                         LEFT OUTER JOIN track_ext
                         ON track.d_release_id = track_ext.d_release_id
                         AND track.d_track_no = track_ext.d_track_no'''
-        return self._select_simple(['release.discogs_id',
-              'track.d_release_id', 'discogs_title', 'd_catno',
-              'track.d_artist', 'track.d_track_name', 'track.d_track_no',
-              'track_ext.m_rec_id_override'], tables, condition=False,
-               fetchone=False, orderby='release.discogs_id', offset=offset)
+        conditions, params = [], []
+        if missing_only:
+            conditions.append('track.m_rec_id IS NOT NULL AND track.a_bpm IS NULL')
+        if max_age: # an OR here has SQLite scan release, look up each part
+            conditions.append('''track.rowid IN (
+                SELECT rowid FROM track WHERE m_match_time IS NULL
+                UNION ALL
+                SELECT rowid FROM track
+                  WHERE m_match_time < datetime('now', 'localtime', ?))''')
+            params.append('-{} days'.format(max_age))
+        if detail: # brainz_fails: failed before, asks *Brainz again
+            fields.append('brainz_fail.fail_count AS brainz_fails')
+            tables+= '''
+                          LEFT OUTER JOIN brainz_fail
+                          ON track.d_release_id = brainz_fail.d_release_id
+                          AND track.d_track_no = brainz_fail.d_track_no'''
+            conditions.append('''(brainz_fail.retry_after IS NULL
+                OR brainz_fail.retry_after <= datetime('now', 'localtime')
+                OR brainz_fail.detail < ?
+                OR brainz_fail.d_fingerprint IS NOT {})'''.format(
+                    self._brainz_fingerprint))
+            params.append(detail)
+        if not max_age and not missing_only:
+            orderby = 'release.discogs_id, track.d_track_no'
+        else: # the same order, but don't tempt SQLite to start at release
+            orderby = 'track.d_release_id, track.d_track_no'
+        return self._select_simple(fields, tables,
+               ' AND '.join(conditions) or False, fetchone=False,
+               orderby=orderby, offset=offset, params=params)
+
+    def count_brainz_fails_backed_off(self, detail):
+        '''tracks get_all_tracks_for_brainz_update(detail=detail) skips'''
+        return self._select_simple(['COUNT(*)'], '''brainz_fail
+                  INNER JOIN release
+                  ON brainz_fail.d_release_id = release.discogs_id
+                    LEFT OUTER JOIN track
+                    ON brainz_fail.d_release_id = track.d_release_id
+                    AND brainz_fail.d_track_no = track.d_track_no
+                      LEFT OUTER JOIN track_ext
+                      ON brainz_fail.d_release_id = track_ext.d_release_id
+                      AND brainz_fail.d_track_no = track_ext.d_track_no''',
+            '''brainz_fail.retry_after > datetime('now', 'localtime')
+               AND brainz_fail.detail >= ?
+               AND brainz_fail.d_fingerprint IS {}'''.format(
+                   self._brainz_fingerprint),
+            fetchone = True, params = (detail, ))[0]
+
+    def record_brainz_fail(self, release_id, track_no, reason, detail):
+        '''remembers that matching a track failed (reason: no_release,
+           no_recording or no_accbr). Each further failure with unchanged
+           DiscoBASE data doubles the time until the next retry.'''
+        sql_fail = '''INSERT INTO brainz_fail (d_release_id, d_track_no,
+              reason, detail, d_fingerprint, fail_count, last_fail, retry_after)
+            SELECT release.discogs_id, ?, ?, ?, {fingerprint}, 1,
+              datetime('now', 'localtime'),
+              datetime('now', 'localtime', '+' || ? || ' days')
+            FROM release LEFT OUTER JOIN track
+              ON release.discogs_id = track.d_release_id AND track.d_track_no == ?
+                LEFT OUTER JOIN track_ext
+                ON release.discogs_id = track_ext.d_release_id
+                AND track_ext.d_track_no == ?
+            WHERE release.discogs_id == ?
+            ON CONFLICT (d_release_id, d_track_no) DO UPDATE SET
+              reason = excluded.reason,
+              detail = excluded.detail,
+              fail_count = CASE WHEN d_fingerprint IS excluded.d_fingerprint
+                THEN fail_count + 1 ELSE 1 END,
+              last_fail = excluded.last_fail,
+              retry_after = datetime('now', 'localtime', '+' || min(? << CASE
+                WHEN d_fingerprint IS excluded.d_fingerprint
+                THEN min(fail_count, 10) ELSE 0 END, ?) || ' days'),
+              d_fingerprint = excluded.d_fingerprint;'''.format(
+                  fingerprint = self._brainz_fingerprint)
+        track_no = track_no.upper() # always save uppercase track numbers
+        return self.execute_sql(sql_fail, (track_no, reason, detail,
+            self.brainz_backoff_days, track_no, track_no, release_id,
+            self.brainz_backoff_days, self.brainz_backoff_max_days))
+
+    def clear_brainz_fail(self, release_id, track_no):
+        return self.execute_sql('''DELETE FROM brainz_fail
+            WHERE d_release_id == ? AND d_track_no == ?;''',
+            (release_id, track_no.upper()))
 
     def get_track_for_brainz_update(self, rel_id, track_no):
         log.info(
            "MODEL: Getting track. Preparing for AcousticBrainz update.")
-        where = 'track.d_release_id == {} AND track.d_track_no == "{}"'.format(
-            rel_id, track_no)
+        where = 'track.d_release_id == ? AND track.d_track_no == ?'
         tables = '''release
                       LEFT OUTER JOIN track
                       ON release.discogs_id = track.d_release_id
@@ -1303,86 +2201,291 @@ class Collection (Database):
         return self._select_simple(['track.d_release_id','discogs_id',
           'discogs_title', 'd_catno', 'track.d_artist', 'track.d_track_name',
           'track.d_track_no', 'track_ext.m_rec_id_override'],
-           tables, condition=where, fetchone=True, orderby='release.discogs_id')
+           tables, condition=where, fetchone=True, orderby='release.discogs_id',
+           params=(rel_id, track_no))
            
 
     def upsert_track_ext(self, orig, edit_answers ):
         track_no = orig['d_track_no'].upper() # always save uppercase track numbers
         release_id = orig['d_release_id']
 
-        fields_ins = ''
-        fields_ins_vals = ''
-        fields_upd = ''
-        values_list = []
-        for key, answer in edit_answers.items():
-            log.debug('key: {}, value: {}'.format(key, answer))
-            # update fields key = ? snippets
-            if fields_upd == '':
-                fields_upd += "{} = ? ".format(key)
-            else:
-                fields_upd += ", {} = ? ".format(key)
-            # insert fields (keys) and values (list of ?)
-            fields_ins += ", {}".format(key)
-            fields_ins_vals += ", ?"
-            values_list.append(answer)
-
         if len(edit_answers) == 0: # only update if necessary
             return True
 
-        try:
-            sql_i='''INSERT INTO track_ext(d_release_id, d_track_no{})
-                        VALUES(?, ?{});'''.format(fields_ins, fields_ins_vals)
-            tuple_i = (release_id, track_no) + tuple(values_list)
-            return self.execute_sql(sql_i, tuple_i, raise_err=True)
-        except sqlerr as e:
-            if "UNIQUE constraint failed" in e.args[0]:
-                log.debug("Track already in DiscoBASE (track_ext), updating ...")
-                try:
-                    sql_u='''
-                     UPDATE track_ext SET {}
-                       WHERE d_release_id = ? AND d_track_no = ?;'''.format(
-                           fields_upd)
-                    tuple_u = tuple(values_list) + (release_id, track_no)
-                    return self.execute_sql(sql_u, tuple_u, raise_err=True)
-                except sqlerr as e:
-                    log.error("MODEL: upsert_track_ext: %s", e.args[0])
-                    return False
-            else:
-                log.error("MODEL: %s", e.args[0])
-                return False
+        fields = list(edit_answers.keys())
+        log.debug('MODEL: upsert_track_ext: {}'.format(edit_answers))
+        sql_upsert = '''INSERT INTO track_ext(d_release_id, d_track_no, {})
+              VALUES(?, ?, {})
+              ON CONFLICT (d_release_id, d_track_no) DO UPDATE SET {};'''.format(
+            ', '.join(fields), ', '.join(['?'] * len(fields)),
+            ', '.join(['{0} = excluded.{0}'.format(f) for f in fields]))
+        tuple_upsert = (release_id, track_no) + tuple(edit_answers.values())
+        return self.execute_sql(sql_upsert, tuple_upsert)
+
+    def get_tracks_for_set_builder(self):
+        '''all tracks with an effective (positive) BPM and a Camelot key.
+           Needs schema version 6, returns an empty list otherwise.'''
+        if not self.schema_at_least(6):
+            log.error("MODEL: get_tracks_for_set_builder: DiscoBASE schema too old.")
+            return []
+        return self._select_simple(['track.d_release_id', 'track.d_track_no',
+          'track.d_artist', 'd_track_name', 'discogs_title', 'd_catno',
+          'chosen_key', 'chosen_camelot', 'chosen_bpm'],
+          'track INNER JOIN release ON release.discogs_id = track.d_release_id',
+          condition = 'chosen_bpm > 0 AND chosen_camelot IS NOT NULL')
+
+    def get_transition_ratings(self):
+        '''all rated transitions ever played in a mix. The trans_rating of a
+           mix track rates the transition from the track before into it.'''
+        return self._select_simple(['from_release_id', 'from_track_no',
+          'd_release_id', 'd_track_no', 'trans_rating'],
+          '''(SELECT d_release_id, d_track_no, trans_rating,
+               LAG(d_release_id) OVER mix_order AS from_release_id,
+               LAG(d_track_no) OVER mix_order AS from_track_no
+             FROM mix_track WINDOW mix_order AS (PARTITION BY mix_id
+               ORDER BY track_pos, mix_track_id))''',
+          condition = '''from_release_id IS NOT NULL
+            AND trans_rating IN ('++', '+', '~', '-', '--')''')
+
+
+class Set_builder (object):
+    '''Proposes a set: an ordered list of tracks starting with a given one.
+
+    Tracks (rows with d_release_id, d_track_no, chosen_camelot and
+    chosen_bpm) are the nodes of a transition graph. An edge leads to every
+    track in a harmonically compatible key within max_drift percent BPM and
+    to tracks that were played next in a mix before. Edges are scored by key
+    relation, BPM difference and past trans_rating values. The edges of a
+    track are looked up via BPM-sorted lists per Camelot code and memoized.
+    A beam search keeps the beam_width best partial sets per step. Each
+    release is used only once, and no track may drift further than
+    max_total_drift percent from the start BPM. Staying in the same key for
+    more than two tracks is penalized, a set should go somewhere.
+    '''
+    key_scores = {'same': 3, '+1': 2, '-1': 2, 'relative': 2, 'boost': 1}
+    same_key_penalty = 2
+    rating_scores = {'++': 2, '+': 1, '~': 0, '-': -1, '--': -2}
+    rating_weight = 2
+    drift_weight = 0.5
+    rated_relation = 'played before'
+
+    def __init__(self, tracks, transitions = [], max_drift = 3,
+                 max_total_drift = 8, beam_width = 20, branching = 4):
+        self.max_drift = max_drift
+        self.max_total_drift = max_total_drift
+        self.beam_width = beam_width
+        self.branching = branching
+        self.tracks = {}
+        by_camelot = {}
+        for track in tracks:
+            if not track['chosen_bpm'] or track['chosen_bpm'] <= 0:
+                continue # no BPM, no drift to compute
+            track_id = (track['d_release_id'], track['d_track_no'])
+            self.tracks[track_id] = track
+            by_camelot.setdefault(track['chosen_camelot'], []).append(
+                (track['chosen_bpm'], track_id))
+        # per Camelot code: a list of BPMs and one of track IDs, same order
+        self.by_camelot = {}
+        for code, bpm_tracks in by_camelot.items():
+            bpm_tracks.sort()
+            self.by_camelot[code] = ([bpm for bpm, _ in bpm_tracks],
+                                     [track_id for _, track_id in bpm_tracks])
+        # average past rating of transitions from one track to another
+        ratings = {}
+        for tr in transitions:
+            from_id = (tr['from_release_id'], tr['from_track_no'])
+            to_id = (tr['d_release_id'], tr['d_track_no'])
+            ratings.setdefault(from_id, {}).setdefault(to_id, []).append(
+                self.rating_scores[tr['trans_rating']])
+        self.rated = {from_id: {to_id: sum(r) / len(r) for to_id, r in to.items()}
+                      for from_id, to in ratings.items()}
+        self.adjacency = {}
+
+    def drift(self, from_bpm, to_bpm):
+        if from_bpm <= 0: # unusable BPM, never a transition
+            return float('inf')
+        return abs(to_bpm - from_bpm) / from_bpm * 100
+
+    def neighbours(self, track_id):
+        '''returns the best scored edges of a track as a list of
+           (score, track_id, relation) tuples, best first. Per key relation
+           only the branching tracks closest in BPM are taken, plus all
+           tracks with a past rating.'''
+        if track_id in self.adjacency:
+            return self.adjacency[track_id]
+        track = self.tracks[track_id]
+        bpm = track['chosen_bpm']
+        low = bpm - bpm / 100 * self.max_drift
+        high = bpm + bpm / 100 * self.max_drift
+        rated = self.rated.get(track_id, {})
+        relations = camelot_neighbours(track['chosen_camelot'])
+        edges = {}
+        def _add_edge(to_id, to_bpm, relation):
+            key_score = self.key_scores.get(relation, 0)
+            edges[to_id] = (key_score + self.rating_weight * rated.get(to_id, 0)
+                - self.drift_weight * self.drift(bpm, to_bpm), to_id, relation)
+        for code, relation in relations.items():
+            if code not in self.by_camelot:
+                continue
+            bpms, track_ids = self.by_camelot[code]
+            # walk outwards from our BPM, closest tracks first
+            below = bisect_left(bpms, bpm) - 1
+            above = below + 1
+            found = 0
+            while found < self.branching:
+                if above < len(bpms) and (below < 0 or
+                        bpms[above] - bpm <= bpm - bpms[below]):
+                    i, above = above, above + 1
+                elif below >= 0:
+                    i, below = below, below - 1
+                else:
+                    break
+                if not low <= bpms[i] <= high:
+                    break
+                if track_ids[i][0] != track_id[0]: # not the same record
+                    _add_edge(track_ids[i], bpms[i], relation)
+                    found += 1
+        for to_id, rating in rated.items(): # what worked before, whatever key
+            if to_id not in self.tracks or to_id[0] == track_id[0]:
+                continue
+            to_track = self.tracks[to_id]
+            relation = relations.get(to_track['chosen_camelot'])
+            if relation is None and rating <= 0:
+                continue
+            if self.drift(bpm, to_track['chosen_bpm']) <= self.max_drift:
+                _add_edge(to_id, to_track['chosen_bpm'],
+                          relation or self.rated_relation)
+        self.adjacency[track_id] = sorted(edges.values(),
+            key = lambda edge: edge[0], reverse = True)
+        return self.adjacency[track_id]
+
+    def build(self, start_id, length):
+        '''returns the best found set of up to length tracks as a list of
+           (track row, relation to the previous track) tuples. Empty list if
+           the start track has no BPM or key.'''
+        if start_id not in self.tracks:
+            log.warning("MODEL: Set_builder: Start track %s has no BPM or key.",
+                        start_id)
+            return []
+        start_bpm = self.tracks[start_id]['chosen_bpm']
+        low = start_bpm - start_bpm / 100 * self.max_total_drift
+        high = start_bpm + start_bpm / 100 * self.max_total_drift
+        beam = [(0, (start_id, ), ('start', ))]
+        best = beam[0]
+        for _ in range(length - 1):
+            candidates = {} # best partial set per last track
+            for score, path, relations in beam:
+                releases = {track_id[0] for track_id in path}
+                for edge_score, to_id, relation in self.neighbours(path[-1]):
+                    if to_id[0] in releases:
+                        continue
+                    if not low <= self.tracks[to_id]['chosen_bpm'] <= high:
+                        continue
+                    new_score = score + edge_score
+                    if relation == 'same' and relations[-1] == 'same':
+                        new_score -= self.same_key_penalty
+                    if to_id not in candidates or candidates[to_id][0] < new_score:
+                        candidates[to_id] = (new_score, path + (to_id, ),
+                                             relations + (relation, ))
+            if not candidates:
+                break
+            beam = heapq.nlargest(self.beam_width, candidates.values(),
+                                  key = lambda state: state[0])
+            best = beam[0]
+        log.info("MODEL: Set_builder: %s tracks, score %.1f, %s tracks with edges",
+                 len(best[1]), best[0], len(self.adjacency))
+        return [(self.tracks[track_id], relation)
+                for track_id, relation in zip(best[1], best[2])]
 
 
 class Brainz (object):
-
-    def __init__(self, musicbrainz_user, musicbrainz_pass, musicbrainz_appid):
+    accbr_bulk_max = 25 # AcousticBrainz limit of recording_ids per request
+    # MusicBrainz requests of all instances (and threads) share one queue,
+    # matching a track goes before prefetching the next ones
+    mb_prio_match = 0
+    mb_prio_prefetch = 1
+    _scheduler = None
+    _mb_lock = threading.Lock()
+    _mb_connected = None # credentials musicbrainzngs was set up with
+
+    def __init__(self, musicbrainz_user, musicbrainz_pass, musicbrainz_appid,
+          web_cache = False):
         self.ONLINE = False
+        self.mb_priority = self.mb_prio_match
+        self.refresh = False # True: ask the services, skip web cache lookups
         self.musicbrainz_user = musicbrainz_user
         self.musicbrainz_password = musicbrainz_pass
         self.musicbrainz_appid = musicbrainz_appid
-        if self.musicbrainz_connect(musicbrainz_user, musicbrainz_pass, musicbrainz_appid):
+        self.web_cache = web_cache # a Web_cache instance or False
+        if self.web_cache and self.web_cache.cache_only:
+            self.ONLINE = True # everything we get comes from the cache
+            log.info("MODEL: Brainz class is in cache only mode.")
+        elif self.musicbrainz_connect(musicbrainz_user, musicbrainz_pass, musicbrainz_appid):
             self.ONLINE = True
             log.info("MODEL: Brainz class is ONLINE.")
 
+    @classmethod
+    def mb_scheduler(cls):
+        '''the Brainz_scheduler all MusicBrainz requests go through'''
+        with cls._mb_lock:
+            if not Brainz._scheduler:
+                # only the scheduler thread talks to MusicBrainz, it does
+                # the pacing instead of musicbrainzngs
+                m.set_rate_limit(False)
+                Brainz._scheduler = Brainz_scheduler(Rate_limiter(1, 1))
+            return Brainz._scheduler
+
     # musicbrainz connect try,except wrapper
     def musicbrainz_connect(self, mb_user, mb_pass, mb_appid):
-        # If you plan to submit data, authenticate
-        m.auth(mb_user, mb_pass)
-        m.set_useragent(mb_appid[0], mb_appid[1]) # 0=version, 1=app
-        # If you are connecting to a different server
-        #m.set_hostname("beta.musicbrainz.org")
-        #m.set_rate_limit(limit_or_interval=1.0, new_requests=1)
-        try: # test request
-            m.get_artist_by_id("952a4205-023d-4235-897c-6fdb6f58dfaa", [])
-            self.ONLINE = True
-            return True
-        except WebServiceError as exc:
-            log.error("connecting to MusicBrainz: %s" % exc)
-            self.ONLINE = False
-            return False
+        '''musicbrainzngs keeps credentials and user agent globally, they
+           are set and checked with a test request once per process (again
+           only if they change)'''
+        credentials = (mb_user, mb_pass, tuple(mb_appid))
+        scheduler = self.mb_scheduler()
+        with Brainz._mb_lock:
+            if Brainz._mb_connected == credentials:
+                self.ONLINE = True
+                return True
+            # If you plan to submit data, authenticate
+            m.auth(mb_user, mb_pass)
+            m.set_useragent(mb_appid[0], mb_appid[1]) # 0=version, 1=app
+            # If you are connecting to a different server
+            #m.set_hostname("beta.musicbrainz.org")
+            try: # test request
+                scheduler.call("connect", self.mb_priority, m.get_artist_by_id,
+                    "952a4205-023d-4235-897c-6fdb6f58dfaa", [])
+            except WebServiceError as exc:
+                log.error("connecting to MusicBrainz: %s" % exc)
+                self.ONLINE = False
+                return False
+            Brainz._mb_connected = credentials
+        self.ONLINE = True
+        return True
+
+    def _mb_cached(self, key, mb_func, *args, **kwargs):
+        '''calls a musicbrainzngs function, or returns what it returned last
+           time if it's still in the web cache. Errors are raised as usual,
+           cache misses in cache only mode raise a WebServiceError. With
+           self.refresh MusicBrainz is asked again, the answer is cached.'''
+        if self.web_cache:
+            refresh = self.refresh and not self.web_cache.cache_only
+            cached = None if refresh else self.web_cache.get_json('musicbrainz', key)
+            if cached is not None:
+                return cached[0]
+            if self.web_cache.cache_only:
+                raise WebServiceError("Not in web cache (cache only mode): {}".format(key))
+
+        def _fetch(): # runs in the scheduler thread
+            mb_return = mb_func(*args, **kwargs)
+            if self.web_cache:
+                self.web_cache.put_json('musicbrainz', key, mb_return)
+            return mb_return
+        return self.mb_scheduler().call(key, self.mb_priority, _fetch)
 
     def get_mb_artist_by_id(self, mb_id):
         try:
-            return m.get_artist_by_id(mb_id, [])
+            return self._mb_cached("artist/{}".format(mb_id),
+                m.get_artist_by_id, mb_id, [])
         except WebServiceError as exc:
             log.error("requesting data from MusicBrainz: %s (WebServiceError)" % exc)
             log.debug("MODELS: get_mb_artist_by_id returns False.")
@@ -1395,12 +2498,14 @@ class Brainz (object):
     def search_mb_releases(self, artist, album, cat_no = False,
           limit = 10, strict = False):
         try:
+            key = "release-search/{}/{}/{}/{}/{}".format(artist, album,
+                cat_no, limit, strict)
             if cat_no:
-                return m.search_releases(artist=artist, release=album,
-                    catno = cat_no, limit=limit, strict=strict)
+                return self._mb_cached(key, m.search_releases, artist=artist,
+                    release=album, catno = cat_no, limit=limit, strict=strict)
             else:
-                return m.search_releases(artist=artist, release=album,
-                    limit=limit, strict=strict)
+                return self._mb_cached(key, m.search_releases, artist=artist,
+                    release=album, limit=limit, strict=strict)
         except WebServiceError as exc:
             log.error("requesting data from MusicBrainz: %s (WebServiceError)" % exc)
             log.debug("MODELS: search_mb_releases returns False.")
@@ -1412,7 +2517,8 @@ class Brainz (object):
 
     def get_mb_release_by_id(self, mb_id):
         try:
-            return m.get_release_by_id(mb_id, includes=["release-groups",
+            return self._mb_cached("release/{}".format(mb_id),
+            m.get_release_by_id, mb_id, includes=["release-groups",
             "artists", "labels", "url-rels", "recordings",
             "recording-rels", "recording-level-rels" ])
         except WebServiceError as websvcerr:
@@ -1426,7 +2532,8 @@ class Brainz (object):
 
     def get_mb_recording_by_id(self, mb_id):
         try:
-            return m.get_recording_by_id(mb_id, includes=[
+            return self._mb_cached("recording/{}".format(mb_id),
+             m.get_recording_by_id, mb_id, includes=[
              "url-rels"
             ])
         except WebServiceError as exc:
@@ -1452,11 +2559,24 @@ class Brainz (object):
         else:
             return ''
 
-    def _get_accousticbrainz(self, urlpart):
+    def _get_accousticbrainz(self, urlpart, refresh = False):
+        '''refresh (or self.refresh): skip the web cache lookup, eg. to
+           retry a recording that wasn't found last time'''
         headers={'Accept': 'application/json' }
         url="https://acousticbrainz.org/api/v1/{}".format(urlpart)
+        if self.web_cache:
+            refresh = (refresh or self.refresh) and not self.web_cache.cache_only
+            cached = None if refresh else self.web_cache.get_json('acousticbrainz', urlpart)
+            if cached is not None:
+                _json, status = cached
+                return _json if status == 200 else None
+            if self.web_cache.cache_only:
+                log.warning("MODEL: Not in web cache (cache only mode): %s", url)
+                return None
         try:
             resp = requests.get(url, headers=headers, timeout=7)
+            if self.web_cache and resp.status_code == 404: # remember "Not found"
+                self.web_cache.put_json('acousticbrainz', urlpart, None, 404)
             resp.raise_for_status()
         except requests.exceptions.HTTPError as errh:
             log.debug("fetching AcousticBrainz MBID: %s (HTTPError)", errh)
@@ -1475,6 +2595,8 @@ class Brainz (object):
 
         if resp.ok:
             _json = json.loads(resp.content)
+            if self.web_cache:
+                self.web_cache.put_json('acousticbrainz', urlpart, _json)
             return _json
         else:
             log.debug("No valid AcousticBrainz response. Returning None.")
@@ -1492,35 +2614,75 @@ class Brainz (object):
     #def _get_accbr_url_rels(self, )
 
     def get_accbr_bpm(self, mb_id):
-        try:
-            ab_return = self._get_accbr_low_level(mb_id)
-            return ab_return['rhythm']['bpm']
-        except:
-            return None
+        features = self.get_accbr_features(mb_id)
+        return features['bpm'] if features else None
 
     def get_accbr_key(self, mb_id):
-        try:
-            ab_return = self._get_accbr_low_level(mb_id)
-            if ab_return['tonal']['key_scale'] == 'minor':
-                majmin = 'm'
-            else:
-                majmin = ''
-            key_key = '{}{}'.format(ab_return['tonal']['key_key'], majmin)
-            return key_key
-        except:
-            return None
+        features = self.get_accbr_features(mb_id)
+        return features['key'] if features else None
 
     def get_accbr_chords_key(self, mb_id):
-        try:
-            ab_return = self._get_accbr_low_level(mb_id)
-            if ab_return['tonal']['chords_scale'] == 'minor':
-                majmin = 'm'
-            else:
-                majmin = ''
-            chords_key = '{}{}'.format(ab_return['tonal']['chords_key'], majmin)
-            return chords_key
-        except:
+        features = self.get_accbr_features(mb_id)
+        return features['chords_key'] if features else None
+
+    def get_accbr_features_bulk(self, mb_ids, refresh = False):
+        '''fetches low-level documents of many recordings using the
+           AcousticBrainz multi-ID endpoint (max. 25 IDs per request).
+           Returns a dict of recording MBID -> features dict (as returned by
+           get_accbr_features). Recordings unknown to AcousticBrainz are
+           missing in the dict. refresh: skip the web cache lookup.'''
+        features = {}
+        unique_ids = list(dict.fromkeys(mb_ids)) # dedup, keep order
+        for i in range(0, len(unique_ids), self.accbr_bulk_max):
+            chunk = unique_ids[i:i + self.accbr_bulk_max]
+            log.info("MODEL: Fetching AcousticBrainz low-level for {} recordings ({}/{})".format(
+                len(chunk), i + len(chunk), len(unique_ids)))
+            ab_return = self._get_accousticbrainz(
+                "low-level?recording_ids={}".format(';'.join(chunk)), refresh)
+            if not ab_return:
+                continue
+            for mb_id in chunk:
+                try: # submissions are numbered, we use the first one
+                    low_level = ab_return[mb_id]['0']
+                except (KeyError, TypeError):
+                    continue
+                features[mb_id] = self._accbr_features_from_low_level(low_level)
+        return features
+
+    def get_accbr_features(self, mb_id):
+        '''fetches the AcousticBrainz low-level document of a recording once
+           and returns all descriptors we use as a dict. Values that are
+           missing in the document are None, the whole dict is None if
+           AcousticBrainz doesn't have the recording.'''
+        ab_return = self._get_accbr_low_level(mb_id)
+        if not ab_return:
             return None
+        return self._accbr_features_from_low_level(ab_return)
+
+    def _accbr_features_from_low_level(self, ab_return):
+        '''takes a low-level document and pulls out key, chords key, bpm
+           and some other descriptors'''
+        def _get(section, field):
+            try:
+                return ab_return[section][field]
+            except (KeyError, TypeError):
+                return None
+
+        def _majmin(key, scale):
+            if key is None:
+                return None
+            return '{}{}'.format(key, 'm' if scale == 'minor' else '')
+
+        return {
+            'key': _majmin(_get('tonal', 'key_key'), _get('tonal', 'key_scale')),
+            'key_strength': _get('tonal', 'key_strength'),
+            'chords_key': _majmin(_get('tonal', 'chords_key'),
+                                  _get('tonal', 'chords_scale')),
+            'bpm': _get('rhythm', 'bpm'),
+            'beats_count': _get('rhythm', 'beats_count'),
+            'danceability': _get('rhythm', 'danceability'),
+            'length': (_get('metadata', 'audio_properties') or {}).get('length'),
+        }
 
 class Brainz_match (Brainz): # we are based on Brainz, but it's not online
     '''This class tries to match _one_ given release and/or recording with
@@ -1529,9 +2691,10 @@ class Brainz_match (Brainz): # we are based on Brainz, but it's not online
     def __init__(self, mb_user, mb_pass, mb_appid,
           d_release_id, d_release_title, d_catno, d_artist, d_track_name,
           d_track_no, d_track_no_num,
-          detail = 1):
+          detail = 1, web_cache = False, refresh = False):
         # FIXME we take mb credentials from passed coll_ctrl object
-        super().__init__(mb_user, mb_pass, mb_appid)
+        super().__init__(mb_user, mb_pass, mb_appid, web_cache)
+        self.refresh = refresh # a retry after a failed match, see Brainz
         # we don't need to create a Brainz obj, we are a child of it
         # remember all original discogs names
         self.d_release_id_orig = d_release_id
@@ -1559,6 +2722,24 @@ class Brainz_match (Brainz): # we are based on Brainz, but it's not online
         self.d_track_name = d_track_name.lower()
         self.d_track_no = d_track_no.upper() # upper comparision everywhere
         self.d_track_no_num = int(d_track_no_num)
+        # full MB releases fetched during this match run, by MBID. All match
+        # methods share them, so each candidate is fetched only once.
+        self.mb_full_releases = {}
+        self.mb_full_releases_hits = 0
+        self.mb_full_releases_misses = 0
+
+    def get_mb_release_by_id(self, mb_id):
+        '''memoized version of Brainz.get_mb_release_by_id'''
+        if mb_id in self.mb_full_releases:
+            self.mb_full_releases_hits += 1
+            log.debug("MODEL: MB release {} already fetched ({} hits)".format(
+                mb_id, self.mb_full_releases_hits))
+            return self.mb_full_releases[mb_id]
+        self.mb_full_releases_misses += 1
+        full_rel = super().get_mb_release_by_id(mb_id)
+        if full_rel: # don't remember errors, next try might be luckier
+            self.mb_full_releases[mb_id] = full_rel
+        return full_rel
 
     def fetch_mb_releases(self, detail): # fetching controllable from outside
         # decide which search method is used according to detail (-z count)
@@ -1576,6 +2757,18 @@ class Brainz_match (Brainz): # we are based on Brainz, but it's not online
                   limit = 5, strict = False)
         return True # FIXME error handling
 
+    def prefetch(self, detail):
+        '''asks MusicBrainz for the release candidates (fetch_mb_releases)
+           and the details of the first one ahead of matching, at low
+           priority. A later match run finds them in the web cache or joins
+           the queued requests. The other candidates are left to the match,
+           it often stops at the first one.'''
+        self.mb_priority = self.mb_prio_prefetch
+        self.fetch_mb_releases(detail)
+        for release in (self.mb_releases or {}).get('release-list', [])[:1]:
+            self.get_mb_release_by_id(release['id'])
+        self.mb_priority = self.mb_prio_match
+
     def fetch_mb_matched_rel(self, rel_mbid = False): # mbid passable from outside
         if rel_mbid: # given from outside, rest of necess. data from init
             self.mb_matched_rel = self.get_mb_release_by_id(rel_mbid)
@@ -54,3 +54,51 @@ def join_sep(iterator, seperator):
     for s in it:
         string += seperator + s
     return string
+
+# musical keys on the Camelot wheel: minor keys are A, major keys are B
+_PITCH_NAMES = [['c', 'b#'], ['c#', 'db'], ['d'], ['d#', 'eb'], ['e', 'fb'],
+                ['f', 'e#'], ['f#', 'gb'], ['g'], ['g#', 'ab'], ['a'],
+                ['a#', 'bb'], ['b', 'cb']]
+_MINOR_SUFFIXES = ['m', 'min', 'minor']
+_MAJOR_SUFFIXES = ['', 'maj', 'major']
+
+def normalize_key(key):
+    '''lowercases a key notation and removes spaces, the same is done in
+       SQL when looking up the key_camelot table'''
+    return key.strip().replace(' ', '').replace('♯', '#').replace('♭', 'b').lower()
+
+def camelot_keys():
+    '''returns a dict of normalized key notations ("am", "f#minor", "dbmaj",
+       "8a", "08a") and their Camelot wheel codes'''
+    keys = {}
+    for pitch, names in enumerate(_PITCH_NAMES):
+        minor = '{}A'.format((pitch * 7 + 4) % 12 + 1)
+        major = '{}B'.format((pitch * 7 + 7) % 12 + 1)
+        for name in names:
+            for suffix in _MINOR_SUFFIXES:
+                keys[name + suffix] = minor
+            for suffix in _MAJOR_SUFFIXES:
+                keys[name + suffix] = major
+    for number in range(1, 13):
+        for letter in ['A', 'B']:
+            code = '{}{}'.format(number, letter)
+            keys[code.lower()] = code
+            keys['{:02d}{}'.format(number, letter).lower()] = code
+    return keys
+
+_CAMELOT_KEYS = camelot_keys()
+
+def camelot(key):
+    '''returns the Camelot wheel code of a musical key or None if unknown'''
+    if not key:
+        return None
+    return _CAMELOT_KEYS.get(normalize_key(str(key)))
+
+def camelot_neighbours(code):
+    '''returns a dict of Camelot codes harmonically compatible with the
+       given one and how they relate to it'''
+    number, letter = int(code[:-1]), code[-1]
+    other = 'B' if letter == 'A' else 'A'
+    step = lambda n: '{}{}'.format((number - 1 + n) % 12 + 1, letter)
+    return {code: 'same', step(1): '+1', step(-1): '-1',
+            '{}{}'.format(number, other): 'relative', step(2): 'boost'}
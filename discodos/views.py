@@ -41,17 +41,10 @@ class View_common(ABC):
 
     def get_max_width(self, rows_list, keys_list, extra_space):
         '''gets max width of sqlite list of rows for given fields (keys_list)
-           and add some space. FIXME: Only supports exactly 2 keys.'''
+           and add some space.'''
         max_width = 0
         for row in rows_list:
-            row_mutable = dict(row)
-            width = 0
-            if row_mutable[keys_list[0]] is None:
-                row_mutable[keys_list[0]] = "-"
-            if row_mutable[keys_list[1]] is None: # this is chosen_bpm field
-                row_mutable[keys_list[1]] = "-"
-            width = (len(row_mutable[keys_list[0]]) + len('/')
-                + len(str(row_mutable[keys_list[1]])))
+            width = len(self.combine_fields_to_width(row, keys_list, 0))
             #log.debug("This rows width: {}.".format(width))
             if max_width < width:
                 max_width = width
@@ -60,18 +53,11 @@ class View_common(ABC):
         return max_width + extra_space
 
     def combine_fields_to_width(self, row, keys_list, set_width):
-        '''takes sqlite row and keys_list, combines and fills with
-           spaces up to set_width. FIXME: Only supports exactly 2 keys.'''
-        row_mut = dict(row) # make sqlite row tuple mutable
-        #print(row_mut[keys_list[0]])
-        #print(row_mut[keys_list[1]])
-        if row_mut[keys_list[0]] is None:
-            row_mut[keys_list[0]] = "-"
-        if row_mut[keys_list[1]] is None: # this is chosen_bpm field
-            row_mut[keys_list[1]] = "-"
-        combined_key_bpm = "{}/{}".format(row_mut[keys_list[0]],
-              str(row_mut[keys_list[1]]))
-        combined_with_space = combined_key_bpm.ljust(set_width)
+        '''takes sqlite row and keys_list, combines fields separated by /
+           and fills with spaces up to set_width. None fields show as -'''
+        combined = "/".join(["-" if row[key] is None else str(row[key])
+                             for key in keys_list])
+        combined_with_space = combined.ljust(set_width)
         #log.warning("Combined string: {}".format(combined_with_space))
         return combined_with_space
 
@@ -332,6 +318,35 @@ class View_common_cli(View_common):
                        'd_track_no': 'Trk\nNo', 'trans_rating': 'Trns\nRat',
                        'key': 'Key', 'bpm': 'BPM'}))
 
+    def tab_track_report(self, _snippets_data):
+        '''renders all snippets of a track report in one pass. Rows come
+           ordered by mix and occurence, a new snippet starts when either
+           changes.'''
+        _snippets_key_bpm = self.replace_key_bpm(_snippets_data)
+        _snippets_nl = self.trim_table_fields(_snippets_key_bpm,
+            exclude = ['name'])
+        headers = {'track_pos': '#', 'discogs_title': 'Release',
+                   'd_artist': 'Track\nArtist', 'd_track_name': 'Track\nName',
+                   'd_track_no': 'Trk\nNo', 'key': 'Key', 'bpm': 'BPM',
+                   'key_notes': 'Key\nNotes', 'trans_rating': 'Trans.\nRating',
+                   'trans_notes': 'Trans.\nNotes', 'notes': 'Track\nNotes'}
+        report = []
+        snippet = []
+        current = None
+        for row in _snippets_nl:
+            mix_id, mix_name = row.pop('mix_id'), row.pop('name')
+            occurence = (mix_id, row.pop('occurence_pos'))
+            if occurence != current:
+                if snippet:
+                    report.append(tab(snippet, tablefmt='pipe', headers=headers))
+                report.append('Snippet of Mix {} - "{}":'.format(mix_id, mix_name))
+                snippet = []
+                current = occurence
+            snippet.append(row)
+        if snippet:
+            report.append(tab(snippet, tablefmt='pipe', headers=headers))
+        self.p('\n'.join(report))
+
     def duration_stats(self, start_time, msg):
         took_seconds = time() - start_time
         if took_seconds >= 86400:
@@ -715,6 +730,7 @@ class User_int(object):
         self.WANTS_TO_COPY_MIX = False
         self.WANTS_TO_DELETE_MIX = False
         self.WANTS_SUGGEST_TRACK_REPORT = False
+        self.WANTS_SUGGEST_SET = False
         self.WANTS_TO_BULK_EDIT = False
         self.WANTS_SUGGEST_BPM_REPORT = False
         self.WANTS_SUGGEST_KEY_REPORT = False
@@ -732,6 +748,8 @@ class User_int(object):
         self.WANTS_TO_ADD_AND_IMPORT_RELEASE = False
         self.WANTS_TO_IMPORT_COLLECTION_WITH_TRACKS = False
         self.WANTS_TO_IMPORT_COLLECTION_WITH_BRAINZ = False
+        self.IMPORT_INCREMENTAL = False
+        self.IMPORT_CONTINUE = False
         self.WANTS_TO_SEARCH_AND_EDIT_TRACK = False
         self.RESUME_OFFSET = 0
         self.WANTS_TO_LAUNCH_SETUP = False
@@ -887,6 +905,19 @@ class User_int(object):
         if hasattr(self.args, 'suggest_search'):
             self.WANTS_TO_SUGGEST_SEARCH = True
             log.debug("Entered suggestion mode.")
+            if self.args.suggest_harmonic and not self.args.suggest_key:
+                log.error("Harmonic suggestions need a key (-k).")
+                raise SystemExit(1)
+            if self.args.suggest_set:
+                if self.args.suggest_search == "0":
+                    log.error("Building a set needs search terms to find the first track.")
+                    raise SystemExit(1)
+                if self.args.suggest_bpm or self.args.suggest_key:
+                    log.error("You can't combine BPM or key with building a set.")
+                    raise SystemExit(1)
+                if self.args.suggest_set < 2:
+                    log.error("A set should have at least 2 tracks.")
+                    raise SystemExit(1)
             if (self.args.suggest_bpm and self.args.suggest_search == "0"
                   and self.args.suggest_key):
                 log.debug("Entered key and BPM suggestion report.")
@@ -909,6 +940,9 @@ class User_int(object):
                 self.WANTS_SUGGEST_KEY_REPORT = True
             elif self.args.suggest_search == "0":
                 log.debug("Entered Track-combination report. No searchterm.")
+            elif self.args.suggest_set:
+                log.debug("Entered set builder.")
+                self.WANTS_SUGGEST_SET = True
             else:
                 log.debug("Entered Track-combination report.")
                 self.WANTS_SUGGEST_TRACK_REPORT = True
@@ -919,6 +953,23 @@ class User_int(object):
         # IMPORT MODE
         if hasattr(self.args, 'import_id'):
             log.debug("Entered import mode.")
+            if self.args.import_incremental:
+                if self.args.import_id != 0 or self.args.import_brainz:
+                    log.error(
+                      "--incremental only works for Discogs collection imports (with or without -u).")
+                    raise SystemExit(1)
+                self.IMPORT_INCREMENTAL = True
+            if self.args.import_continue:
+                if self.args.import_id != 0:
+                    log.error(
+                      "--continue only works for Discogs collection imports and *Brainz matching.")
+                    raise SystemExit(1)
+                self.IMPORT_CONTINUE = True
+            if ((self.args.import_max_age is not None
+                  or self.args.import_missing_only)
+                  and not self.args.import_brainz):
+                log.error("--max-age and --missing-only only work with *Brainz matching (-z, -zz).")
+                raise SystemExit(1)
             if self.args.import_id != 0 and self.args.import_add_coll:
                 self.WANTS_TO_ADD_AND_IMPORT_RELEASE = True
             elif self.args.import_id == 0 and self.args.import_add_coll:
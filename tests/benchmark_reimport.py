@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+'''Times importing and re-importing releases and tracks into a DiscoBASE.
+Compares the native UPSERT statements of Collection with the former
+"INSERT, on UNIQUE constraint error UPDATE" way of doing it. Not a unit
+test, run it by hand from the repository root:
+
+    python -m tests.benchmark_reimport [releases] [runs]
+'''
+import io
+import os
+import sqlite3
+import sys
+import time
+from contextlib import redirect_stdout
+from datetime import datetime
+from pathlib import Path
+from shutil import copy2
+from statistics import median
+
+from discodos.config import Db_setup
+from discodos.models import Collection, sqlerr
+
+
+def upsert_track_fallback(collection, release_id, track_no, track_name,
+                          track_artist):
+    '''the way upsert_track worked before SQLite UPSERT was used'''
+    try:
+        collection.execute_sql('''INSERT INTO track(d_release_id, d_track_no,
+            d_artist, d_track_name, import_timestamp)
+            VALUES(?, ?, ?, ?, datetime('now', 'localtime'));''',
+            (release_id, track_no, track_artist, track_name), raise_err = True)
+    except sqlerr as e:
+        if "UNIQUE constraint failed" not in e.args[0]:
+            raise
+        collection.execute_sql('''UPDATE track SET d_artist = ?,
+            d_track_name = ?, import_timestamp = datetime('now', 'localtime')
+            WHERE d_release_id = ? AND d_track_no = ?;''',
+            (track_artist, track_name, release_id, track_no), raise_err = True)
+
+
+def create_release_fallback(collection, release_id, title, artist, catno):
+    '''the way create_release worked before SQLite UPSERT was used'''
+    timestamp = datetime.today().isoformat(' ', 'seconds')
+    try:
+        collection.execute_sql('''INSERT OR FAIL INTO release(discogs_id,
+            discogs_title, import_timestamp, d_artist, in_d_collection, d_catno)
+            VALUES(?, ?, ?, ?, ?, ?)''',
+            (release_id, title, timestamp, artist, True, catno), raise_err = True)
+    except sqlerr as e:
+        if "UNIQUE constraint failed" not in e.args[0]:
+            raise
+        collection.execute_sql('''UPDATE release SET (discogs_title,
+            import_timestamp, d_artist, in_d_collection, d_catno)
+            = (?, ?, ?, ?, ?) WHERE discogs_id == ?;''',
+            (title, timestamp, artist, True, catno, release_id), raise_err = True)
+
+
+def import_releases(collection, releases, way):
+    start = time.perf_counter()
+    with collection.transaction():
+        for release_id, tracks in releases:
+            title, artist = 'Title {}'.format(release_id), 'Artist'
+            catno = 'CAT {}'.format(release_id)
+            if way == 'fallback':
+                create_release_fallback(collection, release_id, title,
+                                        artist, catno)
+                for track in tracks:
+                    upsert_track_fallback(collection, release_id, *track)
+            elif way == 'upsert':
+                collection.create_release(release_id, title, artist, catno,
+                                          d_coll = True)
+                for track in tracks:
+                    collection.upsert_track(release_id, *track)
+            else: # batched, as import_collection does
+                collection.create_release(release_id, title, artist, catno,
+                                          d_coll = True)
+                collection.upsert_tracks(release_id, tracks)
+    return time.perf_counter() - start
+
+
+def main(release_count = 2000, runs = 3):
+    discodos_tests = Path(os.path.dirname(os.path.abspath(__file__)))
+    db_path = discodos_tests / 'discobase_benchmark.db'
+    releases = [(9000000 + i, [(track_no, 'Track {}'.format(track_no), 'Artist')
+                               for track_no in ['A1', 'A2', 'B1', 'B2']])
+                for i in range(release_count)]
+    print('SQLite {}, {} releases with 4 tracks each, median of {} runs\n'.format(
+        sqlite3.sqlite_version, release_count, runs))
+    print('{:<22}{:>12}{:>12}'.format('', 'import', 're-import'))
+    for way in ['fallback', 'upsert', 'upsert batched']:
+        first, again = [], []
+        for _ in range(runs):
+            copy2(discodos_tests / 'fixtures' / 'discobase_empty.db', db_path)
+            with redirect_stdout(io.StringIO()): # quiet schema upgrade
+                db_setup = Db_setup(db_path)
+                db_setup.upgrade_schema()
+                db_setup.close_conn()
+            collection = Collection(False, db_path)
+            first.append(import_releases(collection, releases, way))
+            again.append(import_releases(collection, releases, way))
+            collection.close_conn()
+        print('{:<22}{:>11.2f}s{:>11.2f}s'.format(way, median(first),
+                                                  median(again)))
+    os.remove(db_path)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -171,6 +171,79 @@ class TestBrainz(unittest.TestCase):
             self.assertFalse(ab_return)
         print("{} - {} - END".format(self.clname, name))
 
+    def test_get_accbr_features(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.brainz = Brainz(self.mb_user,self.mb_pass,self.mb_appid)
+        if self.brainz.ONLINE:
+            print('We are ONLINE')
+            ab_return = self.brainz.get_accbr_features(
+                'fa9b7b2d-e9bb-4122-a725-4f865dd4648a')
+            self.assertEqual(ab_return['key'], 'A#m')
+            self.assertEqual(ab_return['chords_key'], 'A#m')
+            self.assertEqual(int(ab_return['bpm']), 108)
+            self.assertEqual(ab_return['beats_count'], 836)
+        else:
+            print('We are OFFLINE, testing if we properly fail!')
+            ab_return = self.brainz.get_accbr_features(
+                'fa9b7b2d-e9bb-4122-a725-4f865dd4648a')
+            self.assertIsNone(ab_return)
+        # parsing works the same on- and offline
+        features = self.brainz._accbr_features_from_low_level({
+            'tonal': {'key_key': 'C', 'key_scale': 'major',
+                      'chords_key': 'A', 'chords_scale': 'minor'},
+            'rhythm': {'bpm': 125.3}})
+        self.assertEqual(features['key'], 'C')
+        self.assertEqual(features['chords_key'], 'Am')
+        self.assertEqual(features['bpm'], 125.3)
+        self.assertIsNone(features['danceability'])
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_get_accbr_features_bulk(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.brainz = Brainz(self.mb_user,self.mb_pass,self.mb_appid)
+        rec_ids = ['fa9b7b2d-e9bb-4122-a725-4f865dd4648a',
+                   'fa9b7b2d-e9bb-4122-a725-4f865dd4648a'] # dups are merged
+        if self.brainz.ONLINE:
+            print('We are ONLINE')
+            ab_return = self.brainz.get_accbr_features_bulk(rec_ids)
+            self.assertEqual(len(ab_return), 1)
+            self.assertEqual(ab_return[rec_ids[0]]['key'], 'A#m')
+            self.assertEqual(int(ab_return[rec_ids[0]]['bpm']), 108)
+        else:
+            print('We are OFFLINE, testing if we properly fail!')
+            ab_return = self.brainz.get_accbr_features_bulk(rec_ids)
+            self.assertEqual(ab_return, {})
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_get_mb_release_by_id_memoized(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        bmatch = Brainz_match(self.mb_user, self.mb_pass, self.mb_appid,
+              6762725, 'Imperial Propaganda', 'MONNOM BLACK 005',
+              'Dax J', 'Imperial Propaganda', 'A1', 1)
+        if bmatch.ONLINE:
+            print('We are ONLINE')
+            bmatch.fetch_mb_releases(detail = 2)
+            candidates = len(bmatch.mb_releases['release-list'])
+            self.assertTrue(bmatch.match_release())
+            bmatch.fetch_mb_matched_rel()
+            # each candidate fetched once, no matter how many methods ran
+            self.assertLessEqual(bmatch.mb_full_releases_misses, candidates)
+            self.assertGreater(bmatch.mb_full_releases_hits, 0)
+        else:
+            print('We are OFFLINE, testing if we properly fail!')
+            self.assertEqual(bmatch.get_mb_release_by_id('2ff4fe3d'), {})
+            self.assertEqual(bmatch.mb_full_releases, {}) # errors not memoized
+        # a memoized release is never fetched again
+        bmatch.mb_full_releases['2ff4fe3d'] = {'release': {'id': '2ff4fe3d'}}
+        misses = bmatch.mb_full_releases_misses
+        self.assertEqual(bmatch.get_mb_release_by_id('2ff4fe3d')['release']['id'],
+                         '2ff4fe3d')
+        self.assertEqual(bmatch.mb_full_releases_misses, misses)
+        print("{} - {} - END".format(self.clname, name))
+
     def test_catno_match_cutter_var_2(self):
         name = inspect.currentframe().f_code.co_name
         print("\n{} - {} - BEGIN".format(self.clname, name))
@@ -185,6 +258,46 @@ class TestBrainz(unittest.TestCase):
         self.assertEqual(cutter_return['after'], '005')
         print("{} - {} - END".format(self.clname, name))
 
+    def test_brainz_scheduler(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        scheduler = Brainz_scheduler(Rate_limiter(1, 0.05))
+        ran, blocker = [], threading.Event()
+
+        def request(key):
+            if key == 'first':
+                blocker.wait(5) # keeps the rest queued
+            ran.append((key, time.monotonic()))
+            if key == 'broken':
+                raise WebServiceError('404')
+            return key.upper()
+
+        first = scheduler.submit('first', 0, request, 'first')
+        later = scheduler.submit('later', Brainz.mb_prio_prefetch, request, 'later')
+        moved_up = scheduler.submit('moved_up', Brainz.mb_prio_prefetch,
+            request, 'moved_up')
+        urgent = scheduler.submit('urgent', Brainz.mb_prio_match, request, 'urgent')
+        # duplicates are coalesced, a more urgent one moves it up the queue
+        self.assertIs(scheduler.submit('moved_up', Brainz.mb_prio_match,
+            request, 'moved_up'), moved_up)
+        self.assertIs(scheduler.submit('later', Brainz.mb_prio_prefetch,
+            request, 'later'), later)
+        blocker.set()
+        self.assertEqual(later.result(5), 'LATER')
+        self.assertEqual([f.result() for f in (first, moved_up, urgent)],
+            ['FIRST', 'MOVED_UP', 'URGENT'])
+        self.assertEqual([key for key, _ in ran],
+            ['first', 'urgent', 'moved_up', 'later'])
+        # paced: 1 request per 0.05 seconds
+        for (_, t1), (_, t2) in zip(ran, ran[1:]):
+            self.assertGreaterEqual(t2 - t1, 0.04)
+        # errors reach the caller, the key can be requested again afterwards
+        with self.assertRaises(WebServiceError):
+            scheduler.call('broken', 0, request, 'broken')
+        self.assertEqual(scheduler.in_flight, {})
+        self.assertEqual(scheduler.call('again', 0, request, 'again'), 'AGAIN')
+        print("{} - {} - END".format(self.clname, name))
+
     @classmethod
     def tearDownClass(self):
         os.remove(self.db_path)
@@ -1,12 +1,20 @@
 #!/usr/bin/env python
 import inspect
 import os
+import re
+import sqlite3
+import time
 import unittest
 from pathlib import Path
 from shutil import copy2
+from types import SimpleNamespace
+
+import discogs_client
 
 from discodos.config import Config, Db_setup, create_data_dir
-from discodos.models import Collection, log
+from discodos.models import (Collection, Rate_limited_fetcher, Rate_limiter,
+                             Set_builder, log)
+from discodos.utils import camelot, camelot_neighbours
 
 
 class TestCollection(unittest.TestCase):
@@ -22,6 +30,7 @@ class TestCollection(unittest.TestCase):
         empty_db_path = discodos_tests / 'fixtures' / 'discobase_empty.db'
         self.db_path = discodos_tests / 'discobase.db'
         print('Database: {}'.format(copy2(empty_db_path, self.db_path)))
+        Db_setup(self.db_path).upgrade_schema() # fixture is at schema version 2
         print("{} - {} - END\n".format(self.clname, name))
 
     def debug_db(self, db_return):
@@ -118,12 +127,13 @@ class TestCollection(unittest.TestCase):
         db_return = self.collection.search_release_offline('Amon') # artist or title
         self.assertIsNotNone(db_return)
         self.assertEqual(len(db_return), 2) # should be a list with 2 Rows
-        self.assertEqual(db_return[0]['discogs_id'], 69092)
+        # ranked by relevance: equal artist match, shorter entry first
+        self.assertEqual(db_return[0]['discogs_id'], 919698)
         self.assertEqual(db_return[0]['d_artist'], 'Amon Tobin')
-        self.assertEqual(db_return[0]['discogs_title'], 'Out From Out Where')
-        self.assertEqual(db_return[1]['discogs_id'], 919698)
+        self.assertEqual(db_return[0]['discogs_title'], 'Foley Room')
+        self.assertEqual(db_return[1]['discogs_id'], 69092)
         self.assertEqual(db_return[1]['d_artist'], 'Amon Tobin')
-        self.assertEqual(db_return[1]['discogs_title'], 'Foley Room')
+        self.assertEqual(db_return[1]['discogs_title'], 'Out From Out Where')
         print("TestMix.search_release_offline_text_multiple: DONE\n")
 
     def test_search_release_offline_text_error(self):
@@ -135,13 +145,156 @@ class TestCollection(unittest.TestCase):
         #self.assertEqual(db_return, []) # FIXME should this better be empty list?
         print("{} - {} - END".format(self.clname, name))
 
+    def test_search_release_offline_text_quotes(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.collection = Collection(False, self.db_path)
+        # search terms are bound as parameters, quotes can't break the SQL
+        db_return = self.collection.search_release_offline('Märtini" OR "1"="1')
+        self.assertIsNone(db_return)
+        db_return = self.collection.search_release_track_offline(
+            artist="O'Brien", release='"', track="'")
+        self.assertEqual(db_return, [])
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_select_simple_sql_cached(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.collection = Collection(False, self.db_path)
+        self.collection._select_simple_sql.cache_clear()
+        for track_no in ['A1', 'B1', 'B2']:
+            db_return = self.collection.get_track(123456, track_no)
+            self.assertEqual(db_return['d_track_no'], track_no)
+        cache_info = self.collection._select_simple_sql.cache_info()
+        self.assertEqual(cache_info.misses, 1) # SQL string built only once
+        self.assertEqual(cache_info.hits, 2)
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_search_release_offline_fts_prefix(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.collection = Collection(False, self.db_path)
+        self.assertTrue(self.collection.fts_available())
+        # word prefixes, diacritics are ignored
+        for term in ['Mart', 'bros mat', 'MATERIAL lo']:
+            db_return = self.collection.search_release_offline(term)
+            self.assertIsNotNone(db_return)
+            self.assertEqual(len(db_return), 1)
+            self.assertEqual(db_return[0]['discogs_id'], 123456)
+        # but no substrings in the middle of words
+        self.assertIsNone(self.collection.search_release_offline('tini'))
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_search_fts_triggers(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.collection = Collection(False, self.db_path)
+        self.collection.create_release(1234567, 'Fresh Release', 'Newcomer',
+                                       'NEW 001', d_coll = True)
+        db_return = self.collection.search_release_offline('NEW 001') # catno
+        self.assertEqual(db_return[0]['discogs_id'], 1234567)
+        self.collection.create_release(1234567, 'Renamed Release', 'Newcomer',
+                                       'NEW 001', d_coll = True)
+        self.assertIsNone(self.collection.search_release_offline('Fresh'))
+        self.assertEqual(len(self.collection.search_release_offline('Renamed')), 1)
+        self.collection.upsert_track(1234567, 'A', 'Opener', 'Newcomer')
+        self.collection.upsert_track_ext({'d_release_id': 1234567,
+                                          'd_track_no': 'A'},
+                                         {'notes': 'warmup tool'})
+        dbr = self.collection.search_release_track_offline(track='warm')
+        self.assertEqual(len(dbr), 1)
+        self.assertEqual(dbr[0]['d_track_name'], 'Opener')
+        self.assertEqual(dbr[0]['notes'], 'warmup tool')
+        self.collection.execute_sql(
+            'DELETE FROM track WHERE d_release_id == 1234567;')
+        self.collection.execute_sql(
+            'DELETE FROM track_ext WHERE d_release_id == 1234567;')
+        self.collection.execute_sql(
+            'DELETE FROM release WHERE discogs_id == 1234567;')
+        self.assertIsNone(self.collection.search_release_offline('Renamed'))
+        self.assertEqual(self.collection.search_release_track_offline(
+            track='Opener'), [])
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_search_fts_track_renumbered(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.collection = Collection(False, self.db_path)
+        self.collection.create_release(1234570, 'Vacuum Release', 'Cleaner',
+                                       'VAC 001', d_coll = True)
+        self.collection.upsert_track(1234570, 'B', 'Shiny', 'Cleaner')
+        # VACUUM may renumber tables without an INTEGER PRIMARY KEY like track
+        self.collection.execute_sql(
+            'UPDATE track SET rowid = rowid + 1000 WHERE d_release_id == 1234570;')
+        self.collection.upsert_track(1234570, 'B', 'Sparkling', 'Cleaner')
+        dbr = self.collection.search_release_track_offline(track='Sparkling')
+        self.assertEqual([(r['d_release_id'], r['d_track_no']) for r in dbr],
+                         [(1234570, 'B')])
+        self.assertEqual(self.collection.search_release_track_offline(
+            track='Shiny'), [])
+        self.assertEqual(len(self.collection.search_release_track_offline(
+            artist='Cleaner')), 1)
+        self.collection.execute_sql(
+            'DELETE FROM track WHERE d_release_id == 1234570;')
+        self.collection.execute_sql(
+            'DELETE FROM release WHERE discogs_id == 1234570;')
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_search_without_fts5(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        # SQLite built without FTS5: no search index, but all other upgrades
+        nofts_path = self.db_path.with_name('discobase_nofts.db')
+        copy2(self.db_path.with_name('fixtures') / 'discobase_empty.db',
+              nofts_path)
+        self.addCleanup(os.remove, nofts_path)
+        db_setup = Db_setup(nofts_path)
+        db_setup.compileoption_used = lambda option: option != 'ENABLE_FTS5'
+        self.assertTrue(db_setup.upgrade_schema())
+        self.assertEqual(db_setup.get_current_schema_version(),
+                         db_setup.get_latest_schema_version())
+        db_setup.close_conn()
+        collection = Collection(False, nofts_path)
+        self.assertFalse(collection.fts_available())
+        db_return = collection.search_release_offline('Material')
+        self.assertEqual(db_return[0]['discogs_id'], 123456)
+        self.assertTrue(collection.search_release_track_offline(artist='Märtini'))
+        collection.close_conn()
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_prepare_tracklist_info(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.collection = Collection(False, self.db_path)
+        tracklist = [SimpleNamespace(position=pos, title=title) for pos, title in
+            [('a1', 'Material Love'), ('B1', 'Material Love (Cab Drivers Remix)'),
+             ('B2', 'Hedup!'), ('C', 'Not in DiscoBASE')]]
+        selects = []
+        select = self.collection._select
+        def _select(sql_select, fetchone = False, params = ()):
+            selects.append(sql_select)
+            return select(sql_select, fetchone, params)
+        self.collection._select = _select
+        tl = self.collection.prepare_tracklist_info(123456, tracklist)
+        del self.collection._select
+        self.assertEqual(len(selects), 1) # one query for the whole release
+        self.assertEqual(len(tl), 4)
+        self.assertEqual(tl[0]['track_no'], 'a1')
+        self.assertEqual(tl[0]['key'], 'Am')
+        self.assertEqual(tl[0]['bpm'], 125)
+        self.assertEqual(tl[0]['notes'], 'test track note')
+        self.assertEqual(tl[1]['bpm'], 140)
+        self.assertEqual(tl[2]['key'], 'C')
+        self.assertEqual(tl[3], {'track_no': 'C', 'track_title': 'Not in DiscoBASE'})
+        print("{} - {} - END".format(self.clname, name))
+
     def test_get_tracks_by_bpm(self):
         name = inspect.currentframe().f_code.co_name
         print("\n{} - {} - BEGIN".format(self.clname, name))
         self.collection = Collection(False, self.db_path)
         db_return = self.collection.get_tracks_by_bpm(125, 6)
         self.assertIsNotNone(db_return)
-        self.assertEqual(len(db_return), 3) # should be a list with 3 Rows
+        self.assertEqual(len(db_return), 4) # should be a list with 4 Rows
         self.assertEqual(db_return[0]['d_artist'], 'Source Direct')
         self.assertEqual(db_return[0]['d_track_no'], 'AA')
         self.assertEqual(db_return[0]['chosen_bpm'], 120)
@@ -151,6 +304,10 @@ class TestCollection(unittest.TestCase):
         self.assertEqual(db_return[2]['d_artist'], 'Märtini Brös.')
         self.assertEqual(db_return[2]['d_track_no'], 'B2')
         self.assertEqual(db_return[2]['chosen_bpm'], 130)
+        # AcousticBrainz values only, the track has no track_ext row
+        self.assertEqual(db_return[3]['d_track_no'], 'A')
+        self.assertEqual(db_return[3]['chosen_key'], 'F#m')
+        self.assertEqual(db_return[3]['chosen_bpm'], 129)
         print("{} - {} - END".format(self.clname, name))
 
     def test_get_tracks_by_key(self):
@@ -172,6 +329,154 @@ class TestCollection(unittest.TestCase):
         self.assertEqual(db_return[1]['chosen_bpm'], 125)
         print("{} - {} - END".format(self.clname, name))
 
+    def test_get_tracks_by_chosen_bpm_and_key(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.collection = Collection(False, self.db_path)
+        self.assertTrue(self.collection.schema_at_least(5))
+        # BPM ranges are an index range scan on the stored effective BPM
+        plan = self.collection._select('EXPLAIN QUERY PLAN SELECT d_track_no ' +
+            'FROM track WHERE chosen_bpm >= ? AND chosen_bpm <= ?', params=(100, 110))
+        self.assertRegex('\n'.join(row['detail'] for row in plan),
+            r'SEARCH (TABLE )?track USING INDEX track_chosen_bpm ' +
+            r'\(chosen_bpm>\? AND chosen_bpm<\?\)')
+        # AcousticBrainz values are used as long as there is no user input
+        self.collection.update_tracks_accbr([('Dm', 'Dm', 99.04, 123456, 'B1')])
+        db_return = self.collection.get_tracks_by_bpm(99, 1)
+        self.assertEqual(len(db_return), 0) # track_ext.bpm 140 wins
+        self.collection.upsert_track_ext({'d_release_id': 123456,
+            'd_track_no': 'B1'}, {'bpm': None})
+        db_return = self.collection.get_tracks_by_key_and_bpm('Dm', 99, 1)
+        self.assertEqual(len(db_return), 1)
+        self.assertEqual(db_return[0]['d_track_no'], 'B1')
+        self.assertEqual(db_return[0]['chosen_bpm'], 99.0)
+        self.assertEqual(db_return[0]['chosen_key'], 'Dm')
+        # only tracks in the BPM range, even if the key matches
+        self.assertEqual(self.collection.get_tracks_by_key_and_bpm('Am', 99, 1), [])
+        # put fixture data back in place for other tests
+        self.collection.upsert_track_ext({'d_release_id': 123456,
+            'd_track_no': 'B1'}, {'bpm': 140})
+        self.collection.update_tracks_accbr([(None, None, None, 123456, 'B1')])
+        db_return = self.collection.get_tracks_by_bpm(140, 1)
+        self.assertEqual(len(db_return), 1)
+        self.assertEqual(db_return[0]['d_track_no'], 'B1')
+        self.assertIsNone(db_return[0]['chosen_key'])
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_get_tracks_by_harmonic_key(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.assertEqual(camelot('Am'), '8A')
+        self.assertEqual(camelot('a minor'), '8A')
+        self.assertEqual(camelot('F♯m'), '11A')
+        self.assertEqual(camelot('Db maj'), '3B')
+        self.assertEqual(camelot('08b'), '8B')
+        self.assertIsNone(camelot('H'))
+        self.assertEqual(camelot_neighbours('12A'), {'12A': 'same',
+            '1A': '+1', '11A': '-1', '12B': 'relative', '2A': 'boost'})
+        self.collection = Collection(False, self.db_path)
+        db_return = self.collection.get_tracks_by_harmonic_key('A minor')
+        self.assertEqual(len(db_return), 3) # Am, Am and C
+        self.assertEqual(db_return[0]['d_track_no'], 'AA')
+        self.assertEqual(db_return[0]['chosen_camelot'], '8A')
+        self.assertEqual(db_return[1]['d_track_no'], 'A1')
+        self.assertEqual(db_return[2]['d_track_no'], 'B2')
+        self.assertEqual(db_return[2]['chosen_key'], 'C')
+        self.assertEqual(db_return[2]['chosen_camelot'], '8B')
+        db_return = self.collection.get_tracks_by_harmonic_key('8A', 120, 1)
+        self.assertEqual(len(db_return), 1)
+        self.assertEqual(db_return[0]['d_track_no'], 'AA')
+        db_return = self.collection.get_tracks_by_harmonic_key('Gbm')
+        self.assertEqual(len(db_return), 1) # AcousticBrainz key, no track_ext
+        self.assertEqual(db_return[0]['d_track_no'], 'A')
+        self.assertEqual(self.collection.get_tracks_by_harmonic_key('nokey'), [])
+        # chosen_camelot follows key edits, lookups use its index
+        self.collection.upsert_track_ext({'d_release_id': 123456,
+            'd_track_no': 'B2'}, {'key': 'F#m'})
+        db_return = self.collection.get_tracks_by_harmonic_key('Gbm')
+        self.assertEqual(len(db_return), 2)
+        self.assertEqual(db_return[1]['d_track_no'], 'B2')
+        self.collection.upsert_track_ext({'d_release_id': 123456,
+            'd_track_no': 'B2'}, {'key': 'C'})
+        plan = self.collection._select('EXPLAIN QUERY PLAN SELECT d_track_no ' +
+            'FROM track WHERE chosen_camelot IN (SELECT compatible ' +
+            'FROM camelot_compat WHERE camelot = ?)', params=('8A', ))
+        self.assertRegex('\n'.join(row['detail'] for row in plan),
+            r'SEARCH (TABLE )?track USING INDEX ' +
+            r'track_chosen_camelot_chosen_bpm \(chosen_camelot=\?\)')
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_get_tracks_by_chosen_without_track_ext(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.collection = Collection(False, self.db_path)
+        # AcousticBrainz data alone is enough, no user edits (track_ext) needed
+        self.collection.create_release(1234568, 'Untouched Release', 'Nobody',
+                                       'UNT 001', d_coll = True)
+        self.collection.upsert_track(1234568, 'A', 'Only Analyzed', 'Nobody')
+        self.collection.update_tracks_accbr([('Ebm', 'Ebm', 131.5, 1234568, 'A')])
+        untouched = lambda rows: [r for r in rows if r['d_catno'] == 'UNT 001']
+        db_return = untouched(self.collection.get_tracks_by_bpm(131.5, 1))
+        self.assertEqual(len(db_return), 1)
+        self.assertEqual(db_return[0]['chosen_key'], 'Ebm')
+        self.assertEqual(len(untouched(
+            self.collection.get_tracks_by_key('Ebm'))), 1)
+        db_return = untouched(self.collection.get_tracks_by_harmonic_key('2A'))
+        self.assertEqual(len(db_return), 1)
+        self.assertEqual(db_return[0]['chosen_camelot'], '2A')
+        self.collection.execute_sql(
+            'DELETE FROM track WHERE d_release_id == 1234568;')
+        self.collection.execute_sql(
+            'DELETE FROM release WHERE discogs_id == 1234568;')
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_set_builder(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        tracks = [
+            {'d_release_id': 1, 'd_track_no': 'A', 'chosen_camelot': '8A', 'chosen_bpm': 120},
+            {'d_release_id': 2, 'd_track_no': 'A', 'chosen_camelot': '8A', 'chosen_bpm': 120.5},
+            {'d_release_id': 3, 'd_track_no': 'A', 'chosen_camelot': '9A', 'chosen_bpm': 121},
+            {'d_release_id': 4, 'd_track_no': 'A', 'chosen_camelot': '3B', 'chosen_bpm': 120},
+            {'d_release_id': 5, 'd_track_no': 'A', 'chosen_camelot': '8A', 'chosen_bpm': 135},
+            {'d_release_id': 2, 'd_track_no': 'B', 'chosen_camelot': '8B', 'chosen_bpm': 120}]
+        transitions = [{'from_release_id': 1, 'from_track_no': 'A',
+            'd_release_id': 4, 'd_track_no': 'A', 'trans_rating': '++'}]
+        builder = Set_builder(tracks, transitions)
+        # a well rated transition wins over a compatible key
+        proposed = builder.build((1, 'A'), 2)
+        self.assertEqual([(tr['d_release_id'], rel) for tr, rel in proposed],
+                         [(1, 'start'), (4, 'played before')])
+        proposed = builder.build((1, 'A'), 6)
+        releases = [tr['d_release_id'] for tr, _ in proposed]
+        self.assertEqual(releases[0], 1)
+        # 135 BPM is too far, record 2 once only, 3B leads nowhere
+        self.assertEqual(len(releases), 3)
+        self.assertEqual(set(releases), {1, 2, 3})
+        self.assertEqual(len(set(releases)), len(releases))
+        self.assertNotIn(5, releases)
+        # total drift limits the whole set
+        builder = Set_builder(tracks, max_total_drift = 0.5)
+        proposed = builder.build((1, 'A'), 6)
+        self.assertEqual([(tr['d_release_id'], rel) for tr, rel in proposed],
+                         [(1, 'start'), (2, 'same')])
+        self.assertEqual(builder.build((9, 'A'), 6), []) # unknown track
+        # a BPM of 0 (e.g. entered by mistake) is no BPM
+        builder = Set_builder(tracks + [{'d_release_id': 6, 'd_track_no': 'A',
+            'chosen_camelot': '8A', 'chosen_bpm': 0}])
+        self.assertEqual(builder.build((6, 'A'), 6), [])
+        self.assertNotIn(6, [tr['d_release_id'] for tr, _
+                             in builder.build((1, 'A'), 6)])
+        self.assertEqual(builder.drift(0, 120), float('inf'))
+        # with DiscoBASE data
+        self.collection = Collection(False, self.db_path)
+        builder = Set_builder(self.collection.get_tracks_for_set_builder(),
+            self.collection.get_transition_ratings(), max_drift = 5)
+        proposed = builder.build((8620643, 'AA'), 3)
+        self.assertEqual([(tr['d_track_no'], rel) for tr, rel in proposed],
+                         [('AA', 'start'), ('A1', 'same')])
+        print("{} - {} - END".format(self.clname, name))
+
     def test_search_release_online_text_multiple(self):
         print("\nTestMix.search_release_online_text_multiple: BEGIN")
         self.collection = Collection(False, self.db_path)
@@ -321,6 +626,10 @@ class TestCollection(unittest.TestCase):
         self.assertEqual(db_return[1]["a_bpm"], None)
         # track 5
         self.assertEqual(db_return[2]["track_pos"], 5)
+        # positions are numbered densely, mix 129 has a gap at track_pos 5
+        db_return = self.collection.track_report_snippet(5, 129)
+        self.assertEqual([row["track_pos"] for row in db_return], [4, 5]) # last
+        self.assertEqual(db_return[1]["d_track_no"], "B1")
         print("{} - {} - END".format(self.clname, name))
 
     def test_track_report_occurences(self):
@@ -340,6 +649,26 @@ class TestCollection(unittest.TestCase):
         self.assertEqual(db_return[10]["track_pos"], 2) # used at pos 2
         print("{} - {} - END".format(self.clname, name))
 
+    def test_track_report_snippets(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.collection = Collection(False, self.db_path)
+        db_return = self.collection.track_report_snippets(123456, 'B2')
+        # one query returns the same rows as a snippet query per occurence
+        expected = []
+        for occ in self.collection.track_report_occurences(123456, 'B2'):
+            snippet = self.collection.track_report_snippet(occ['track_pos'],
+                                                           occ['mix_id'])
+            expected.extend([(occ['mix_id'], occ['name'], occ['track_pos'])
+                             + tuple(row) for row in snippet])
+        self.assertEqual([tuple(row) for row in db_return], expected)
+        self.assertEqual(db_return[0]["mix_id"], 125)
+        self.assertEqual(db_return[0]["occurence_pos"], 2)
+        self.assertEqual(db_return[0]["track_pos"], 1) # track played before
+        self.assertEqual(db_return[1]["d_track_no"], 'B2')
+        self.assertEqual(self.collection.track_report_snippets(123456, 'X9'), [])
+        print("{} - {} - END".format(self.clname, name))
+
     def test_stats_match_method_release(self):
         name = inspect.currentframe().f_code.co_name
         print("\n{} - {} - BEGIN".format(self.clname, name))
@@ -379,6 +708,421 @@ class TestCollection(unittest.TestCase):
             # d_get_first_catno() to retrieve it. This should be handled elsewhere
         print("{} - {} - END".format(self.clname, name))
 
+    def test_update_tracks_accbr(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.collection = Collection(False, self.db_path)
+        rowcount = self.collection.update_tracks_accbr([
+            ('D', 'Bm', 121.5, 123456, 'b2'),
+            ('E', 'E', 99.0, 123456, 'B1')])
+        self.assertEqual(rowcount, 2)
+        db_return = self.collection._select_simple(
+            ['d_track_no', 'a_key', 'a_chords_key', 'a_bpm'], 'track',
+            condition='d_release_id = 123456', orderby='d_track_no')
+        self.assertEqual(db_return[1]['a_key'], 'E') # B1
+        self.assertEqual(db_return[2]['a_key'], 'D') # B2
+        self.assertEqual(db_return[2]['a_chords_key'], 'Bm')
+        self.assertEqual(db_return[2]['a_bpm'], 121.5)
+        # put fixture data back in place for other tests
+        self.collection.update_tracks_accbr([
+            (None, None, None, 123456, 'B2'),
+            (None, None, None, 123456, 'B1')])
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_d_release_import_data(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.collection = Collection(False, self.db_path)
+        # a release object with full data, no lazy loading is triggered
+        d_release = discogs_client.Release(discogs_client.Client('DiscoDOS'), {
+            'id': 1, 'title': 'Title', 'artists': [{'id': 1, 'name': 'Artist'}],
+            'labels': [{'id': 2, 'name': 'Label', 'catno': 'CAT 1'}],
+            'tracklist': [
+                {'position': 'A1', 'title': 'Track 1', 'artists': []},
+                {'position': 'B1', 'title': 'Track 2',
+                 'artists': [{'id': 3, 'name': 'Remixer'}]}]})
+        rel = self.collection.d_release_import_data(d_release, tracks = True)
+        self.assertEqual(rel['id'], 1)
+        self.assertEqual(rel['artists'], 'Artist')
+        self.assertEqual(rel['catno'], 'CAT 1')
+        self.assertEqual(rel['tracks'], [('A1', 'Track 1', 'Artist'),
+                                         ('B1', 'Track 2', 'Remixer')])
+        self.assertIsNone(rel['error'])
+        rel = self.collection.d_release_import_data(d_release)
+        self.assertEqual(rel['tracks'], [])
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_release_needs_import(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.collection = Collection(False, self.db_path)
+        state = self.collection.get_releases_import_state()
+        self.assertEqual(len(state), 4)
+        self.assertEqual(state[123456]['tracks'], 3)
+        self.assertEqual(state[69092]['tracks'], 0)
+        # new releases are imported, known ones only if added again later
+        self.assertTrue(self.collection.release_needs_import(
+            None, '2020-01-01T10:00:00-08:00'))
+        self.assertFalse(self.collection.release_needs_import(
+            state[123456], '2020-01-01T10:00:00-08:00'))
+        self.assertTrue(self.collection.release_needs_import(
+            state[123456], '2021-01-01T10:00:00-08:00'))
+        # when importing tracks, releases without tracks are fetched again
+        self.assertFalse(self.collection.release_needs_import(
+            state[69092], '2019-01-01T10:00:00-08:00'))
+        self.assertTrue(self.collection.release_needs_import(
+            state[69092], '2019-01-01T10:00:00-08:00', tracks = True))
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_set_releases_not_in_d_collection(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.collection = Collection(False, self.db_path)
+        removed = self.collection.set_releases_not_in_d_collection(
+            {69092, 123456, 8620643})
+        self.assertEqual(removed, 1)
+        db_return = self.collection.search_release_id(919698)
+        self.assertEqual(db_return['in_d_collection'], 0)
+        self.assertEqual(self.collection.set_releases_not_in_d_collection(
+            {69092, 123456, 8620643}), 0)
+        # put fixture data back in place for other tests
+        self.collection.execute_sql(
+            'UPDATE release SET in_d_collection = 1 WHERE discogs_id == 919698;')
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_get_db_releases_by_ids(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.collection = Collection(False, self.db_path)
+        db_return = self.collection.get_db_releases_by_ids([1, 123456, '8620643'])
+        self.assertEqual(sorted(db_return), [123456, 8620643])
+        self.assertEqual(db_return[123456]['discogs_title'], 'Material Love')
+        self.assertEqual(self.collection.get_db_releases_by_ids([]), {})
+        self.assertTrue(self.collection.has_releases())
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_d_collection_index(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.collection = Collection(False, self.db_path)
+        class Listing(object): # stands in for a discogs_client PaginatedList
+            def __init__(self, items):
+                self.items, self.order, self.walked = items, 'asc', 0
+            def sort(self, key, order = 'asc'):
+                self.order = order
+                return self
+            @property
+            def count(self):
+                return len(self.items)
+            def __iter__(self):
+                for item in (reversed(self.items) if self.order == 'desc'
+                             else self.items):
+                    self.walked += 1
+                    yield item
+        def item(instance_id, release_id):
+            return SimpleNamespace(instance_id = instance_id, folder_id = 1,
+                release = SimpleNamespace(id = release_id),
+                date_added = '2020-01-0{}T10:00:00-08:00'.format(instance_id))
+        listing = Listing([item(1, 69092), item(2, 123456)])
+        self.collection.me = SimpleNamespace(collection_folders = [
+            SimpleNamespace(releases = listing)])
+        self.assertTrue(self.collection.is_in_d_coll(123456)) # full fetch
+        self.assertFalse(self.collection.is_in_d_coll(8620643))
+        self.assertEqual(listing.walked, 2)
+        # added on Discogs: seen after expiry, only the new item is walked
+        listing.items.append(item(3, 8620643))
+        self.assertFalse(self.collection.is_in_d_coll(8620643)) # still fresh
+        self.collection.expire_d_collection_index()
+        listing.walked = 0
+        self.assertTrue(self.collection.is_in_d_coll(8620643))
+        self.assertEqual(listing.walked, 2) # new one and first known one
+        # removed on Discogs: counts don't add up, whole listing is fetched
+        del listing.items[0]
+        self.collection.refresh_d_collection_index(max_age = 0)
+        self.assertFalse(self.collection.is_in_d_coll(69092))
+        self.assertTrue(self.collection.is_in_d_coll(123456))
+        self.collection.execute_sql('DELETE FROM d_collection;')
+        self.collection.expire_d_collection_index()
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_jobs(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.collection = Collection(False, self.db_path)
+        params = {'detail': 2}
+        self.assertIsNone(self.collection.get_unfinished_job('brainz', params))
+        job_id = self.collection.start_job('brainz', params)
+        self.assertTrue(job_id)
+        key = self.collection.job_item_key(69092, 'A1')
+        self.assertEqual(key, '69092/A1')
+        self.assertEqual(self.collection.job_item_key(69092), '69092')
+        self.collection.job_item_done(job_id, key)
+        self.collection.job_item_done(job_id, key) # twice is fine
+        self.collection.job_item_done(job_id, '69092/A2')
+        self.assertFalse(self.collection.job_item_done(None, key))
+        # interrupted: found again, but only with the same params
+        self.assertIsNone(self.collection.get_unfinished_job('brainz',
+            {'detail': 1}))
+        self.assertIsNone(self.collection.get_unfinished_job('import', params))
+        job = self.collection.get_unfinished_job('brainz', {'detail': 2})
+        self.assertEqual(job['job_id'], job_id)
+        self.assertEqual(self.collection.get_job_done_items(job_id),
+            {'69092/A1', '69092/A2'})
+        self.collection.finish_job(job_id)
+        self.assertIsNone(self.collection.get_unfinished_job('brainz', params))
+        self.assertEqual(self.collection.get_job_done_items(job_id), set())
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_get_all_tracks_for_brainz_update(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.collection = Collection(False, self.db_path)
+        all_tracks = self.collection.get_all_tracks_for_brainz_update()
+        keys = lambda rows: [(r['discogs_id'], r['d_track_no']) for r in rows]
+        # never matched and matched in 2020, but no releases without tracks
+        stale = self.collection.get_all_tracks_for_brainz_update(max_age = 30)
+        self.assertEqual(keys(stale), [k for k in keys(all_tracks)
+                                       if k[1] is not None])
+        self.collection.execute_sql('''UPDATE track
+            SET m_match_time = datetime('now', 'localtime')
+            WHERE d_release_id == 123456 AND d_track_no == 'A1';''')
+        stale_now = self.collection.get_all_tracks_for_brainz_update(max_age = 30)
+        self.assertNotIn((123456, 'A1'), keys(stale_now))
+        self.assertEqual(len(stale_now), len(stale) - 1)
+        # Recording MBID but no AcousticBrainz BPM
+        missing = self.collection.get_all_tracks_for_brainz_update(
+            missing_only = True)
+        self.assertEqual(keys(missing), [(8620643, 'AA')])
+        self.assertEqual(missing[0]['m_rec_id'],
+            'e8bfb39b-36f1-4d65-be3c-61b05b3f67de')
+        self.assertEqual(self.collection.get_all_tracks_for_brainz_update(
+            max_age = 30, missing_only = True)[0]['d_track_no'], 'AA')
+        self.collection.execute_sql('''UPDATE track SET m_match_time = NULL
+            WHERE d_release_id == 123456 AND d_track_no == 'A1';''')
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_get_all_tracks_for_brainz_update_query_plan(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        # with statistics SQLite likes to scan release, which is slow
+        analyzed_path = self.db_path.with_name('discobase_analyzed.db')
+        copy2(self.db_path, analyzed_path)
+        self.addCleanup(os.remove, analyzed_path)
+        collection = Collection(False, analyzed_path)
+        collection.execute_sql('ANALYZE;')
+        sqls = []
+        select = collection._select
+        def _select(sql_select, fetchone = False, params = ()):
+            sqls.append((sql_select, params))
+            return select(sql_select, fetchone, params)
+        collection._select = _select
+        collection.get_all_tracks_for_brainz_update(max_age = 30)
+        collection.get_all_tracks_for_brainz_update(max_age = 30, detail = 1)
+        collection.get_all_tracks_for_brainz_update(missing_only = True)
+        del collection._select
+        for sql, params in sqls:
+            details = [row['detail'] for row in collection.cur.execute(
+                'EXPLAIN QUERY PLAN ' + sql, params).fetchall()]
+            self.assertFalse([d for d in details
+                              if re.match(r'SCAN (TABLE )?(release|track)$', d)])
+            self.assertTrue([d for d in details if re.match(
+                r'(SEARCH|SCAN) (TABLE )?track USING (COVERING )?INDEX '
+                r'(track_m_match_time|track_accbr_missing)', d)])
+        collection.close_conn()
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_brainz_fail(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.collection = Collection(False, self.db_path)
+        keys = lambda rows: [(r['discogs_id'], r['d_track_no']) for r in rows]
+        fail = lambda: self.collection._select_simple(['fail_count',
+            "julianday(retry_after) - julianday(last_fail) AS days"],
+            'brainz_fail', 'd_release_id == 123456 AND d_track_no == ?',
+            fetchone = True, params = ('A1', ))
+        self.assertIn((123456, 'A1'), keys(
+            self.collection.get_all_tracks_for_brainz_update(detail = 1)))
+        self.collection.record_brainz_fail(123456, 'a1', 'no_release', 1)
+        self.assertEqual(fail()['fail_count'], 1)
+        self.assertAlmostEqual(fail()['days'], 7)
+        self.assertNotIn((123456, 'A1'), keys(
+            self.collection.get_all_tracks_for_brainz_update(detail = 1)))
+        self.assertEqual(self.collection.count_brainz_fails_backed_off(1), 1)
+        # a more detailed match is tried
+        self.assertIn((123456, 'A1'), keys(
+            self.collection.get_all_tracks_for_brainz_update(detail = 2)))
+        self.collection.record_brainz_fail(123456, 'A1', 'no_recording', 1)
+        self.assertEqual(fail()['fail_count'], 2)
+        self.assertAlmostEqual(fail()['days'], 14)
+        # after the back-off the track is retried and marked so the web
+        # cache doesn't answer with the same failure again
+        self.collection.execute_sql('''UPDATE brainz_fail
+            SET retry_after = datetime('now', 'localtime', '-1 days');''')
+        retried = [row for row in
+            self.collection.get_all_tracks_for_brainz_update(detail = 1)
+            if (row['discogs_id'], row['d_track_no']) == (123456, 'A1')]
+        self.assertEqual(retried[0]['brainz_fails'], 2)
+        # changed Discogs data is tried again, the back-off starts over
+        sql_name = '''UPDATE track SET d_track_name = ?
+            WHERE d_release_id == 123456 AND d_track_no == 'A1';'''
+        track_name = self.collection.get_track(123456, 'A1')['d_track_name']
+        self.collection.execute_sql(sql_name, ('Renamed', ))
+        self.assertIn((123456, 'A1'), keys(
+            self.collection.get_all_tracks_for_brainz_update(detail = 1)))
+        self.collection.record_brainz_fail(123456, 'A1', 'no_release', 1)
+        self.assertEqual(fail()['fail_count'], 1)
+        self.collection.execute_sql(sql_name, (track_name, ))
+        self.collection.clear_brainz_fail(123456, 'A1')
+        self.assertIsNone(fail())
+        self.assertEqual(self.collection.count_brainz_fails_backed_off(1), 0)
+        # --missing-only backs off tracks AcousticBrainz doesn't know either
+        self.collection.record_brainz_fail(8620643, 'AA', 'no_accbr', 1)
+        self.assertEqual(self.collection.get_all_tracks_for_brainz_update(
+            missing_only = True, detail = 1), [])
+        self.assertEqual(keys(self.collection.get_all_tracks_for_brainz_update(
+            missing_only = True)), [(8620643, 'AA')])
+        self.collection.clear_brainz_fail(8620643, 'AA')
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_sqlite_min_version(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.assertGreaterEqual(sqlite3.sqlite_version_info,
+                                Collection.sqlite_min_version)
+        future = type('Future_collection', (Collection, ),
+                      {'sqlite_min_version': (99, 0, 0)})
+        with self.assertRaises(SystemExit):
+            future(False, self.db_path)
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_transaction(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.collection = Collection(False, self.db_path)
+        sql_u = "UPDATE release SET d_catno = ? WHERE discogs_id == 69092;"
+        catno = self.collection.search_release_id(69092)['d_catno']
+        with self.collection.transaction(commit_every = 3):
+            self.collection.execute_sql(sql_u, ('TX 1', ))
+            self.collection.execute_sql(sql_u, ('TX 2', ))
+            self.assertTrue(self.collection.db_conn.in_transaction)
+            self.collection.execute_sql(sql_u, ('TX 3', )) # 3rd commits
+            self.assertFalse(self.collection.db_conn.in_transaction)
+            self.collection.execute_sql(sql_u, ('TX 4', ))
+        self.assertFalse(self.collection.db_conn.in_transaction)
+        # database errors roll back everything not committed yet
+        with self.assertRaises(sqlite3.Error):
+            with self.collection.transaction():
+                self.collection.execute_sql(sql_u, ('TX 5', ))
+                self.collection.execute_sql('INSERT INTO nothing VALUES (1);',
+                                            raise_err = True)
+        self.assertEqual(self.collection.search_release_id(69092)['d_catno'],
+                         'TX 4')
+        # other exceptions (eg. ctrl-c) keep what was done
+        with self.assertRaises(KeyboardInterrupt):
+            with self.collection.transaction():
+                self.collection.execute_sql(sql_u, (catno, ))
+                raise KeyboardInterrupt
+        self.assertFalse(self.collection.db_conn.in_transaction)
+        self.assertEqual(self.collection.search_release_id(69092)['d_catno'],
+                         catno)
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_upsert_tracks(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.collection = Collection(False, self.db_path)
+        orig = self.collection._select_simple(['d_track_name', 'd_artist'],
+            'track', condition = "d_release_id == 123456 AND d_track_no == 'A1'",
+            fetchone = True)
+        ret = self.collection.upsert_tracks(123456, [
+            ('a1', 'New Name', 'New Artist'), ('C1', 'Brand New', 'Artist')])
+        self.assertEqual(ret, 2)
+        self.assertEqual(self.collection.get_track(123456, 'A1')['d_track_name'],
+                         'New Name')
+        self.assertEqual(self.collection.get_track(123456, 'C1')['d_track_name'],
+                         'Brand New')
+        # put fixture data back in place for other tests
+        self.collection.upsert_tracks(123456, [
+            ('A1', orig['d_track_name'], orig['d_artist'])])
+        self.collection.execute_sql(
+            "DELETE FROM track WHERE d_release_id == 123456 AND d_track_no == 'C1';")
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_upserts_keep_other_fields(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.collection = Collection(False, self.db_path)
+        # re-importing a release keeps its MusicBrainz data
+        self.assertEqual(self.collection.create_release(8620643, 'The Crane',
+            'Source Direct', 'SCIENCE 1', d_coll = True), 1)
+        db_return = self.collection.search_release_id(8620643)
+        self.assertEqual(db_return['d_catno'], 'SCIENCE 1')
+        self.assertEqual(db_return['m_rel_id'], 'c4b619f1-5ae2-45e5-b848-71290e97eb69')
+        # track_ext upsert only touches the given fields
+        self.assertEqual(self.collection.upsert_track_ext(
+            {'d_release_id': 123456, 'd_track_no': 'b1'}, {'key': 'Dm'}), 1)
+        db_return = self.collection.get_track(123456, 'B1')
+        self.assertEqual(db_return['key'], 'Dm')
+        self.assertEqual(db_return['bpm'], 140.0)
+        self.assertEqual(self.collection.upsert_track_ext(
+            {'d_release_id': 123456, 'd_track_no': 'Z9'}, {'bpm': 99.0}), 1)
+        self.assertEqual(self.collection.get_track(123456, 'B1')['key'], 'Dm')
+        # a match waiting for the AcousticBrainz bulk lookup keeps a_* fields
+        self.assertEqual(self.collection.upsert_track_brainz(8620643, 'a',
+            'b6b3b3b3-0000-4000-8000-000000000001', 'test', None, None, None,
+            accbr = False), 1)
+        db_return = self.collection.get_track(8620643, 'A')
+        self.assertEqual(db_return['a_key'], 'F#m')
+        self.assertEqual(db_return['a_bpm'], 129.045806885)
+        self.assertEqual(self.collection._select_simple(['m_rec_id'], 'track',
+            "d_release_id == 8620643 AND d_track_no == 'A'", fetchone = True)[0],
+            'b6b3b3b3-0000-4000-8000-000000000001')
+        # put fixture data back in place for other tests
+        self.collection.execute_sql('''UPDATE track SET m_rec_id = NULL,
+            m_match_method = NULL, m_match_time = NULL
+            WHERE d_release_id == 8620643 AND d_track_no == 'A';''')
+        self.collection.upsert_track_ext(
+            {'d_release_id': 123456, 'd_track_no': 'B1'}, {'key': None})
+        self.collection.execute_sql(
+            "DELETE FROM track_ext WHERE d_release_id == 123456 AND d_track_no == 'Z9';")
+        self.collection.execute_sql(
+            "UPDATE release SET d_catno = NULL WHERE discogs_id == 8620643;")
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_rate_limiter(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        limiter = Rate_limiter(5, 0.5) # 10 requests/s, bursts of 5
+        for i in range(5): # the burst doesn't wait
+            limiter.acquire()
+        self.assertEqual(limiter.waited, 0)
+        limiter.acquire() # 6th request has to wait for a token (0.1s)
+        self.assertGreater(limiter.waited, 0.05)
+        self.assertLess(limiter.waited, 0.5)
+        # server says nothing remaining -> its window is full, the next
+        # request waits for a whole period
+        waited = limiter.waited
+        limiter.sync('5', '0')
+        limiter.acquire()
+        self.assertGreaterEqual(limiter.waited - waited, 0.5)
+        limiter.sync(None, None) # missing headers are ignored
+        self.assertEqual(limiter.limit, 5)
+        # headers come from the thread's own response, not from the
+        # fetcher's attributes other threads overwrite
+        class Fetcher_stub(object):
+            def request(self, method, url, data=None, headers=None):
+                return SimpleNamespace(headers = {'X-Discogs-Ratelimit': '5',
+                    'X-Discogs-Ratelimit-Remaining': '0'})
+            def fetch(self, client, method, url, data=None, headers=None):
+                self.request(method, url, data, headers)
+                self.rate_limit, self.rate_limit_remaining = '5', '5'
+                return b'{}', 200
+        fetcher = Rate_limited_fetcher(Fetcher_stub(), limiter)
+        self.assertEqual(fetcher.fetch(None, 'GET', 'releases/1'), (b'{}', 200))
+        self.assertEqual(limiter.tokens, 0)
+        self.assertGreater(limiter.last_refill, time.monotonic())
+        print("{} - {} - END".format(self.clname, name))
+
     @classmethod
     def tearDownClass(self):
         name = inspect.currentframe().f_code.co_name
@@ -5,6 +5,7 @@ from discodos.models import *
 from discodos.utils import *
 from discodos.config import create_data_dir, Db_setup, Config
 import inspect
+import re
 from pathlib import Path
 import os
 
@@ -20,6 +21,7 @@ class TestMix(unittest.TestCase):
         self.db_path = discodos_tests / 'discobase.db'
         self.clname = self.__name__ # just handy a shortcut, used in test output
         print('TestMix.setUpClass: test-db: {}'.format(copy2(empty_db_path, self.db_path)))
+        Db_setup(self.db_path).upgrade_schema() # fixture is at schema version 2
         print("TestMix.setUpClass: done\n")
 
     def test_non_existent(self):
@@ -149,9 +151,10 @@ class TestMix(unittest.TestCase):
         self.mix = Mix(False, 127, self.db_path)
         db_ret_add = self.mix.add_track("123456", "B2", 5, 'üüü', '@@@')
         self.assertEqual(db_ret_add, 1)
-        db_return = self.mix.get_one_mix_track(5) # get track #2
+        # positions are numbered densely on reading, the gap at 4 doesn't show
+        db_return = self.mix.get_one_mix_track(4)
         self.assertEqual(len(db_return), 13) # select returns 13 cols
-        self.assertEqual(db_return["track_pos"], 5)
+        self.assertEqual(db_return["track_pos"], 4)
         self.assertEqual(db_return["discogs_title"], "Material Love")
         self.assertEqual(db_return["d_track_name"], "Hedup!")
         self.assertEqual(db_return["d_track_no"], "B2")
@@ -183,27 +186,6 @@ class TestMix(unittest.TestCase):
             'Material Love (Cab Drivers Remix)') # pos 5 should be this track now
         print("{} - {} - END".format(self.clname, name))
 
-    def test_reorder_tracks_squeeze_in(self):
-        name = inspect.currentframe().f_code.co_name
-        print("\n{} - {} - BEGIN".format(self.clname, name))
-        self.mix = Mix(False, 130, self.db_path) # mix 130 has contains 6 tracks
-        # get tracks to shift
-        tracks_to_shift = self.mix.get_tracks_from_position(3) # track 3 is Material Love
-        # add new track
-        rowcount = self.mix.add_track(8620643, "A", track_pos = 3) # add "The Crane"
-        self.assertEqual(rowcount, 1) # 1 row was added?
-        # now shift previously found tracks, shifting starts at pos 3
-        db_ret_reord = self.mix.reorder_tracks_squeeze_in(3, tracks_to_shift)
-        self.assertEqual(db_ret_reord, 1)
-        db_get_crane = self.mix.get_one_mix_track(3) # get the squeezed in track
-        self.assertEqual(len(db_get_crane), 13) # select should return 13 columns
-        self.assertEqual(db_get_crane['d_track_name'], 'The Crane') # should be The Crane
-        db_get_cab = self.mix.get_one_mix_track(4) # get track after that
-        self.assertEqual(len(db_get_cab), 13) # select should return 13 columns
-        self.assertEqual(db_get_cab['d_track_name'],
-            'Material Love (Cab Drivers Remix)') # should be cab driver remix
-        print("{} - {} - END".format(self.clname, name))
-
     def test_get_tracks_from_position(self):
         name = inspect.currentframe().f_code.co_name
         print("\n{} - {} - BEGIN".format(self.clname, name))
@@ -351,6 +333,137 @@ class TestMix(unittest.TestCase):
         self.assertEqual(get_5_return["d_track_no"], 'AA')
         print("{} - {} - END".format(self.clname, name))
 
+    def test_insert_move_remove_track(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.mix = Mix(False, 0, self.db_path)
+        self.mix.create("2020-01-01", "test venue", "test positions api")
+        for pos, track_no in enumerate(['A1', 'B1', 'B2'], 1):
+            self.mix.add_track(123456, track_no, pos)
+        def track_nos():
+            return [(t['track_pos'], t['d_track_no'])
+                    for t in self.mix.get_tracks_of_one_mix()]
+        self.assertEqual(self.mix.insert_track(8620643, 'a', 2), 1)
+        self.assertEqual(track_nos(), [(1, 'A1'), (2, 'A'), (3, 'B1'), (4, 'B2')])
+        self.assertTrue(self.mix.move_track(4, 1))
+        self.assertEqual(track_nos(), [(1, 'B2'), (2, 'A1'), (3, 'A'), (4, 'B1')])
+        self.assertTrue(self.mix.move_track(1, 3))
+        self.assertEqual(track_nos(), [(1, 'A1'), (2, 'A'), (3, 'B2'), (4, 'B1')])
+        self.assertFalse(self.mix.move_track(1, 5)) # no position 5
+        self.assertFalse(self.mix.move_track(7, 1)) # no track 7
+        self.assertEqual(self.mix.remove_track(2), 1)
+        self.assertEqual(track_nos(), [(1, 'A1'), (2, 'B2'), (3, 'B1')])
+        self.assertFalse(self.mix.remove_track(4))
+        # changing positions needs a single commit
+        commits = []
+        self.mix.db_conn.set_trace_callback(
+            lambda sql: commits.append(sql) if sql == 'COMMIT' else None)
+        self.mix.move_track(3, 1)
+        self.mix.db_conn.set_trace_callback(None)
+        self.assertEqual(len(commits), 1)
+        # a failing edit leaves no half done changes behind
+        before = track_nos()
+        def _half_done():
+            self.mix.execute_sql('UPDATE mix_track SET track_pos = -track_pos '
+                                 'WHERE mix_id == ?;', (self.mix.id, ))
+            return False
+        self.assertFalse(self.mix._edit_positions(_half_done))
+        self.assertEqual(track_nos(), before)
+        # nested in an outer transaction only the failing edit is undone,
+        # the outer transaction's work is kept
+        def _broken():
+            _half_done()
+            self.mix.execute_sql('UPDATE no_such_table SET x = 1;',
+                                 raise_err = True)
+        with self.mix.transaction():
+            self.mix.execute_sql('UPDATE mix SET venue = ? WHERE mix_id == ?;',
+                                 ('outer venue', self.mix.id))
+            self.assertFalse(self.mix._edit_positions(_half_done))
+            self.assertFalse(self.mix._edit_positions(_broken))
+        self.assertFalse(self.mix.db_conn.in_transaction)
+        self.assertEqual(track_nos(), before)
+        self.assertEqual(self.mix.get_mix_info()['venue'], 'outer venue')
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_fractional_track_pos(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.mix = Mix(False, 0, self.db_path)
+        self.mix.create("2020-01-01", "test venue", "test fractional positions")
+        for pos, track_no in enumerate(['A1', 'B1', 'B2', 'A'], 1):
+            self.mix.insert_track(123456, track_no, pos)
+        def stored_pos():
+            return {row['mix_track_id']: row['track_pos']
+                    for row in self.mix._select_simple(['mix_track_id', 'track_pos'],
+                        'mix_track', 'mix_id == ?', params = (self.mix.id, ))}
+        before = stored_pos()
+        # inserting and moving write only one row
+        self.mix.insert_track(69092, 'A1', 2)
+        after = stored_pos()
+        self.assertEqual([k for k in after if after[k] != before.get(k)],
+                         [self.mix.get_one_mix_track(2)['mix_track_id']])
+        self.assertEqual(after[self.mix.get_one_mix_track(2)['mix_track_id']], 1.5)
+        self.mix.move_track(5, 1)
+        moved = stored_pos()
+        self.assertEqual(len([k for k in moved if moved[k] != after[k]]), 1)
+        # dense positions on reading, in whatever order the mix is shown
+        self.assertEqual([t['track_pos'] for t in self.mix.get_full_mix()],
+                         [1, 2, 3, 4, 5])
+        self.assertEqual([t['d_track_no'] for t in self.mix.get_full_mix()],
+                         ['A', 'A1', 'A1', 'B1', 'B2'])
+        self.assertEqual(self.mix.get_last_track()[0], 5)
+        self.assertEqual(len(self.mix.get_mix_tracks_for_brainz_update(4)), 2)
+        # squeezing in again and again at the same spot rebalances at some point
+        for _ in range(60):
+            self.mix.insert_track(919698, 'D2', 3)
+        self.assertEqual([t['track_pos'] for t in self.mix.get_full_mix()],
+                         list(range(1, 66)))
+        self.assertEqual(self.mix.get_one_mix_track(2)['d_track_no'], 'A1')
+        self.assertEqual(self.mix.get_one_mix_track(63)['d_track_no'], 'A1')
+        self.assertEqual(self.mix.get_one_mix_track(65)['d_track_no'], 'B2')
+        print("{} - {} - END".format(self.clname, name))
+
+    def query_plan(self, model, method, *args):
+        '''runs method and returns the EXPLAIN QUERY PLAN details of all
+           selects it executed'''
+        sqls = []
+        select = model._select
+        def _select(sql_select, fetchone = False, params = ()):
+            sqls.append((sql_select, params))
+            return select(sql_select, fetchone, params)
+        model._select = _select
+        getattr(model, method)(*args)
+        del model._select
+        details = []
+        for sql, params in sqls:
+            plan = model.cur.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            details += [row['detail'] for row in plan.fetchall()]
+        return details
+
+    def test_query_plans_mix_track(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.mix = Mix(False, 133, self.db_path)
+        self.collection = Collection(False, self.db_path)
+        for model, method, args in [
+                (self.mix, 'get_full_mix', ()),
+                (self.mix, 'get_full_mix', (True, )),
+                (self.mix, 'get_tracks_from_position', (3, )),
+                (self.mix, 'get_last_track', ()),
+                (self.mix, 'get_all_mix_tracks_for_brainz_update', ()),
+                (self.collection, 'track_report_snippet', (4, 133)),
+                (self.collection, 'track_report_occurences', (123456, 'A1'))]:
+            details = self.query_plan(model, method, *args)
+            self.assertTrue(details)
+            # mix_track has to be read via one of its indexes, never scanned,
+            # SQLite < 3.36 says "SCAN TABLE" / "SEARCH TABLE"
+            self.assertFalse([d for d in details
+                              if re.match(r'SCAN (TABLE )?mix_track$', d)])
+            if method != 'get_all_mix_tracks_for_brainz_update': # reads all
+                self.assertTrue([d for d in details
+                        if re.match(r'SEARCH (TABLE )?mix_track USING', d)])
+        print("{} - {} - END".format(self.clname, name))
+
 
     @classmethod
     def tearDownClass(self):
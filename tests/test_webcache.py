@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+import inspect
+import os
+import time
+import unittest
+from pathlib import Path
+
+from discodos.models import Brainz, Web_cache, Web_cache_fetcher, log
+
+
+class Fetcher_stub(object):
+    '''stands in for discogs_client's fetcher, counts real "requests"'''
+    def __init__(self):
+        self.requests = 0
+        self.rate_limit_remaining = 42
+
+    def fetch(self, client, method, url, data=None, headers=None):
+        self.requests += 1
+        return b'{"id": 1}', 200
+
+
+class TestWebcache(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        name = inspect.currentframe().f_code.co_name
+        self.clname = self.__name__ # just handy a shortcut, used in test output
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        discodos_tests = Path(os.path.dirname(os.path.abspath(__file__)))
+        self.cache_path = discodos_tests / 'webcache.db'
+        print("{} - {} - END\n".format(self.clname, name))
+
+    def setUp(self):
+        self.ttls = {'discogs': 1, 'musicbrainz': 1, 'acousticbrainz': 0}
+        self.web_cache = Web_cache(self.cache_path, self.ttls)
+        self.web_cache.clear()
+
+    def tearDown(self):
+        self.web_cache.close_conn()
+
+    def test_put_get(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.assertIsNone(self.web_cache.get('discogs', '/releases/1'))
+        self.assertTrue(self.web_cache.put('discogs', '/releases/1', b'{}', 200))
+        self.assertEqual(self.web_cache.get('discogs', '/releases/1'), (b'{}', 200))
+        self.assertTrue(self.web_cache.put_json('musicbrainz', 'release/x', {'a': 1}))
+        self.assertEqual(self.web_cache.get_json('musicbrainz', 'release/x'),
+                         ({'a': 1}, 200))
+        # server errors are not cached, 404s are
+        self.assertFalse(self.web_cache.put('discogs', '/releases/2', b'{}', 500))
+        self.assertTrue(self.web_cache.put('discogs', '/releases/3', b'{}', 404))
+        self.assertEqual(self.web_cache.get('discogs', '/releases/3'), (b'{}', 404))
+        # ttl 0 disables a service
+        self.assertFalse(self.web_cache.put('acousticbrainz', 'x/low-level', b'{}', 200))
+        self.assertIsNone(self.web_cache.get('acousticbrainz', 'x/low-level'))
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_ttl_expired(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.web_cache.put('discogs', '/releases/1', b'{}', 200)
+        self.web_cache.execute_sql('UPDATE response SET fetched = ?;',
+                                   (time.time() - 2 * 86400, ))
+        self.assertIsNone(self.web_cache.get('discogs', '/releases/1'))
+        # in cache only mode stale is better than nothing
+        self.web_cache.cache_only = True
+        self.assertEqual(self.web_cache.get('discogs', '/releases/1'), (b'{}', 200))
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_evict(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.web_cache.max_size = 25
+        for i in range(3): # 10 bytes each, the oldest has to go
+            self.web_cache.put('discogs', '/releases/{}'.format(i), b'0123456789', 200)
+            time.sleep(0.01)
+        self.assertIsNone(self.web_cache.get('discogs', '/releases/0'))
+        self.assertIsNotNone(self.web_cache.get('discogs', '/releases/1'))
+        self.assertIsNotNone(self.web_cache.get('discogs', '/releases/2'))
+        self.assertEqual(self.web_cache.total_size, 20)
+        # replacing a response doesn't count it twice
+        self.web_cache.put('discogs', '/releases/2', b'01234', 200)
+        self.assertEqual(self.web_cache.total_size, 15)
+        self.web_cache.clear()
+        self.assertEqual(self.web_cache.total_size, 0)
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_fetcher(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        stub = Fetcher_stub()
+        fetcher = Web_cache_fetcher(stub, self.web_cache)
+        url = 'https://api.discogs.com/releases/1'
+        self.assertEqual(fetcher.fetch(None, 'GET', url), (b'{"id": 1}', 200))
+        self.assertEqual(fetcher.fetch(None, 'GET', url), (b'{"id": 1}', 200))
+        self.assertEqual(stub.requests, 1)
+        # collection pages and non-GETs always go to Discogs
+        fetcher.fetch(None, 'GET', 'https://api.discogs.com/users/me/collection')
+        fetcher.fetch(None, 'GET', 'https://api.discogs.com/users/me/collection')
+        fetcher.fetch(None, 'POST', url)
+        self.assertEqual(stub.requests, 4)
+        self.assertEqual(fetcher.rate_limit_remaining, 42) # proxied
+        # the identity is the online check and belongs to the current token
+        identity = 'https://api.discogs.com/oauth/identity'
+        fetcher.fetch(None, 'GET', identity)
+        fetcher.fetch(None, 'GET', identity)
+        self.assertEqual(stub.requests, 6)
+        self.assertIsNone(self.web_cache.get('discogs', identity))
+        # cache only mode never asks Discogs
+        self.web_cache.cache_only = True
+        content, status = fetcher.fetch(None, 'GET', 'https://api.discogs.com/releases/2')
+        self.assertEqual(status, 504)
+        content, status = fetcher.fetch(None, 'GET', identity) # not online
+        self.assertEqual(status, 504)
+        self.assertEqual(stub.requests, 6)
+        print("{} - {} - END".format(self.clname, name))
+
+    def test_brainz_refresh(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        self.web_cache.cache_only = True # skips the MusicBrainz connect test
+        brainz = Brainz('', '', ('0.1', 'DiscoDOS test'), web_cache = self.web_cache)
+        self.web_cache.cache_only = False
+        asked = []
+        def search(query): # stands in for a musicbrainzngs function
+            asked.append(query)
+            return {'release-list': []}
+        key = 'release/search?query=nothing'
+        self.assertEqual(brainz._mb_cached(key, search, 'nothing'),
+                         {'release-list': []})
+        brainz._mb_cached(key, search, 'nothing')
+        self.assertEqual(len(asked), 1)
+        # a retry of a failed match asks again instead of repeating the
+        # cached failure, the new answer is cached
+        brainz.refresh = True
+        brainz._mb_cached(key, search, 'nothing')
+        self.assertEqual(len(asked), 2)
+        # in cache only mode there's nobody to ask
+        self.web_cache.cache_only = True
+        brainz._mb_cached(key, search, 'nothing')
+        self.assertEqual(len(asked), 2)
+        print("{} - {} - END".format(self.clname, name))
+
+    @classmethod
+    def tearDownClass(self):
+        name = inspect.currentframe().f_code.co_name
+        print("\n{} - {} - BEGIN".format(self.clname, name))
+        os.remove(self.cache_path)
+        print("{} - {} - END".format(self.clname, name))
+
+
+if __name__ == '__main__':
+    unittest.main()